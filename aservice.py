@@ -0,0 +1,335 @@
+import asyncio
+import json
+import sqlite3
+import sys
+from time import time, perf_counter
+
+import aiohttp
+from aiohttp import web
+from jinja2 import Environment, FileSystemLoader
+
+from server import (logger, Airline, DB_LCC_PATH, REQUEST_TIMEOUT, FETCH_DEADLINE, fare_cache, fare_history, breakers, get_cache_stats,
+                    plan_requests, vanilla_air_routes_request, parse_vanilla_air_transit, merge_fares, get_visualized_data,
+                    get_line_spec, get_table, get_stale,
+                    upstream_seconds, upstream_bytes, upstream_errors, parse_seconds, airline_fetch_seconds, request_seconds)
+from metrics import TRACE_HEADER, render, timer, start_trace, stop_trace, format_server_timing
+from sessions import RETRIES, BACKOFF_FACTOR, RETRY_STATUSES
+from fares import FareMatrix, get_month_axis, new_prices, fill_prices
+from migrations import migrate
+from catalog import get_catalog
+from httpcache import choose_encoding, parse_accept_encodings
+from history import HISTORY_DB_PATH, HISTORY_MIGRATIONS
+from readonly import ReadOnlyDatabase
+from resilience import FAILURE_STATUSES, CircuitOpen, UpstreamError
+from prewarm import Prewarmer
+
+# The same endpoints as service.py for /, /airport_codes, /airlines, /data, /data/stream, /status and /metrics,
+# served by one event loop.
+# Upstream requests go through an async client, so a slow airline holds a coroutine instead of a thread.
+ASYNC_HOST = '127.0.0.1'
+ASYNC_PORT = 5000
+# Connections kept open to the site of each airline, a connection costs no thread here
+ASYNC_LIMIT_PER_HOST = 100
+
+templates = Environment(loader=FileSystemLoader('templates'))
+# Month fetches in flight, shared by the searches asking for the same key
+inflight = {}
+# Asyncio tasks run in contexts of their own from Python 3.7. Before, the contextvars backport gives the tasks of a thread
+# one context, where the spans of concurrent requests would mix, so requests are not traced
+TRACE_ENABLED = sys.version_info >= (3, 7)
+# Failures of the site itself, counted by the breaker of the airline, a search cancelled on its deadline included
+UPSTREAM_FAILURES = (aiohttp.ClientError, asyncio.TimeoutError, asyncio.CancelledError, UpstreamError)
+
+async def fetch_page(client, request, parse, label=''):
+    # The async twin of server.fetch_page, retrying the statuses that the sessions of sessions.py retry
+    url, params, headers = request
+    try:
+        with timer(upstream_seconds, label):
+            for retry in range(RETRIES + 1):
+                if retry:
+                    await asyncio.sleep(BACKOFF_FACTOR * (2 ** (retry - 1)))
+                async with client.get(url, params=params, headers=headers,
+                                      timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as response:
+                    if response.status not in RETRY_STATUSES or retry == RETRIES:
+                        text = await response.text()
+                        break
+            if response.status in FAILURE_STATUSES:
+                raise UpstreamError(response.status, url)
+    except Exception:
+        upstream_errors.inc(label)
+        raise
+    upstream_bytes.observe(len(text), label)
+    with timer(parse_seconds, label):
+        return parse(text)
+
+async def fetch_month(client, airline, month, origin, destination, currency):
+    # Skipped while the breaker of the airline is open, as server.fetch_prices does
+    breaker = breakers[airline]
+    if not breaker.allow():
+        raise CircuitOpen('the circuit breaker of the airline is open')
+    start, num_of_days = get_month_axis(month)
+    fetch_start = time()
+    try:
+        transit = None
+        if airline == Airline.VANILLA_AIR:
+            transit = await fetch_page(client, vanilla_air_routes_request(),
+                                       lambda text: parse_vanilla_air_transit(text, origin, destination), airline.name.lower())
+        segments = [(start, start.replace(day=num_of_days))]
+        pages = await asyncio.gather(*[fetch_page(client, request, parse, airline.name.lower())
+                                       for request, parse in plan_requests(airline, segments, origin, destination, currency, transit)])
+    except UPSTREAM_FAILURES:
+        breaker.record_failure()
+        airline_fetch_seconds.observe(time() - fetch_start, airline.name.lower(), 'error')
+        raise
+    except Exception:
+        # e.g. a page of a new layout or a route without fares, which one bad route must not open the breaker with
+        breaker.release()
+        airline_fetch_seconds.observe(time() - fetch_start, airline.name.lower(), 'error')
+        raise
+    breaker.record_success(time() - fetch_start)
+    airline_fetch_seconds.observe(time() - fetch_start, airline.name.lower(), 'ok')
+    prices = new_prices(num_of_days)
+    for fares in pages:
+        fare_history.record(airline.value, origin, destination, fares)
+        fill_prices(prices, start, fares)
+    return prices
+
+async def fetch_and_store(client, key, airline, month, origin, destination, currency):
+    fare_cache.miss()
+    prices = await fetch_month(client, airline, month, origin, destination, currency)
+    await asyncio.get_event_loop().run_in_executor(None, fare_cache.store, key, prices, time())
+    return prices
+
+async def fetch_cached(client, airline, month, origin, destination, currency):
+    # The same FareCache as the threaded server, its SQLite tier read and written off the loop
+    key = (airline.value, origin, destination, month, currency)
+    cached = await asyncio.get_event_loop().run_in_executor(None, fare_cache.peek, key)
+    if cached is not None:
+        return cached
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(fetch_and_store(client, key, airline, month, origin, destination, currency))
+        task.add_done_callback(lambda _: inflight.pop(key, None))
+    # A search giving up on its deadline leaves the shared fetch running for the others
+    return await asyncio.shield(task)
+
+async def fetch_airline(client, airline, month, origin, destination, currency, start):
+    # (airline, prices, stale) of one airline, a failed or late one served from its stale cached fares
+    # or zeroed prices as in server.iter_airlines
+    success_stat = 'Succeed on getting fares of the airline with ID {0}'
+    failure_stat = 'Fail on getting fares of the airline with ID {0} - {1}'
+    deadline = min(start + breakers[airline].get_timeout(), start + FETCH_DEADLINE)
+    try:
+        prices = await asyncio.wait_for(fetch_cached(client, airline, month, origin, destination, currency),
+                                        max(deadline - time(), 0))
+    except Exception as e:
+        logger.error(failure_stat.format(airline.value, repr(e)))
+        cached = await asyncio.get_event_loop().run_in_executor(
+            None, fare_cache.peek_stale, (airline.value, origin, destination, month, currency))
+        if cached is None:
+            return airline, new_prices(get_month_axis(month)[1]), None
+        return airline, cached[0], cached[1]
+    logger.info(success_stat.format(airline.value))
+    return airline, prices, None
+
+def iter_fares(client, month, origin, destination, airlines, currency):
+    # Every requested airline at the same time, as awaitables of (airline, prices, stale) in the order they arrive
+    start = time()
+    return asyncio.as_completed([fetch_airline(client, airline, month, origin, destination, currency, start)
+                                 for airline in Airline if airline.value in airlines])
+
+async def get_fares(client, month, origin, destination, airlines, currency):
+    fares = FareMatrix(*get_month_axis(month))
+    for row in iter_fares(client, month, origin, destination, airlines, currency):
+        fares.add(*(await row))
+    return merge_fares(fares)
+
+def record_searches(from_id, to_id, month, airlines):
+    # Keep the searches for prewarm.py to find the popular ones, run off the loop
+    conn = sqlite3.connect(DB_LCC_PATH)
+    try:
+        conn.executemany('''INSERT INTO SearchHistory (FromAirportId, ToAirportId, Month, AirlineId, SearchedAt)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         [(from_id, to_id, month, id_, time()) for id_ in airlines])
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error('Fail on saving the search history - {0}'.format(repr(e)))
+    finally:
+        conn.close()
+
+async def get_route_codes(db, from_id, to_id):
+    codes = await db.fetchone('''SELECT fap.Code, tap.Code, c.Currency FROM Airport fap, Airport tap
+                                 JOIN Country c ON fap.CountryId = c.Id
+                                 WHERE fap.Id = ? AND tap.Id = ?''', (from_id, to_id))
+    currency = codes[2] if codes[2] is not None else 'TWD'
+    return codes[0], codes[1], currency
+
+async def load_catalog():
+    # The catalog checks its version in the database now and then, which is kept off the loop
+    return await asyncio.get_event_loop().run_in_executor(None, get_catalog, DB_LCC_PATH)
+
+async def index(request):
+    html = templates.get_template('index.html').render(url_for=lambda endpoint, filename: '/static/' + filename)
+    return web.Response(text=html, content_type='text/html')
+
+async def get_catalog_response(request, catalog, body):
+    # The catalog responses of service.get_catalog_response: revalidated on every use, a 304 without a body
+    # until get_routes bumps the catalog version, and compressed once at the highest level
+    etag = 'catalog-{0}'.format(catalog.version)
+    last_modified = int(catalog.updated_at)
+    if request.if_none_match:
+        not_modified = any(tag.value in (etag, '*') for tag in request.if_none_match)
+    else:
+        since = request.if_modified_since
+        not_modified = since is not None and since.timestamp() >= last_modified
+    if not_modified:
+        response = web.Response(status=304)
+    else:
+        encoding = choose_encoding(parse_accept_encodings(request.headers.get('Accept-Encoding', '')), len(body))
+        if encoding is not None:
+            data = await asyncio.get_event_loop().run_in_executor(None, catalog.get_compressed, body, encoding)
+            response = web.Response(body=data, content_type='application/json')
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = web.Response(text=body, content_type='application/json')
+    response.headers['ETag'] = 'W/"{0}"'.format(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+async def get_values(request):
+    # From the query string of GET requests or the form of POST ones, as request.values of Flask
+    if request.method == 'POST':
+        return await request.post()
+    return request.query
+
+async def get_airport_codes(request):
+    form = await get_values(request)
+    if 'id' not in form:
+        logger.error('missing the parameter - id')
+        raise web.HTTPNotFound()
+
+    # If id is 'ALL', showing all airports, otherwise showing the corresponding destination airports
+    catalog = await load_catalog()
+    return await get_catalog_response(request, catalog, catalog.get_airport_codes(form['id']))
+
+async def get_airlines(request):
+    form = await get_values(request)
+    if not all(param in form for param in ['fromId', 'toId']):
+        logger.error('missing one or more following parameters - fromId, toId')
+        raise web.HTTPNotFound()
+
+    catalog = await load_catalog()
+    return await get_catalog_response(request, catalog, catalog.get_airlines(form['fromId'], form['toId']))
+
+async def get_search_params(request):
+    form = await request.post()
+    if not all(param in form for param in ['fromId', 'toId', 'month', 'airlines']):
+        logger.error('missing one or more following parameters - fromId, toId, month, airlines')
+        raise web.HTTPNotFound()
+
+    origin, destination, currency = await get_route_codes(request.app['db'], form['fromId'], form['toId'])
+    airlines = [int(id_) for id_ in form['airlines'].split(',')]
+    asyncio.get_event_loop().run_in_executor(None, record_searches, form['fromId'], form['toId'], form['month'], airlines)
+    return form['month'], origin, destination, airlines, currency
+
+async def get_data(request):
+    params = await get_search_params(request)
+    data = get_visualized_data(await get_fares(request.app['client'], *params))
+    data['currency'] = params[4]
+    return web.Response(text=json.dumps(data), content_type='text/html')
+
+async def stream_data(request):
+    # Newline-delimited JSON, one line for each airline as soon as its fares arrive, then one line for the table,
+    # the same lines as /data/stream of service.py
+    params = await get_search_params(request)
+    response = web.StreamResponse()
+    response.content_type = 'application/x-ndjson'
+    await response.prepare(request)
+    fares = FareMatrix(*get_month_axis(params[0]))
+    for row in iter_fares(request.app['client'], *params):
+        airline, prices, stale = await row
+        fares.add(airline, prices, stale)
+        await response.write((json.dumps({
+            'airline': airline.value,
+            'currency': params[4],
+            'line': get_line_spec(fares),
+            'stale': stale
+        }) + '\n').encode('utf-8'))
+    # The table lists the airlines in the same order as /data does
+    fares = merge_fares(fares)
+    await response.write((json.dumps({
+        'currency': params[4],
+        'line': get_line_spec(fares),
+        'table': get_table(fares),
+        'stale': get_stale(fares)
+    }) + '\n').encode('utf-8'))
+    await response.write_eof()
+    return response
+
+async def get_status(request):
+    return web.Response(text=json.dumps({
+        'airlines': {airline.name: breakers[airline].stats() for airline in Airline},
+        'cache': get_cache_stats(),
+        'history': fare_history.stats()
+    }), content_type='text/html')
+
+async def get_metrics(request):
+    return web.Response(text=render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+@web.middleware
+async def measure_request(request, handler):
+    # Time every request like service.py does, the trace living in the context of the task of the request
+    start = perf_counter()
+    start_trace(TRACE_ENABLED and TRACE_HEADER in request.headers)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        request_seconds.observe(perf_counter() - start, resource.canonical if resource is not None else 'unmatched', status)
+    spans = stop_trace()
+    # The headers of a streamed response are sent before its body
+    if spans and not response.prepared:
+        response.headers['Server-Timing'] = format_server_timing(spans)
+    return response
+
+async def start_clients(app):
+    app['client'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, limit_per_host=ASYNC_LIMIT_PER_HOST),
+        headers={'Accept-Encoding': 'gzip, deflate'})
+    app['db'] = ReadOnlyDatabase(DB_LCC_PATH)
+
+async def close_clients(app):
+    await app['client'].close()
+    app['db'].close()
+
+def create_app():
+    app = web.Application(middlewares=[measure_request])
+    app.router.add_get('/', index)
+    app.router.add_get('/airport_codes', get_airport_codes)
+    app.router.add_post('/airport_codes', get_airport_codes)
+    app.router.add_get('/airlines', get_airlines)
+    app.router.add_post('/airlines', get_airlines)
+    app.router.add_post('/data', get_data)
+    app.router.add_post('/data/stream', stream_data)
+    app.router.add_get('/status', get_status)
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_static('/static', 'static')
+    app.on_startup.append(start_clients)
+    app.on_cleanup.append(close_clients)
+    return app
+
+if __name__ == '__main__':
+    # Bring the schema up to date before serving any request
+    migrate(DB_LCC_PATH)
+    migrate(HISTORY_DB_PATH, HISTORY_MIGRATIONS)
+    get_catalog(DB_LCC_PATH)
+    # Pre-warming keeps running in threads of its own, next to the loop
+    Prewarmer(DB_LCC_PATH).start()
+    web.run_app(create_app(), host=ASYNC_HOST, port=ASYNC_PORT)
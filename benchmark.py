@@ -0,0 +1,1085 @@
+import argparse
+import datetime as dt
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import socketserver
+import sqlite3
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import perf_counter, process_time, time, sleep
+from urllib.parse import urlsplit, parse_qsl
+
+import loadtest
+import replay
+
+# Repeatable benchmarks of the fare and route pipelines, run against the fixtures of replay.py.
+# Each run is kept as JSON in BENCHMARK_RESULTS_DIR, and two runs are compared with the compare command
+BENCHMARK_RESULTS_DIR = 'benchmark_results'
+BENCHMARK_PORT = 8905
+# Overhead of the metrics of metrics.py on the hot path of a cached search, get_fares and
+# get_visualized_data, allowed as a share of its time with the metrics switched off
+METRICS_OVERHEAD_BUDGET = 0.03
+HTTPS_STUB_PORT = 8908
+ENRICHMENT_PORT = 8911
+# Days of the month of the itinerary searches made without any fare, as the past days of the current month are
+ITINERARY_GAP_DAYS = (1, 2)
+
+def time_calls(fn, iterations):
+    start = perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (perf_counter() - start) / iterations
+
+def get_percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000,
+        'max_ms': latencies[-1] * 1000
+    }
+
+def load_search(fixtures):
+    with open(os.path.join(fixtures, 'search.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+def start_replay(fixtures, latency):
+    process = multiprocessing.Process(target=replay.run_replay, args=(fixtures, latency), daemon=True)
+    process.start()
+    loadtest.wait_for_port(replay.REPLAY_PORT, replay.REPLAY_HOST)
+    return process
+
+def get_replay_counts():
+    import requests
+    return requests.get('http://{0}:{1}/_replay/counts'.format(replay.REPLAY_HOST, replay.REPLAY_PORT)).json()
+
+def run_service(directory):
+    # service.py with the fare cache switched off as in loadtest.py, fetching from the replay server
+    import server
+    replay.point_at_replay()
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 0
+    server.fare_cache.db_path = None
+    server.fare_history.db_path = os.path.join(directory, 'history.db')
+    from werkzeug.serving import make_server
+    from service import app
+    make_server('127.0.0.1', BENCHMARK_PORT, app, threaded=True).serve_forever()
+
+def bench_data(fixtures, latency, iterations):
+    # End-to-end latency of /data, one search at a time, every search fetching all its pages from the replay server
+    import requests
+    search = load_search(fixtures)
+    conn = sqlite3.connect('lcc.db')
+    ids = dict(conn.execute('SELECT Code, Id FROM Airport WHERE Code IN (?, ?)', (search['origin'], search['destination'])))
+    conn.close()
+    form = {
+        'fromId': ids[search['origin']],
+        'toId': ids[search['destination']],
+        'month': search['month'],
+        'airlines': '1,2,5'
+    }
+    replay_process = start_replay(fixtures, latency)
+    service = multiprocessing.Process(target=run_service, args=(tempfile.mkdtemp(), ), daemon=True)
+    service.start()
+    try:
+        loadtest.wait_for_port(BENCHMARK_PORT)
+        url = 'http://127.0.0.1:{0}/data'.format(BENCHMARK_PORT)
+        # One search first, so that imports and connections are not timed
+        requests.post(url, data=form).raise_for_status()
+        latencies = []
+        for _ in range(iterations):
+            start = perf_counter()
+            requests.post(url, data=form).raise_for_status()
+            latencies.append(perf_counter() - start)
+        result = get_percentiles(latencies)
+        result['replayed'] = get_replay_counts()
+        return result
+    finally:
+        service.terminate()
+        replay_process.terminate()
+
+def bench_routes(fixtures, latency, rounds):
+    # Duration of a full route refresh, then of incremental ones over unchanged sources, on a copy of lcc.db
+    replay_process = start_replay(fixtures, latency)
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    shutil.copy('lcc.db', directory)
+    # Run from the copy, so that the pages of enrichment.py are cached there too
+    os.chdir(directory)
+    try:
+        replay.point_at_replay()
+        import routes
+        start = perf_counter()
+        changes = routes.get_routes(full=True)
+        full = perf_counter() - start
+        incremental = []
+        for _ in range(rounds):
+            start = perf_counter()
+            routes.get_routes()
+            incremental.append(perf_counter() - start)
+        return {
+            'full_ms': full * 1000,
+            'incremental': get_percentiles(incremental),
+            'airlines': {airline.name.lower(): change for airline, change in changes.items()},
+            'replayed': get_replay_counts()
+        }
+    finally:
+        os.chdir(cwd)
+        replay_process.terminate()
+
+def upsert_routes_by_row(c, airline, pairs):
+    # The statements get_routes ran for every route before apply_routes, kept here as the baseline
+    c.execute('UPDATE Route SET IsActive = 0 WHERE AirlineId = ?', (airline.value, ))
+    for origin, destination in pairs:
+        for code in (origin, destination):
+            c.execute('SELECT Id FROM Airport WHERE Code = ?', (code, ))
+            if c.fetchone() is None:
+                c.execute('INSERT INTO Airport (Code) VALUES (?)', (code, ))
+        c.execute('''SELECT r.Id FROM Route r
+                     JOIN Airport fap ON r.FromAirportId = fap.Id
+                     JOIN Airport tap ON r.ToAirportId = tap.Id
+                     WHERE r.AirlineId = ? and fap.Code = ? and tap.Code = ?''',
+                  (airline.value, origin, destination))
+        if c.fetchone() is None:
+            c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
+                         SELECT ?, fap.Id, tap.Id, 1 FROM Airport fap, Airport tap
+                         WHERE fap.Code = ? and tap.Code = ?''',
+                      (airline.value, origin, destination))
+        else:
+            c.execute('''UPDATE Route SET IsActive = 1
+                         WHERE AirlineId = ?
+                         AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
+                         AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
+                      (airline.value, origin, destination))
+
+def get_route_pairs(db_path, scale, seed):
+    # The active routes of lcc.db as {airline: {(origin, destination), ...}}, with scale - 1 made-up routes
+    # added for each of them between made-up airports
+    from server import Airline
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''SELECT r.AirlineId, fap.Code, tap.Code FROM Route r
+                           JOIN Airport fap ON r.FromAirportId = fap.Id
+                           JOIN Airport tap ON r.ToAirportId = tap.Id
+                           WHERE r.IsActive = 1''').fetchall()
+    conn.close()
+    pairs = {}
+    for airline_id, origin, destination in rows:
+        pairs.setdefault(Airline(airline_id), set()).add((origin, destination))
+    rng = random.Random(seed)
+    airports = int((len(rows) * scale) ** 0.5) + 1
+    for airline, airline_pairs in pairs.items():
+        target = len(airline_pairs) * scale
+        while len(airline_pairs) < target:
+            origin, destination = rng.sample(range(airports), 2)
+            airline_pairs.add(('Z{0:05d}'.format(origin), 'Z{0:05d}'.format(destination)))
+    return pairs
+
+def time_ingest(db_path, apply, pairs):
+    # Seconds to apply the routes of every airline, each in its own transaction as get_routes does
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    start = perf_counter()
+    for airline, airline_pairs in pairs.items():
+        apply(c, airline, airline_pairs)
+        conn.commit()
+    elapsed = perf_counter() - start
+    conn.close()
+    return elapsed
+
+def bench_ingest(scales, seed):
+    # Route refresh time of the row-by-row upserts and of the set-based apply_routes and apply_route_diff,
+    # on copies of lcc.db: a first ingest that adds the made-up routes, then a refresh of the same routes
+    from migrations import migrate
+    from routes import apply_routes, apply_route_diff
+    methods = {
+        'by_row': upsert_routes_by_row,
+        'apply_routes': apply_routes,
+        'apply_route_diff': apply_route_diff
+    }
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        for scale in scales:
+            source = os.path.join(directory, 'lcc.db')
+            shutil.copy('lcc.db', source)
+            migrate(source)
+            pairs = get_route_pairs(source, scale, seed)
+            result = results['x{0}'.format(scale)] = {'routes': sum(len(airline_pairs) for airline_pairs in pairs.values())}
+            for name, apply in methods.items():
+                db_path = os.path.join(directory, name + '.db')
+                shutil.copy(source, db_path)
+                result[name] = {
+                    'first_ms': time_ingest(db_path, apply, pairs) * 1000,
+                    'refresh_ms': time_ingest(db_path, apply, pairs) * 1000
+                }
+                conn = sqlite3.connect(db_path)
+                result[name]['active_routes'] = conn.execute('SELECT COUNT(*) FROM Route WHERE IsActive = 1').fetchone()[0]
+                conn.close()
+            # Every method leaves the same routes active
+            assert len(set(result[name]['active_routes'] for name in methods)) == 1, result
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def query_airport_codes(db_path, id_):
+    # /airport_codes as service.py answered it before catalog.py, a connection and a join for every request
+    from catalog import group_by_country
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    if id_ == 'ALL':
+        c.execute('''SELECT a.Id, a.Code, a.Name, IFNULL(c.Name, "Other") CountryName FROM Airport a
+                     LEFT JOIN Country c ON a.CountryId = c.Id''')
+    else:
+        c.execute('''SELECT DISTINCT a.Id, a.Code, a.Name, IFNULL(c.Name, "Other") CountryName FROM Route r
+                     JOIN Airport a ON r.ToAirportId = a.Id
+                     JOIN Country c ON a.CountryId = c.Id
+                     WHERE r.FromAirportId = ? AND r.IsActive = 1''', (id_, ))
+    body = json.dumps(group_by_country(c.fetchall()))
+    conn.close()
+    return body
+
+def query_airlines(db_path, from_id, to_id):
+    # /airlines as service.py answered it before catalog.py
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    c.execute('''SELECT a.Id, a.Name FROM Airline a
+                 JOIN Route r ON a.Id = r.AirlineId
+                 WHERE r.FromAirportId = ? AND r.ToAirportId = ? AND r.IsActive = 1''', (from_id, to_id))
+    body = json.dumps([{'id': d[0], 'name': d[1]} for d in c.fetchall()])
+    conn.close()
+    return body
+
+def normalize_airport_codes(body):
+    # The same options whatever order the query returned the airports of a country in
+    return [(group['text'], sorted((child['id'], child['text']) for child in group['children'])) for group in json.loads(body)]
+
+def bench_catalog(requests_count, seed):
+    # Throughput of /airport_codes and /airlines answered from SQLite for every request and from the in-memory
+    # catalog, on the same random requests over the active routes of a migrated copy of lcc.db
+    from catalog import Catalog, get_version
+    from migrations import migrate
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'lcc.db')
+    shutil.copy('lcc.db', db_path)
+    migrate(db_path)
+    conn = sqlite3.connect(db_path)
+    routes = conn.execute('SELECT DISTINCT FromAirportId, ToAirportId FROM Route WHERE IsActive = 1 ORDER BY 1, 2').fetchall()
+    start = perf_counter()
+    catalog = Catalog(conn, get_version(conn))
+    build = perf_counter() - start
+    conn.close()
+
+    rng = random.Random(seed)
+    chosen = [rng.choice(routes) for _ in range(requests_count)]
+    ids = ['ALL'] + [str(from_id) for from_id, to_id in chosen]
+    pairs = [(str(from_id), str(to_id)) for from_id, to_id in chosen]
+    for id_ in sorted(set(ids)):
+        assert normalize_airport_codes(query_airport_codes(db_path, id_)) == normalize_airport_codes(catalog.get_airport_codes(id_)), id_
+    for from_id, to_id in sorted(set(pairs)):
+        assert json.loads(query_airlines(db_path, from_id, to_id)) == json.loads(catalog.get_airlines(from_id, to_id))
+
+    paths = {
+        'airport_codes': (lambda: [query_airport_codes(db_path, id_) for id_ in ids],
+                          lambda: [catalog.get_airport_codes(id_) for id_ in ids], len(ids)),
+        'airlines': (lambda: [query_airlines(db_path, from_id, to_id) for from_id, to_id in pairs],
+                     lambda: [catalog.get_airlines(from_id, to_id) for from_id, to_id in pairs], len(pairs))
+    }
+    results = {'build_ms': build * 1000, 'routes': len(routes)}
+    for name, (sqlite_path, catalog_path, count) in paths.items():
+        sqlite_seconds = time_calls(sqlite_path, 1)
+        catalog_seconds = time_calls(catalog_path, 5)
+        results[name] = {
+            'sqlite_per_second': count / sqlite_seconds,
+            'catalog_per_second': count / catalog_seconds,
+            'speedup': sqlite_seconds / catalog_seconds
+        }
+    shutil.rmtree(directory)
+    return results
+
+def render_with_pandas(fares):
+    # get_visualized_data as it was before the templates, on the list of {'Airline', 'Date', 'Price'} it took then
+    import pandas as pd
+    import altair as alt
+    import plotly.offline as offline
+    import plotly.graph_objs as go
+    data = pd.DataFrame(fares)
+    chart = alt.Chart(data).mark_line().encode(
+        color='Airline:N',
+        x='Date:O',
+        y='Price:Q'
+    )
+    trace = go.Table(
+        header={
+            'values': list(data.columns),
+            'fill': {
+                'color': '#a1c3d1'
+            },
+            'align': ['center']
+        },
+        cells={
+            'values': [data.Airline, data.Date, data.Price],
+            'fill': {
+                'color': '#EDFAFF'
+            },
+            'align': ['center']
+        })
+    return {
+        'line': chart.to_json(),
+        'table': offline.plot({'data': [trace]}, include_plotlyjs=False, output_type='div').replace('"', '\'')
+    }
+
+def run_render(path, months, iterations, queue):
+    # Run in a process of its own, so that the RSS is the one of a single render path and of what it imports
+    import resource
+    import server
+    from fares import FareMatrix, get_month_axis, new_prices
+    rng = random.Random(0)
+    inputs = []
+    for idx in range(months):
+        start, num_of_days = get_month_axis('2030-{0:02d}'.format(idx % 12 + 1))
+        fares = FareMatrix(start, num_of_days)
+        for airline in (server.Airline.TIGERAIR_TAIWAN, server.Airline.VANILLA_AIR, server.Airline.JETSTAR):
+            prices = fares.add(airline, new_prices(num_of_days))
+            for day in range(num_of_days):
+                prices[day] = rng.randint(0, 40) * 250
+        if path == 'pandas':
+            fares = [{'Airline': server.AIRLINE_NAMES[airline], 'Date': date, 'Price': price}
+                     for airline, prices in fares.rows.items() for date, price in zip(fares.get_dates(), prices)]
+        inputs.append(fares)
+    render = render_with_pandas if path == 'pandas' else server.get_visualized_data
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    try:
+        # The first render imports what the path needs
+        render(inputs[0])
+    except ImportError as e:
+        queue.put({'skipped': repr(e)})
+        return
+    first = perf_counter() - start
+    cpu_start = process_time()
+    start = perf_counter()
+    for _ in range(iterations):
+        for fares in inputs:
+            render(fares)
+    renders = iterations * len(inputs)
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        'first_ms': first * 1000,
+        'cpu_ms': (process_time() - cpu_start) / renders * 1000,
+        'wall_ms': (perf_counter() - start) / renders * 1000,
+        # ru_maxrss is in KB on Linux
+        'rss_mb': rss_end / 1024,
+        'rss_added_mb': (rss_end - rss_start) / 1024
+    })
+
+def bench_render(months, iterations):
+    # Per-request CPU time and RSS of rendering the chart spec and the table of three airlines over a month,
+    # with the templates of server.py and with pandas, altair and plotly as before when they are installed
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for path in ('templates', 'pandas'):
+        queue = context.Queue()
+        process = context.Process(target=run_render, args=(path, months, iterations, queue))
+        process.start()
+        results[path] = queue.get()
+        process.join()
+    if 'skipped' not in results['pandas']:
+        results['cpu_speedup'] = results['pandas']['cpu_ms'] / results['templates']['cpu_ms']
+    return results
+
+def enrich_metadata_by_page(c):
+    # The lookups get_routes made before enrichment.py, kept here as the baseline: the airport pages downloaded and
+    # parsed again for every capital, the currency list for every country, and every airport looked up on each run
+    import enrichment
+    from bs4 import BeautifulSoup
+    from hanziconv import HanziConv
+    from sessions import http_get
+    capital = None
+    c.execute('SELECT Code FROM Airport ORDER BY Code')
+    for row in c.fetchall():
+        try:
+            if row[0][0] != capital:
+                capital = row[0][0]
+                table = BeautifulSoup(http_get(enrichment.EN_AIRPORTS_URL.format(capital)).text,
+                                      'html.parser').find('table', class_='wikitable sortable')
+            tds = table.find(string=row[0]).find_parent('tr').find_all('td')
+            airport_name = re.split(r'[\[\(\d]', tds[2].text)[0].strip()
+            country_name = re.sub(r'\d', '', tds[3].text.split(',')[-1]).strip()
+            c.execute('INSERT OR IGNORE INTO Country (Name) VALUES (?)', (country_name, ))
+            c.execute('UPDATE Airport SET Name = ?, CountryId = (SELECT Id FROM Country WHERE Name = ?) WHERE Code = ?',
+                      (airport_name, country_name, row[0]))
+        except Exception:
+            pass
+    capital = None
+    c.execute('SELECT Code FROM Airport ORDER BY Code')
+    for row in c.fetchall():
+        try:
+            if row[0][0] != capital:
+                capital = row[0][0]
+                table = BeautifulSoup(http_get(enrichment.ZH_AIRPORTS_URL.format(capital)).text,
+                                      'html.parser').select('table.wikitable.sortable')[0]
+            tds = table.find(string=row[0]).find_parent('tr').find_all('td')
+            start_idx = 1 if capital in enrichment.ZH_SHIFTED_CAPITALS else 2
+            airport_name = tds[start_idx].text.split('（')[0].strip()
+            country_name = tds[start_idx + 2].text.strip()
+            c.execute('UPDATE Country SET NameZhTW = ? WHERE Id = (SELECT CountryId FROM Airport WHERE Code = ?)',
+                      (HanziConv.toTraditional(country_name), row[0]))
+            if re.search(r'[A-Za-z]', airport_name) is None:
+                c.execute('UPDATE Airport SET NameZhTW = ? WHERE Code = ?',
+                          (HanziConv.toTraditional(airport_name), row[0]))
+        except Exception:
+            pass
+    c.execute('SELECT Name FROM Country')
+    for row in c.fetchall():
+        try:
+            tds = BeautifulSoup(http_get(enrichment.CURRENCIES_URL).text, 'html.parser').find(
+                'table', class_='wikitable sortable').find(string=row[0]).find_parent('tr').find_all('td')
+            c.execute('UPDATE Country SET Currency = ? WHERE Name = ?', (tds[3].text.strip(), row[0]))
+        except Exception:
+            pass
+
+def get_metadata_pages(db_path):
+    # Local stand-ins of the Wikipedia pages, listing the metadata lcc.db holds: airports without a Chinese name and
+    # countries without a currency are left out of them as the lookups Wikipedia has no answer for
+    import enrichment
+    conn = sqlite3.connect(db_path)
+    airports = conn.execute('''SELECT a.Code, a.Name, a.NameZhTW, c.Name, c.NameZhTW FROM Airport a
+                               JOIN Country c ON a.CountryId = c.Id
+                               WHERE a.Name IS NOT NULL ORDER BY a.Code''').fetchall()
+    currencies = conn.execute('SELECT Name, Currency FROM Country WHERE Currency IS NOT NULL').fetchall()
+    conn.close()
+    table = '<html><body><table class="wikitable sortable"><tr><th>{0}</th></tr>{1}</table></body></html>'
+    row = '<tr>' + '<td>{}</td>' * 5 + '</tr>'
+    en_rows = {}
+    zh_rows = {}
+    for code, name, name_zh, country, country_zh in airports:
+        en_rows.setdefault(code[0], []).append(row.format(code, 'X' + code, name, 'City, ' + country, ''))
+        zh_rows.setdefault(code[0], [])
+        if name_zh is not None:
+            cells = [code, name_zh, '', country_zh, ''] if code[0] in enrichment.ZH_SHIFTED_CAPITALS else \
+                [code, 'X' + code, name_zh, '', country_zh]
+            zh_rows.setdefault(code[0], []).append(row.format(*cells))
+    pages = {'/currencies': table.format('Country', ''.join(row.format(country, 'Currency', '$', currency, '')
+                                                              for country, currency in currencies))}
+    for capital, rows in en_rows.items():
+        pages['/en/' + capital] = table.format('IATA', ''.join(rows))
+    for capital, rows in zh_rows.items():
+        pages['/zh/' + capital] = table.format('IATA', ''.join(rows))
+    return pages
+
+class MetadataPageHandler(BaseHTTPRequestHandler):
+    # The pages of get_metadata_pages with an ETag, each request counted and answered 304 when the ETag matches
+    def do_GET(self):
+        self.server.requests += 1
+        body = self.server.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = '"{0}"'.format(hashlib.sha1(body.encode('utf-8')).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetadataPageServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def get_metadata(db_path):
+    conn = sqlite3.connect(db_path)
+    metadata = (conn.execute('SELECT Code, Name, NameZhTW, CountryId FROM Airport ORDER BY Code').fetchall(),
+                conn.execute('SELECT Name, NameZhTW, Currency FROM Country ORDER BY Name').fetchall())
+    conn.close()
+    return metadata
+
+def time_enrichment(db_path, enrich, server):
+    # Milliseconds, requests and 304 answers of one metadata phase, committed as get_routes does
+    requests_count, not_modified = server.requests, server.not_modified
+    conn = sqlite3.connect(db_path)
+    start = perf_counter()
+    result = enrich(conn.cursor()) or {}
+    conn.commit()
+    result['ms'] = (perf_counter() - start) * 1000
+    conn.close()
+    result['requests'] = server.requests - requests_count
+    result['not_modified'] = server.not_modified - not_modified
+    return result
+
+def bench_enrichment():
+    # Requests and parses of the metadata phase of get_routes against local copies of the Wikipedia pages, on a
+    # migrated copy of lcc.db with its metadata cleared: the former lookups, then enrichment.py on a cold page cache,
+    # on the next run, and once the cached pages and the metadata are due again
+    import enrichment
+    from migrations import migrate
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'lcc.db')
+    shutil.copy('lcc.db', source)
+    migrate(source)
+    server = MetadataPageServer(('127.0.0.1', ENRICHMENT_PORT), MetadataPageHandler)
+    server.pages = get_metadata_pages(source)
+    server.requests = 0
+    server.not_modified = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{0}'.format(ENRICHMENT_PORT)
+    enrichment.EN_AIRPORTS_URL = base_url + '/en/{0}'
+    enrichment.ZH_AIRPORTS_URL = base_url + '/zh/{0}'
+    enrichment.CURRENCIES_URL = base_url + '/currencies'
+    conn = sqlite3.connect(source)
+    conn.execute('UPDATE Airport SET Name = NULL, NameZhTW = NULL, CountryId = NULL, MetadataUpdatedAt = NULL')
+    conn.execute('UPDATE Country SET NameZhTW = NULL, Currency = NULL, MetadataUpdatedAt = NULL')
+    conn.commit()
+    conn.close()
+    fresh, max_age = enrichment.PAGE_CACHE_FRESH, enrichment.METADATA_MAX_AGE
+    results = {'pages': len(server.pages)}
+    try:
+        db_path = os.path.join(directory, 'by_page.db')
+        shutil.copy(source, db_path)
+        results['by_page'] = time_enrichment(db_path, enrich_metadata_by_page, server)
+        expected = get_metadata(db_path)
+
+        db_path = os.path.join(directory, 'page_cache.db')
+        shutil.copy(source, db_path)
+        cache_dir = os.path.join(directory, 'page_cache')
+        runs = [('cold', fresh, max_age), ('next_run', fresh, max_age), ('revalidated', 0, 0)]
+        for run, enrichment.PAGE_CACHE_FRESH, enrichment.METADATA_MAX_AGE in runs:
+            page_cache = enrichment.PageCache(cache_dir)
+            results[run] = time_enrichment(db_path, lambda c: enrichment.enrich_metadata(c, page_cache), server)
+            # The same metadata as the former lookups, whatever pages the run fetched
+            assert get_metadata(db_path) == expected, run
+    finally:
+        enrichment.PAGE_CACHE_FRESH, enrichment.METADATA_MAX_AGE = fresh, max_age
+        server.shutdown()
+        shutil.rmtree(directory)
+    # Airports and countries the pages do not list are stamped too, so the next run looks up nothing
+    assert results['next_run']['airports'] == results['next_run']['countries'] == results['next_run']['requests'] == 0
+    assert results['revalidated']['not_modified'] == results['revalidated']['requests'] == results['cold']['requests']
+    # Only the cold run writes names, countries and currencies, which get_routes bumps the catalog version for
+    assert results['cold']['changed'] > 0 and results['next_run']['changed'] == results['revalidated']['changed'] == 0
+    results['request_reduction'] = results['by_page']['requests'] / results['cold']['requests']
+    return results
+
+def count_stub_requests():
+    from rangetest import get_counts
+    return sum(get_counts().values())
+
+def get_itinerary_paths(itineraries):
+    return [tuple([itinerary['legs'][0]['from']] + [leg['to'] for leg in itinerary['legs']]) for itinerary in itineraries]
+
+def bench_itineraries(pairs_count, searches, month, seed):
+    # The connecting itinerary search on the route graph of a migrated copy of lcc.db: the time to build the
+    # reachability index and to list the candidates of random pairs, then searches against the request-counting stubs
+    # of loadtest.py, once with nothing cached and once with the legs in the fare cache. The stub draws the fares into
+    # each airport from a lowest fare of its own, so that legs differ in price as distances make them
+    import requests
+    import itinerary
+    from catalog import get_catalog
+    from migrations import migrate
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'lcc.db')
+    shutil.copy('lcc.db', db_path)
+    migrate(db_path)
+    catalog = get_catalog(db_path)
+    start = perf_counter()
+    index = itinerary.ReachabilityIndex(catalog)
+    results = {'edges': sum(len(edges) for edges in catalog.edges.values()), 'index_ms': (perf_counter() - start) * 1000}
+    rng = random.Random(seed)
+    airports = sorted(index.outbound)
+    pairs = [tuple(rng.sample(airports, 2)) for _ in range(pairs_count)]
+    start = perf_counter()
+    counts = [len(index.get_candidates(from_id, to_id)) for from_id, to_id in pairs]
+    results['candidates'] = {
+        'pairs': pairs_count,
+        'total_ms': (perf_counter() - start) * 1000,
+        'max': max(counts),
+        'mean': sum(counts) / len(counts)
+    }
+
+    stub = multiprocessing.Process(target=loadtest.run_stub, args=(0.01, ), daemon=True)
+    stub.start()
+    loadtest.wait_for_port(loadtest.STUB_PORT, loadtest.STUB_HOSTS['tigerair'])
+    loadtest.configure(directory)
+    lowest = {catalog.airports[id_][1]: rng.randrange(1000, 20000, 100) for id_ in airports}
+    requests.post('http://{0}:{1}/fares'.format(loadtest.STUB_HOSTS['tigerair'], loadtest.STUB_PORT),
+                  data=lowest).raise_for_status()
+    import server
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 3600
+    itinerary.index = index
+    num_of_days = server.get_month_axis(month)[1]
+    # Pairs with more candidates flown by the airlines with a fetcher than the former cap of 60 kept
+    fetchable = set(airline.value for airline in (server.Airline.TIGERAIR_TAIWAN, server.Airline.VANILLA_AIR,
+                                                  server.Airline.JETSTAR))
+
+    def is_fetchable(path):
+        return all(fetchable.intersection(index.airlines[leg]) for leg in zip(path, path[1:]))
+    connected = [pair for pair in pairs if sum(1 for path in index.get_candidates(*pair) if is_fetchable(path)) > 60]
+    gaps_url = 'http://{0}:{1}/gaps'.format(loadtest.STUB_HOSTS['tigerair'], loadtest.STUB_PORT)
+    gap_days = ['{0}-{1:02}'.format(month, day) for day in ITINERARY_GAP_DAYS]
+
+    def run_search(run, from_id, to_id, max_fetches):
+        requests_count = count_stub_requests()
+        stats = server.fare_cache.stats()
+        start = perf_counter()
+        data = itinerary.search_itineraries(catalog, from_id, to_id, month, 'TWD', max_fetches=max_fetches)
+        elapsed = perf_counter() - start
+        after = server.fare_cache.stats()
+        return data, {
+            'ms': elapsed * 1000,
+            'candidates': data['candidates'],
+            'pruned': data['pruned'],
+            'unexplored': data['unexplored'],
+            'fetched_legs': data['fetchedLegs'],
+            'upstream_legs': data['upstreamLegs'],
+            'complete': data['complete'],
+            'days': len(data['itineraries']),
+            'upstream_requests': count_stub_requests() - requests_count,
+            'cache_hits': after['hits'] - stats['hits'],
+            'cache_misses': after['misses'] - stats['misses']
+        }
+
+    results['searches'] = []
+    try:
+        for from_id, to_id in connected[:searches]:
+            search = {'pair': '{0}-{1}'.format(catalog.airports[from_id][1], catalog.airports[to_id][1])}
+            prices = {}
+            # Exact searches without a budget, cold then with the legs in the fare cache
+            server.fare_cache.entries.clear()
+            for run in ('cold', 'cached'):
+                data, search[run] = run_search(run, from_id, to_id, float('inf'))
+                prices[run] = [itinerary_['price'] for itinerary_ in data['itineraries']]
+            # The former cap kept the 60 candidates with the fewest stops
+            capped = set(tuple(catalog.airports[id_][1] for id_ in path)
+                         for path in sorted(index.get_candidates(from_id, to_id), key=len)[:60])
+            itineraries = data['itineraries']
+            search['two_stops'] = sum(1 for itinerary_ in itineraries if itinerary_['stops'] == 2)
+            search['beyond_former_cap'] = sum(1 for path in get_itinerary_paths(itineraries) if path not in capped)
+            search['past_month_end'] = sum(1 for itinerary_ in itineraries if itinerary_['legs'][-1]['date'][:7] != month)
+            # The budget of the endpoint on a cold cache, and days of the month without any fare
+            server.fare_cache.entries.clear()
+            data, search['budgeted'] = run_search('budgeted', from_id, to_id, itinerary.ITINERARY_MAX_FETCHES)
+            search['budgeted']['worse_days'] = sum(1 for price, exact in zip(
+                [itinerary_['price'] for itinerary_ in data['itineraries']], prices['cold']) if price > exact)
+            server.fare_cache.entries.clear()
+            requests.post(gaps_url, data={date: '1' for date in gap_days}).raise_for_status()
+            try:
+                data, search['gaps'] = run_search('gaps', from_id, to_id, float('inf'))
+            finally:
+                requests.post(gaps_url, data={}).raise_for_status()
+            results['searches'].append(search)
+            print(search)
+            # Every day is served, those on the last days too, and the bounds of the cached fares prune more candidates
+            # without changing any price, as no candidate is dropped before its bound rules it out
+            assert search['cold']['days'] == search['cached']['days'] == num_of_days, search
+            assert prices['cold'] == prices['cached'], search
+            assert search['cached']['fetched_legs'] < search['cold']['fetched_legs'], search
+            # Days no itinerary can serve keep the pruning of the others going
+            assert search['gaps']['days'] == num_of_days - len(gap_days), search
+            assert search['gaps']['fetched_legs'] <= search['cold']['fetched_legs'] * 2, search
+            assert search['budgeted']['upstream_legs'] < itinerary.ITINERARY_MAX_FETCHES * 2, search
+    finally:
+        stub.terminate()
+        shutil.rmtree(directory)
+    return results
+
+def get_fare_dicts(airline_name, start, prices):
+    # A route-month as get_fares returned it before fares.py, a {'Airline', 'Date', 'Price'} dict for every day
+    return [{'Airline': airline_name, 'Date': (start + dt.timedelta(days=i)).isoformat(), 'Price': price}
+            for i, price in enumerate(prices)]
+
+def bench_matrix(route_months, iterations, seed):
+    # Memory and throughput of cached route-months kept as price arrays over shared date axes, against the
+    # former lists of dicts: the memory they hold, a round trip through a FareCache row, the fill of fetched pages
+    # and the render of a search
+    from array import array
+    import server
+    from fares import PRICE_TYPECODE, FareMatrix, get_month_axis, get_date_axis, new_prices, load_prices, fill_prices
+    rng = random.Random(seed)
+    months = ['{0}-{1:02}'.format(2030 + i // 12, i % 12 + 1) for i in range(24)]
+    samples = []
+    for i in range(route_months):
+        start, num_of_days = get_month_axis(months[i % len(months)])
+        samples.append((start, [rng.randrange(1000, 20000) for _ in range(num_of_days)]))
+    name = server.AIRLINE_NAMES[server.Airline.TIGERAIR_TAIWAN]
+
+    def build_dicts():
+        return [get_fare_dicts(name, start, prices) for start, prices in samples]
+
+    def build_arrays():
+        # The date axis of each month is formatted once and shared by all of its route-months
+        return [(get_date_axis(start, len(prices)), array(PRICE_TYPECODE, prices)) for start, prices in samples]
+
+    results = {'route_months': route_months}
+    for layout, build in (('dicts', build_dicts), ('arrays', build_arrays)):
+        get_date_axis.cache_clear()
+        tracemalloc.start()
+        held = build()
+        results[layout] = {'held_mb': tracemalloc.get_traced_memory()[0] / 1024 / 1024}
+        tracemalloc.stop()
+        del held
+    results['memory_ratio'] = results['dicts']['held_mb'] / results['arrays']['held_mb']
+
+    # A FareCache row written and read back, as JSON before and as the bytes of the array now
+    dicts = build_dicts()
+    arrays = [prices for axis, prices in build_arrays()]
+    results['dicts']['row_bytes'] = sum(len(json.dumps(row)) for row in dicts) / route_months
+    results['arrays']['row_bytes'] = sum(len(row.tobytes()) for row in arrays) / route_months
+    results['dicts']['round_trips_ms'] = time_calls(lambda: [json.loads(json.dumps(row)) for row in dicts], iterations) * 1000
+    results['arrays']['round_trips_ms'] = time_calls(lambda: [load_prices(row.tobytes()) for row in arrays], iterations) * 1000
+
+    # The pages of a Jetstar month written into a month array
+    start, num_of_days = get_month_axis(months[0])
+    pages = [{date: 1000 + idx for idx, date in enumerate(get_date_axis(start + dt.timedelta(days=week * 7), 7))}
+             for week in range(5)]
+    results['fill_months_per_second'] = 1 / time_calls(
+        lambda: [fill_prices(new_prices(num_of_days), start, page) for page in pages], iterations * 100)
+
+    # /data of two airlines over a month
+    fares = FareMatrix(start, num_of_days)
+    for airline, prices in zip((server.Airline.TIGERAIR_TAIWAN, server.Airline.JETSTAR), arrays[::len(months)]):
+        fares.add(airline, prices)
+    results['render_ms'] = time_calls(lambda: server.get_visualized_data(fares), iterations) * 1000
+    assert results['arrays']['held_mb'] < results['dicts']['held_mb']
+    return results
+
+def get_parsers(search):
+    # Parse functions of the fixtures by the URL they were recorded from, as {URL: (name, parse(text))}
+    import server
+    import routes
+    import enrichment
+
+    def parse_route_source(airline):
+        import requests
+        extract, parse = routes.ROUTE_SOURCES[airline]
+
+        def parse_text(text):
+            response = requests.Response()
+            response._content = text.encode('utf-8')
+            response.encoding = 'utf-8'
+            return parse(extract(response))
+        return 'routes_' + airline.name.lower(), parse_text
+
+    parsers = {
+        server.TIGERAIR_TAIWAN_URL: ('tigerair_taiwan_window', server.parse_tigerair_taiwan_window),
+        server.VANILLA_AIR_FARES_URL: ('vanilla_air_month', server.parse_vanilla_air_month),
+        server.VANILLA_AIR_ROUTES_URL: ('vanilla_air_transit',
+                                        lambda text: server.parse_vanilla_air_transit(text, search['origin'], search['destination'])),
+        server.JETSTAR_URL: ('jetstar_window', server.parse_jetstar_window),
+        enrichment.CURRENCIES_URL: ('wikipedia_currencies', lambda text: enrichment.index_table(text, enrichment.select_sortable_table))
+    }
+    for airline in routes.ROUTE_SOURCES:
+        parsers.setdefault(routes.get_route_source_url(airline), parse_route_source(airline))
+    for capital in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        parsers[enrichment.EN_AIRPORTS_URL.format(capital)] = (
+            'wikipedia_en', lambda text: enrichment.index_table(text, enrichment.select_sortable_table))
+        parsers[enrichment.ZH_AIRPORTS_URL.format(capital)] = (
+            'wikipedia_zh', lambda text: enrichment.index_table(text, enrichment.select_zh_sortable_table))
+    return parsers
+
+def bench_parse(fixtures, iterations):
+    # Throughput and peak memory of the parse functions over the recorded pages, then of get_visualized_data
+    import server
+    from fares import FareMatrix, get_month_axis, new_prices
+    search = load_search(fixtures)
+    parsers = get_parsers(search)
+    pages = {}
+    for key, entry in replay.load_index(fixtures).items():
+        if entry['url'] in parsers:
+            with open(os.path.join(fixtures, entry['body']), 'rb') as f:
+                pages.setdefault(parsers[entry['url']], []).append(f.read().decode('utf-8', 'replace'))
+
+    results = {}
+    for (name, parse), texts in sorted(pages.items(), key=lambda item: item[0][0]):
+        size = sum(len(text.encode('utf-8')) for text in texts)
+        try:
+            elapsed = time_calls(lambda: [parse(text) for text in texts], iterations)
+        except Exception as e:
+            # e.g. a Jetstar home page without embedded routes, which would need a browser
+            results[name] = {'error': repr(e)}
+            continue
+        tracemalloc.start()
+        for text in texts:
+            parse(text)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.setdefault(name, {'pages': 0, 'bytes': 0, 'seconds': 0})
+        results[name]['pages'] += len(texts)
+        results[name]['bytes'] += size
+        results[name]['seconds'] += elapsed
+        results[name]['peak_kb'] = max(results[name].get('peak_kb', 0), peak / 1024)
+    for result in results.values():
+        if 'error' in result:
+            continue
+        result['pages_per_second'] = result['pages'] / result['seconds']
+        result['mb_per_second'] = result['bytes'] / result['seconds'] / 1024 / 1024
+        del result['seconds']
+
+    # A month of every airline, rendered into the chart and the table
+    fares = FareMatrix(*get_month_axis(search['month']))
+    for airline in server.Airline:
+        fares.add(airline, new_prices(fares.num_of_days))
+    elapsed = time_calls(lambda: server.get_visualized_data(fares), iterations)
+    tracemalloc.start()
+    server.get_visualized_data(fares)
+    results['render'] = {'ms': elapsed * 1000, 'peak_kb': tracemalloc.get_traced_memory()[1] / 1024}
+    tracemalloc.stop()
+    return results
+
+class HTTPSStubHandler(BaseHTTPRequestHandler):
+    # Jetstar week pages over keep-alive HTTPS connections, each new connection counted
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written apart, which Nagle's algorithm would hold up on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # A new connection pays the round trips of its handshakes, as it would to a distant host
+        sleep(self.server.rtt)
+        self.server.connections += 1
+        self.request = self.server.context.wrap_socket(self.request, server_side=True)
+        super().setup()
+
+    def do_GET(self):
+        params = dict(parse_qsl(urlsplit(self.path).query))
+        body = ''.join('<li class="date-selector__option" data-lowfare="?departuredate1={0}">'
+                       '<span data-amount="1">{1}</span></li>'.format(date, 1000 + idx)
+                       for idx, date in enumerate(loadtest.get_window(params, 'departuredate1', 3)))
+        body = ('<ul>' + body + '</ul>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class HTTPSStubServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_https_stub(directory, rtt):
+    # A self-signed certificate for 127.0.0.1, trusted by the requests of the benchmark only
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                           '-days', '1', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = HTTPSStubServer(('127.0.0.1', HTTPS_STUB_PORT), HTTPSStubHandler)
+    server.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server.context.load_cert_chain(cert, key)
+    server.rtt = rtt
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, cert
+
+def bench_sessions(rtt, sweeps):
+    # Per-request latency of the five week pages of a Jetstar month fetched one after another over HTTPS,
+    # with a new connection for every request as with requests.get, then with the pooled sessions of sessions.py
+    import requests
+    import server
+    import sessions
+    directory = tempfile.mkdtemp()
+    stub, cert = start_https_stub(directory, rtt)
+    server.JETSTAR_URL = 'https://127.0.0.1:{0}/jetstar'.format(HTTPS_STUB_PORT)
+    start, num_of_days = server.get_month_axis('2030-01')
+    pages = server.plan_requests(server.Airline.JETSTAR, [(start, start.replace(day=num_of_days))], 'TPE', 'NRT', 'TWD')
+    modes = {
+        'fresh': lambda url, **kwargs: requests.get(url, **kwargs),
+        'pooled': sessions.http_get
+    }
+    results = {'pages_per_sweep': len(pages)}
+    try:
+        for mode, get in modes.items():
+            sessions.close_sessions()
+            connections = stub.connections
+            latencies = []
+            for _ in range(sweeps):
+                for (url, params, headers), parse in pages:
+                    request_start = perf_counter()
+                    response = get(url, params=params, headers=headers, timeout=10, verify=cert)
+                    response.raise_for_status()
+                    parse(response.text)
+                    latencies.append(perf_counter() - request_start)
+            results[mode] = get_percentiles(latencies)
+            results[mode]['mean_ms'] = sum(latencies) / len(latencies) * 1000
+            results[mode]['connections_per_sweep'] = (stub.connections - connections) / sweeps
+    finally:
+        stub.shutdown()
+        sessions.close_sessions()
+    results['speedup'] = results['fresh']['mean_ms'] / results['pooled']['mean_ms']
+    return results
+
+def bench_metrics(iterations, rounds):
+    import metrics
+    import server
+    from fares import get_month_axis, new_prices
+
+    # Every airline served from the cache kept in memory, so that only the code of this process is timed
+    server.fare_cache.db_path = None
+    month = '2030-01'
+    num_of_days = get_month_axis(month)[1]
+    for airline in server.Airline:
+        server.fare_cache.store((airline.value, 'TPE', 'NRT', month, 'TWD'), new_prices(num_of_days), time(), False)
+    airlines = [airline.value for airline in server.Airline]
+
+    def search():
+        server.get_visualized_data(server.get_fares(month, 'TPE', 'NRT', airlines, 'TWD'))
+
+    # Best of the rounds, alternating the two modes so that drifts of the machine hit both
+    timings = {True: [], False: []}
+    for _ in range(rounds):
+        for enabled in (False, True):
+            metrics.METRICS_ENABLED = enabled
+            timings[enabled].append(time_calls(search, iterations))
+    histogram = metrics.Histogram('lcc_benchmark_seconds', 'Observations of the benchmark', ('label', ))
+    observe = time_calls(lambda: histogram.observe(0.01, 'label'), iterations * 100)
+    metrics.METRICS_ENABLED = True
+
+    disabled = min(timings[False])
+    enabled = min(timings[True])
+    overhead = (enabled - disabled) / disabled
+    return {
+        'search_disabled_ms': disabled * 1000,
+        'search_enabled_ms': enabled * 1000,
+        'overhead': overhead,
+        'budget': METRICS_OVERHEAD_BUDGET,
+        'within_budget': overhead <= METRICS_OVERHEAD_BUDGET,
+        'observe_us': observe * 1000000
+    }
+
+def save_results(command, args, results):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = None
+    run = {
+        'command': command,
+        'args': args,
+        'commit': commit,
+        'python': platform.python_version(),
+        'started_at': dt.datetime.now().isoformat(timespec='seconds'),
+        'results': results
+    }
+    os.makedirs(BENCHMARK_RESULTS_DIR, exist_ok=True)
+    path = os.path.join(BENCHMARK_RESULTS_DIR, '{0}-{1}.json'.format(command, dt.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(run, f, indent=2)
+    return path
+
+def flatten(results, prefix=''):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def compare(old_path, new_path):
+    # Print every number of two runs of the same benchmark with its change
+    with open(old_path, encoding='utf-8') as f:
+        old = flatten(json.load(f)['results'])
+    with open(new_path, encoding='utf-8') as f:
+        new = flatten(json.load(f)['results'])
+    for key in sorted(set(old) | set(new)):
+        if key in old and key in new and old[key]:
+            print('{0:<48} {1:>12.3f} {2:>12.3f} {3:>+8.1%}'.format(key, old[key], new[key], (new[key] - old[key]) / old[key]))
+        else:
+            print('{0:<48} {1:>12} {2:>12}'.format(key, old.get(key, '-'), new.get(key, '-')))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the fare and route pipelines')
+    parser.add_argument('--fixtures', default=replay.FIXTURES_DIR, help='responses recorded by replay.py')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the replay server waits before answering')
+    subparsers = parser.add_subparsers(dest='command')
+    data_parser = subparsers.add_parser('data', help='end-to-end latency of /data')
+    data_parser.add_argument('--iterations', type=int, default=50)
+    routes_parser = subparsers.add_parser('routes', help='duration of full and incremental route refreshes')
+    routes_parser.add_argument('--rounds', type=int, default=5)
+    parse_parser = subparsers.add_parser('parse', help='throughput and memory of the parsers and the render')
+    parse_parser.add_argument('--iterations', type=int, default=20)
+    metrics_parser = subparsers.add_parser('metrics', help='overhead of the metrics on a cached search')
+    metrics_parser.add_argument('--iterations', type=int, default=200)
+    metrics_parser.add_argument('--rounds', type=int, default=5)
+    sessions_parser = subparsers.add_parser('sessions', help='latency of Jetstar pages with and without pooled connections')
+    sessions_parser.add_argument('--rtt', type=float, default=0.02, help='seconds the stub waits before each new connection')
+    sessions_parser.add_argument('--sweeps', type=int, default=20)
+    ingest_parser = subparsers.add_parser('ingest', help='route refresh time on lcc.db and on a synthetic route set')
+    ingest_parser.add_argument('--scales', type=int, nargs='+', default=[1, 10], help='times the routes of lcc.db')
+    ingest_parser.add_argument('--seed', type=int, default=0)
+    catalog_parser = subparsers.add_parser('catalog', help='throughput of the catalog endpoints with and without catalog.py')
+    catalog_parser.add_argument('--requests', type=int, default=2000)
+    catalog_parser.add_argument('--seed', type=int, default=0)
+    render_parser = subparsers.add_parser('render', help='CPU time and RSS of the render with and without pandas')
+    render_parser.add_argument('--months', type=int, default=12)
+    render_parser.add_argument('--iterations', type=int, default=20)
+    subparsers.add_parser('enrichment', help='requests and parses of the airport and currency metadata lookups')
+    matrix_parser = subparsers.add_parser('matrix', help='memory and throughput of cached route-months as arrays and as dicts')
+    matrix_parser.add_argument('--route-months', type=int, default=5000)
+    matrix_parser.add_argument('--iterations', type=int, default=20)
+    matrix_parser.add_argument('--seed', type=int, default=0)
+    itineraries_parser = subparsers.add_parser('itineraries', help='candidates, fetched legs and time of the itinerary search')
+    itineraries_parser.add_argument('--pairs', type=int, default=1000)
+    itineraries_parser.add_argument('--searches', type=int, default=5)
+    itineraries_parser.add_argument('--month', default='2030-01')
+    itineraries_parser.add_argument('--seed', type=int, default=0)
+    compare_parser = subparsers.add_parser('compare', help='compare two results of the same benchmark')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    args = parser.parse_args()
+    # Subcommands cannot be required before Python 3.7
+    if args.command is None:
+        parser.error('a command is required')
+
+    if args.command == 'compare':
+        compare(args.old, args.new)
+    else:
+        fixtures = os.path.abspath(args.fixtures)
+        if args.command == 'data':
+            results = bench_data(fixtures, args.latency, args.iterations)
+        elif args.command == 'routes':
+            results = bench_routes(fixtures, args.latency, args.rounds)
+        elif args.command == 'parse':
+            results = bench_parse(fixtures, args.iterations)
+        elif args.command == 'sessions':
+            results = bench_sessions(args.rtt, args.sweeps)
+        elif args.command == 'ingest':
+            results = bench_ingest(args.scales, args.seed)
+        elif args.command == 'catalog':
+            results = bench_catalog(args.requests, args.seed)
+        elif args.command == 'render':
+            results = bench_render(args.months, args.iterations)
+        elif args.command == 'enrichment':
+            results = bench_enrichment()
+        elif args.command == 'matrix':
+            results = bench_matrix(args.route_months, args.iterations, args.seed)
+        elif args.command == 'itineraries':
+            results = bench_itineraries(args.pairs, args.searches, args.month, args.seed)
+        else:
+            results = bench_metrics(args.iterations, args.rounds)
+        print(json.dumps(results, indent=2))
+        print('Saved to ' + save_results(args.command, vars(args), results))
+        # Kept as a run like the others, then failed so that the overhead is guarded and not only reported
+        if args.command == 'metrics' and not results['within_budget']:
+            sys.exit('the metrics take {0:.1%} of a cached search, over the budget of {1:.0%}'.format(
+                results['overhead'], METRICS_OVERHEAD_BUDGET))
@@ -0,0 +1,86 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+
+from server import logger
+
+def create_driver():
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--no-sandbox')
+    return webdriver.Chrome(options=options)
+
+class BrowserPool:
+    # A bounded pool of browser sessions, reused across tasks and replaced when they crash
+    def __init__(self, size, factory=create_driver):
+        self.size = size
+        self.factory = factory
+        self.idle = queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    return self.factory()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            # Wait for a session to come back, checking again now and then in case a broken one freed a slot
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def release(self, driver, broken=False):
+        if not broken:
+            self.idle.put(driver)
+            return
+        # A crashed session is dropped, the next acquire starts a fresh one
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error('Fail on quitting a broken browser session - {0}'.format(repr(e)))
+        with self.lock:
+            self.created -= 1
+
+    @contextmanager
+    def driver(self):
+        driver = self.acquire()
+        try:
+            yield driver
+        except WebDriverException:
+            self.release(driver, broken=True)
+            raise
+        except Exception:
+            self.release(driver)
+            raise
+        else:
+            self.release(driver)
+
+    def close(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                driver.quit()
+            except Exception as e:
+                logger.error('Fail on quitting a browser session - {0}'.format(repr(e)))
+            with self.lock:
+                self.created -= 1
@@ -0,0 +1,189 @@
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time
+
+from fares import load_prices
+
+logger = logging.getLogger('server')
+
+class FareCache:
+    # Keys are tuples of (airline ID, origin, destination, month, currency),
+    # values are the price arrays returned by the fetchers of server.py, shared and never modified once cached.
+    # The FareCache table of db_path is created by migrations.py
+    def __init__(self, ttls, max_bytes, db_path=None):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.prewarming = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.prewarms = 0
+        self.prewarmed_hits = 0
+
+    def get_or_fetch(self, key, fetch, prewarm=False, stored=False):
+        # A pre-warming fetch always goes upstream, and the entry it stores is flagged
+        # so that the requests served from it can be counted.
+        # A stored fetch leaves the data in the table itself, e.g. through the workers of worker.py,
+        # and the entry it loaded keeps the fetched time and the flag of the row
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not prewarm:
+                if time() - entry[1] < self.ttls[key[0]]:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    self.prewarmed_hits += entry[3]
+                    return entry[0]
+                self.stale += 1
+            # Only one upstream fetch per key is in flight, the other callers wait for its result. Pre-warming fetches
+            # are paced over seconds, so they have a map of their own and a search never waits for one
+            inflight = self.prewarming if prewarm else self.inflight
+            future = inflight.get(key)
+            leader = future is None
+            if leader:
+                future = inflight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            entry = None if prewarm else self.load(key)
+            if entry is None:
+                with self.lock:
+                    if prewarm:
+                        self.prewarms += 1
+                    else:
+                        self.misses += 1
+                data = fetch()
+                if not stored:
+                    self.store(key, data, time(), prewarm)
+            else:
+                data = entry[0]
+                with self.lock:
+                    self.hits += 1
+                    self.prewarmed_hits += entry[3]
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(data)
+            return data
+        finally:
+            with self.lock:
+                del inflight[key]
+
+    def peek(self, key):
+        # Fresh cached data of the key or None, never fetching
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time() - entry[1] < self.ttls[key[0]]:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.prewarmed_hits += entry[3]
+                return entry[0]
+        entry = self.load(key)
+        if entry is None:
+            return None
+        with self.lock:
+            self.hits += 1
+            self.prewarmed_hits += entry[3]
+        return entry[0]
+
+    def peek_memory(self, key):
+        # Fresh data of the key held in memory or None, for estimates such as the lower bounds of itinerary.py:
+        # neither counted as a hit nor read from the table, and leaving the order of eviction alone
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time() - entry[1] < self.ttls[key[0]]:
+                return entry[0]
+        return None
+
+    def peek_stale(self, key):
+        # The last cached data of the key however old, as (data, fetched time) or None, for when the upstream is down
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            return entry[0], entry[1]
+        row = self.select(key)
+        if row is None:
+            return None
+        return load_prices(row[0]), row[1]
+
+    def miss(self):
+        # Counted by callers fetching on their own, e.g. the async server of aservice.py
+        with self.lock:
+            self.misses += 1
+
+    def fetched_at(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            return entry[1]
+        row = self.select(key)
+        return row[1] if row is not None else None
+
+    def select(self, key):
+        if self.db_path is None:
+            return None
+        try:
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute('''SELECT Data, FetchedAt, Prewarmed FROM FareCache
+                                  WHERE AirlineId = ? AND Origin = ? AND Destination = ? AND Month = ? AND Currency = ?''',
+                               key).fetchone()
+            conn.close()
+        except sqlite3.Error as e:
+            logger.error('Fail on loading cached fares of {0} - {1}'.format(key, repr(e)))
+            return None
+        return row
+
+    def load(self, key):
+        row = self.select(key)
+        if row is None or time() - row[1] >= self.ttls[key[0]]:
+            return None
+        entry = (load_prices(row[0]), row[1], len(row[0]), row[2])
+        self.remember(key, entry)
+        return entry
+
+    def store(self, key, data, fetched_at, prewarmed=False):
+        blob = data.tobytes()
+        self.remember(key, (data, fetched_at, len(blob), int(prewarmed)))
+        if self.db_path is None:
+            return
+        try:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute('INSERT OR REPLACE INTO FareCache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         key + (blob, fetched_at, int(prewarmed)))
+            conn.commit()
+            conn.close()
+        except sqlite3.Error as e:
+            logger.error('Fail on saving cached fares of {0} - {1}'.format(key, repr(e)))
+
+    def remember(self, key, entry):
+        # Entries are tuples of (data, fetched time, size, pre-warmed flag),
+        # the bytes of the price array stand for the memory taken by an entry
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = entry
+            self.size += entry[2]
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1][2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'prewarms': self.prewarms,
+                'prewarmed_hits': self.prewarmed_hits,
+                'entries': len(self.entries),
+                'bytes': self.size
+            }
@@ -0,0 +1,141 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+from time import time
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port, get_route_forms
+
+# Bytes sent by service.py for the catalog responses and /data with and without compression, and the answers
+# to conditional requests before and after the catalog version is bumped, against the stubbed airline sites.
+# aservice.py has to answer the GET catalog requests of the search page the same way
+ACCEPT_ENCODINGS = ('identity', 'gzip', 'br')
+
+def get_sizes(client, url, query):
+    # Body bytes sent for each accepted encoding, the headers are the same but for Content-Encoding
+    sizes = {}
+    for accept in ACCEPT_ENCODINGS:
+        response = client.get(url, query_string=query, headers={'Accept-Encoding': accept})
+        assert response.status_code == 200, response.status
+        assert response.headers.get('Content-Encoding') in (None, accept), response.headers
+        sizes[accept] = len(response.data)
+    return sizes
+
+def check_conditional(client, url, query):
+    first = client.get(url, query_string=query)
+    etag = first.headers['ETag']
+    by_etag = client.get(url, query_string=query, headers={'If-None-Match': etag})
+    by_date = client.get(url, query_string=query, headers={'If-Modified-Since': first.headers['Last-Modified']})
+    assert by_etag.status_code == 304 and not by_etag.data, by_etag.status
+    assert by_date.status_code == 304 and not by_date.data, by_date.status
+    assert client.post(url, data=query).status_code == 200
+    return etag, first.headers['Last-Modified']
+
+async def check_async(catalog_requests):
+    # The same validators, answers to conditional requests and encodings from aservice.py
+    from aiohttp.test_utils import TestClient, TestServer
+    import aservice
+    client = TestClient(TestServer(aservice.create_app()), auto_decompress=False)
+    await client.start_server()
+    results = {}
+    try:
+        for url, query in catalog_requests:
+            name = '{0}?{1}'.format(url, '&'.join('{0}={1}'.format(*item) for item in sorted(query.items())))
+            first = await client.get(url, params=query)
+            assert first.status == 200, first.status
+            assert first.headers['Cache-Control'] == 'no-cache' and 'Accept-Encoding' in first.headers['Vary'], first.headers
+            etag = first.headers['ETag']
+            by_etag = await client.get(url, params=query, headers={'If-None-Match': etag})
+            by_date = await client.get(url, params=query, headers={'If-Modified-Since': first.headers['Last-Modified']})
+            assert by_etag.status == 304 and not await by_etag.read(), by_etag.status
+            assert by_date.status == 304 and not await by_date.read(), by_date.status
+            assert (await client.post(url, data=query)).status == 200
+            sizes = {}
+            for accept in ACCEPT_ENCODINGS:
+                response = await client.get(url, params=query, headers={'Accept-Encoding': accept})
+                assert response.status == 200, response.status
+                assert response.headers.get('Content-Encoding') in (None, accept), response.headers
+                sizes[accept] = len(await response.read())
+            results[name] = {'bytes': sizes, 'etag': etag}
+            print('aservice', name, results[name])
+    finally:
+        await client.close()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the compression and conditional requests of service.py')
+    parser.add_argument('--month', default='2030-01')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stubbed airlines take to answer')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(args.latency, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'lcc.db')
+    shutil.copy('lcc.db', db_path)
+    configure(directory)
+    import catalog
+    import server
+    import service
+    from migrations import migrate
+    migrate(db_path)
+    # The catalog version is bumped in the copy only
+    service.DB_LCC_PATH = db_path
+    import aservice
+    aservice.DB_LCC_PATH = db_path
+    client = service.app.test_client()
+
+    form = get_route_forms(db_path, args.month, 1)[0]
+    catalog_requests = [
+        ('/airport_codes', {'id': 'ALL'}),
+        ('/airport_codes', {'id': form['fromId']}),
+        ('/airlines', {'fromId': form['fromId'], 'toId': form['toId']})
+    ]
+    results = {}
+    for url, query in catalog_requests:
+        name = '{0}?{1}'.format(url, '&'.join('{0}={1}'.format(*item) for item in sorted(query.items())))
+        etag, last_modified = check_conditional(client, url, query)
+        results[name] = {'bytes': get_sizes(client, url, query), 'etag': etag, 'last_modified': last_modified}
+        print(name, results[name])
+
+    # A new version of the catalog answers the old validators with the full body
+    conn = sqlite3.connect(db_path)
+    conn.execute('UPDATE Catalog SET Version = Version + 1, UpdatedAt = ?', (time() + 1, ))
+    conn.commit()
+    conn.close()
+    catalog.checked_at = 0
+    for url, query in catalog_requests:
+        name = '{0}?{1}'.format(url, '&'.join('{0}={1}'.format(*item) for item in sorted(query.items())))
+        response = client.get(url, query_string=query, headers={'If-None-Match': results[name]['etag']})
+        assert response.status_code == 200 and response.headers['ETag'] != results[name]['etag'], response.headers
+        response = client.get(url, query_string=query, headers={'If-Modified-Since': results[name]['last_modified']})
+        assert response.status_code == 200, response.status
+    print('bumped version: 200 with the new ETag', response.headers['ETag'])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    async_results = loop.run_until_complete(check_async(catalog_requests))
+    loop.close()
+    # Both services name the same catalog version with the same validator
+    assert all(result['etag'] == response.headers['ETag'] for result in async_results.values()), async_results
+    results['aservice'] = async_results
+
+    # Without caching /data is never cacheable, with it until the first of its fares expires
+    response = client.get('/data', query_string=form)
+    assert response.headers['Cache-Control'] == 'no-cache', response.headers
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 600
+    response = client.get('/data', query_string=form)
+    print('/data Cache-Control:', response.headers['Cache-Control'])
+    assert response.headers['Cache-Control'].startswith('public, max-age=')
+    results['/data'] = {'bytes': get_sizes(client, '/data', form), 'cache_control': response.headers['Cache-Control']}
+    print('/data', results['/data'])
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
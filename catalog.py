@@ -0,0 +1,119 @@
+import logging
+import json
+import sqlite3
+import functools
+import threading
+from collections import defaultdict
+from time import time
+
+from httpcache import compress
+
+logger = logging.getLogger('server')
+
+# Seconds between checks of whether server.get_routes has changed the database
+CATALOG_CHECK_INTERVAL = 5
+
+def compare(str_a, str_b):
+    if str_a == 'Other' or str_a > str_b:
+        return 1
+    return -1
+
+def group_by_country(airports):
+    # airports are tuples of (ID, code, name, country name), grouped as the options of select2
+    result = []
+    for country in sorted(set(d[3] for d in airports), key=functools.cmp_to_key(compare)):
+        result.append({
+            'text': country,
+            'children': [{
+                'id': d[0],
+                'text': d[2] + ' - ' + d[1] if d[2] is not None else d[1]
+            } for d in airports if d[3] == country]
+        })
+    return result
+
+class Catalog:
+    # An immutable snapshot of airports and active routes, with the responses of
+    # /airport_codes and /airlines serialized in advance. Keys are IDs as strings,
+    # the way they arrive in the request form.
+    def __init__(self, conn, version):
+        self.version = version
+        self.updated_at = conn.execute('SELECT UpdatedAt FROM Catalog').fetchone()[0] or time()
+        # Responses compressed on first use, kept for the life of the snapshot
+        self.compressed = {}
+        c = conn.cursor()
+        c.execute('''SELECT a.Id, a.Code, a.Name, IFNULL(c.Name, "Other") CountryName FROM Airport a
+                     LEFT JOIN Country c ON a.CountryId = c.Id
+                     ORDER BY a.Id''')
+        self.airports = {d[0]: d for d in c.fetchall()}
+        c.execute('SELECT Id, Name FROM Airline')
+        airline_names = dict(c.fetchall())
+        c.execute('''SELECT r.FromAirportId, r.ToAirportId, r.AirlineId, a.CountryId FROM Route r
+                     JOIN Airport a ON r.ToAirportId = a.Id
+                     WHERE r.IsActive = 1
+                     ORDER BY r.FromAirportId, r.ToAirportId, r.AirlineId''')
+        # Adjacency lists of airline-tagged edges
+        self.edges = defaultdict(list)
+        destinations = defaultdict(list)
+        for from_id, to_id, airline_id, country_id in c.fetchall():
+            if not self.edges[from_id] or self.edges[from_id][-1][0] != to_id:
+                # Destinations without a country are not listed, as they have never been
+                if country_id is not None:
+                    destinations[from_id].append(self.airports[to_id])
+            self.edges[from_id].append((to_id, airline_id))
+        self.edges = dict(self.edges)
+
+        self.airport_codes = {'ALL': json.dumps(group_by_country(list(self.airports.values())))}
+        for from_id, airports in destinations.items():
+            self.airport_codes[str(from_id)] = json.dumps(group_by_country(airports))
+        airlines = defaultdict(list)
+        for from_id, edges in self.edges.items():
+            for to_id, airline_id in edges:
+                airlines[(str(from_id), str(to_id))].append({
+                    'id': airline_id,
+                    'name': airline_names[airline_id]
+                })
+        self.airlines = {key: json.dumps(value) for key, value in airlines.items()}
+
+    def get_airport_codes(self, id_):
+        return self.airport_codes.get(id_, '[]')
+
+    def get_airlines(self, from_id, to_id):
+        return self.airlines.get((from_id, to_id), '[]')
+
+    def get_compressed(self, body, encoding):
+        # body is one of the responses above, compressed at the highest level as it is sent many times
+        key = (encoding, body)
+        data = self.compressed.get(key)
+        if data is None:
+            data = self.compressed[key] = compress(body.encode('utf-8'), encoding, True)
+        return data
+
+def get_version(conn):
+    return conn.execute('SELECT Version FROM Catalog').fetchone()[0]
+
+current = None
+checked_at = 0
+reload_lock = threading.Lock()
+
+def get_catalog(db_path):
+    global current, checked_at
+    if current is not None and time() - checked_at < CATALOG_CHECK_INTERVAL:
+        return current
+    with reload_lock:
+        if current is None or time() - checked_at >= CATALOG_CHECK_INTERVAL:
+            try:
+                conn = sqlite3.connect(db_path)
+                try:
+                    version = get_version(conn)
+                    if current is None or version != current.version:
+                        # Build the new snapshot aside and swap it in, readers keep using the old one meanwhile
+                        current = Catalog(conn, version)
+                        logger.info('Succeed on loading the catalog of version {0}'.format(current.version))
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                if current is None:
+                    raise
+                logger.error('Fail on reloading the catalog - {0}'.format(repr(e)))
+            checked_at = time()
+    return current
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import hashlib
+from time import time
+
+from bs4 import BeautifulSoup
+from hanziconv import HanziConv
+
+from server import logger
+from sessions import http_get
+
+PAGE_CACHE_DIR = 'page_cache'
+# Seconds a cached page is used without asking the site whether it has changed
+PAGE_CACHE_FRESH = 24 * 3600
+# Seconds before the metadata of an airport or a country is looked up again
+METADATA_MAX_AGE = 30 * 24 * 3600
+REQUEST_TIMEOUT = 30
+
+EN_AIRPORTS_URL = 'https://en.wikipedia.org/wiki/List_of_airports_by_IATA_code:_{0}'
+ZH_AIRPORTS_URL = 'https://zh.wikipedia.org/wiki/%E5%9B%BD%E9%99%85%E8%88%AA%E7%A9%BA%E8%BF%90%E8%BE%93%E5%8D%8F%E4%BC%9A%E6%9C%BA%E5%9C%BA%E4%BB%A3%E7%A0%81_({0})'
+CURRENCIES_URL = 'https://en.wikipedia.org/wiki/List_of_circulating_currencies'
+# Chinese pages of these capitals have a different webpage structure
+ZH_SHIFTED_CAPITALS = ['H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'R', 'S', 'T', 'U']
+
+class PageCache:
+    # Pages kept on disk with their ETag and Last-Modified, and parsed at most once per run.
+    # The URLs of the pages that could not be fetched or parsed are kept in failed
+    def __init__(self, directory=PAGE_CACHE_DIR):
+        self.directory = directory
+        self.indexes = {}
+        self.failed = set()
+        self.fetches = 0
+        self.parses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url):
+        path = os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        meta = None
+        if os.path.exists(path + '.json'):
+            with open(path + '.json', encoding='utf-8') as f:
+                meta = json.load(f)
+            if time() - meta['checked_at'] < PAGE_CACHE_FRESH:
+                with open(path + '.html', encoding='utf-8') as f:
+                    return f.read()
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        self.fetches += 1
+        response = http_get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            with open(path + '.html', encoding='utf-8') as f:
+                text = f.read()
+        else:
+            response.raise_for_status()
+            text = response.text
+            with open(path + '.html', 'w', encoding='utf-8') as f:
+                f.write(text)
+        with open(path + '.json', 'w', encoding='utf-8') as f:
+            json.dump({
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'checked_at': time()
+            }, f)
+        return text
+
+    def get_index(self, url, select_table):
+        if url not in self.indexes:
+            index = {}
+            try:
+                text = self.get(url)
+                self.parses += 1
+                index = index_table(text, select_table)
+            except Exception as e:
+                # Remember the failure too, so that a broken page is not fetched again for every airport
+                logger.error('Fail on indexing the page {0} - {1}'.format(url, repr(e)))
+                self.failed.add(url)
+            self.indexes[url] = index
+        return self.indexes[url]
+
+def index_table(text, select_table):
+    # Index the cells of every table row by each string in the row, the first row holding a string wins
+    # as table.find(string=...).find_parent('tr') does
+    index = {}
+    for tr in select_table(BeautifulSoup(text, 'html.parser')).find_all('tr'):
+        tds = tr.find_all('td')
+        for string in tr.find_all(string=True):
+            index.setdefault(str(string), tds)
+    return index
+
+def select_sortable_table(soup):
+    return soup.find('table', class_='wikitable sortable')
+
+def select_zh_sortable_table(soup):
+    return soup.select('table.wikitable.sortable')[0]
+
+def enrich_metadata(c, page_cache=None):
+    # Look up the names, countries and currencies never looked up or looked up more than METADATA_MAX_AGE ago.
+    # The lookups are stamped whether the pages list them or not, so that e.g. an airport without a Chinese name
+    # is not looked up on every run, unless the page itself failed. Only values that differ are written, and the rows
+    # written are counted in the stats, for get_routes to bump the catalog version with
+    page_cache = page_cache or PageCache()
+    now = time()
+    changed = 0
+    c.execute('''SELECT Code FROM Airport
+                 WHERE MetadataUpdatedAt IS NULL OR MetadataUpdatedAt < ?
+                 ORDER BY Code''',
+              (now - METADATA_MAX_AGE, ))
+    codes = [row[0] for row in c.fetchall()]
+
+    # Update English information of airports
+    for code in codes:
+        try:
+            tds = page_cache.get_index(EN_AIRPORTS_URL.format(code[0]), select_sortable_table)[code]
+            airport_name = re.split(r'[\[\(\d]', tds[2].text)[0].strip()
+            country_name = re.sub(r'\d', '', tds[3].text.split(',')[-1]).strip()
+            c.execute('INSERT OR IGNORE INTO Country (Name) VALUES (?)',
+                      (country_name, ))
+            changed += c.rowcount
+            c.execute('''UPDATE Airport SET Name = ?, CountryId = (SELECT Id FROM Country WHERE Name = ?)
+                         WHERE Code = ? AND (Name IS NOT ? OR CountryId IS NOT (SELECT Id FROM Country WHERE Name = ?))''',
+                      (airport_name, country_name, code, airport_name, country_name))
+            changed += c.rowcount
+        except Exception as e:
+            logger.error('Fail on updating English info of the airport with code {0} - {1}'.format(code, repr(e)))
+
+    # Update Chinese information of airports
+    for code in codes:
+        try:
+            tds = page_cache.get_index(ZH_AIRPORTS_URL.format(code[0]), select_zh_sortable_table)[code]
+            start_idx = 1 if code[0] in ZH_SHIFTED_CAPITALS else 2
+            airport_name = tds[start_idx].text.split('（')[0].strip()
+            country_name = tds[start_idx + 2].text.strip()
+            country_name = HanziConv.toTraditional(country_name)
+            c.execute('''UPDATE Country SET NameZhTW = ?
+                         WHERE Id = (SELECT CountryId FROM Airport WHERE Code = ?) AND NameZhTW IS NOT ?''',
+                      (country_name, code, country_name))
+            changed += c.rowcount
+            if re.search(r'[A-Za-z]', airport_name) is None:
+                airport_name = HanziConv.toTraditional(airport_name)
+                c.execute('UPDATE Airport SET NameZhTW = ? WHERE Code = ? AND NameZhTW IS NOT ?',
+                          (airport_name, code, airport_name))
+                changed += c.rowcount
+        except Exception as e:
+            logger.error('Fail on updating Chinese info of the airport with code {0} - {1}'.format(code, repr(e)))
+
+    c.executemany('UPDATE Airport SET MetadataUpdatedAt = ? WHERE Code = ?',
+                  [(now, code) for code in codes if EN_AIRPORTS_URL.format(code[0]) not in page_cache.failed
+                   and ZH_AIRPORTS_URL.format(code[0]) not in page_cache.failed])
+
+    # Update currency codes of countries
+    c.execute('''SELECT Name FROM Country
+                 WHERE MetadataUpdatedAt IS NULL OR MetadataUpdatedAt < ?''',
+              (now - METADATA_MAX_AGE, ))
+    countries = [row[0] for row in c.fetchall()]
+    for country in countries:
+        try:
+            tds = page_cache.get_index(CURRENCIES_URL, select_sortable_table)[country]
+            currency_code = tds[3].text.strip()
+            c.execute('UPDATE Country SET Currency = ? WHERE Name = ? AND Currency IS NOT ?',
+                      (currency_code, country, currency_code))
+            changed += c.rowcount
+        except Exception as e:
+            logger.error('Fail on updating the currency of the country {0} - {1}'.format(country, repr(e)))
+    if CURRENCIES_URL not in page_cache.failed:
+        c.executemany('UPDATE Country SET MetadataUpdatedAt = ? WHERE Name = ?',
+                      [(now, country) for country in countries])
+
+    stats = {
+        'airports': len(codes),
+        'countries': len(countries),
+        'changed': changed,
+        'fetches': page_cache.fetches,
+        'parses': page_cache.parses
+    }
+    logger.info('Succeed on enriching the metadata - {0}'.format(stats))
+    return stats
@@ -0,0 +1,117 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from server import Airline
+from itinerary import get_cached_bound, fetch_leg
+
+# Destinations fetched at the same time by one exploration, each of them over all of its airlines
+EXPLORE_CONCURRENCY = 8
+EXPLORE_TOP_K = 5
+EXPLORE_MAX_TOP_K = 20
+# A destination is assumed never to get cheaper than this share of the lowest price it has ever been seen at,
+# 0 to fetch every destination not found in the cache. This is a guess, not a bound: a top settled on it is approximate
+EXPLORE_HISTORY_MARGIN = 0.8
+
+destination_executor = ThreadPoolExecutor(max_workers=EXPLORE_CONCURRENCY)
+
+def get_cheapest_day(month, days):
+    # The cheapest day of the days returned by fetch_leg, None when there is no fare at all
+    cheapest = None
+    for idx, day in enumerate(days):
+        if day is not None and (cheapest is None or day[0] < cheapest[0]):
+            cheapest = (day[0], month + '-{0:02}'.format(idx + 1), day[1])
+    return cheapest
+
+def explore(catalog, from_id, month, currency, floors=None, top_k=EXPLORE_TOP_K):
+    # Yield a line for each destination of from_id as soon as its cheapest fare of the month is known, with the
+    # cheapest top_k destinations so far, then a last line once no destination left could enter them.
+    # Destinations fully in the cache come first as they cost nothing, the others in the order of the lowest
+    # prices in floors ({destination code: price}) lowered by EXPLORE_HISTORY_MARGIN. Only those guesses prune
+    # destinations, so the last line is exact when floors is None and approximate once anything was pruned
+    origin = catalog.airports[from_id][1]
+    known_airlines = set(airline.value for airline in Airline)
+    airline_ids = defaultdict(list)
+    for to_id, airline_id in catalog.edges.get(from_id, []):
+        if airline_id in known_airlines:
+            airline_ids[to_id].append(airline_id)
+
+    cached = []
+    candidates = []
+    for to_id in airline_ids:
+        code = catalog.airports[to_id][1]
+        bound = get_cached_bound(origin, code, airline_ids[to_id], month, currency)
+        if bound > 0:
+            cached.append(to_id)
+        else:
+            if floors is not None and code in floors:
+                bound = floors[code] * EXPLORE_HISTORY_MARGIN
+            candidates.append((bound, to_id))
+    candidates.sort()
+
+    ranked = []
+
+    def get_line(to_id, days, fetched):
+        airport = catalog.airports[to_id]
+        cheapest = get_cheapest_day(month, days)
+        destination = {
+            'id': to_id,
+            'code': airport[1],
+            'name': airport[2],
+            'country': airport[3],
+            'price': cheapest[0] if cheapest is not None else None,
+            'date': cheapest[1] if cheapest is not None else None,
+            'airline': cheapest[2] if cheapest is not None else None,
+            'fetched': fetched
+        }
+        if cheapest is not None:
+            ranked.append(destination)
+            ranked.sort(key=lambda d: d['price'])
+            del ranked[top_k:]
+        return {
+            'destination': destination,
+            'top': list(ranked)
+        }
+
+    def fetch(to_id):
+        return fetch_leg(origin, catalog.airports[to_id][1], airline_ids[to_id], month, currency)
+
+    for to_id in cached:
+        yield get_line(to_id, fetch(to_id), False)
+
+    pending = {}
+    fetched = 0
+    pruned = 0
+    idx = 0
+    while True:
+        # The price a destination has to beat to enter the top, nothing is settled before the top is full
+        threshold = ranked[-1]['price'] if len(ranked) == top_k else float('inf')
+        for future, (bound, to_id) in list(pending.items()):
+            if bound >= threshold:
+                # Left to finish into the cache, its fares cannot change the top any more
+                future.cancel()
+                del pending[future]
+                pruned += 1
+        while idx < len(candidates) and len(pending) < EXPLORE_CONCURRENCY and candidates[idx][0] < threshold:
+            bound, to_id = candidates[idx]
+            pending[destination_executor.submit(fetch, to_id)] = (bound, to_id)
+            fetched += 1
+            idx += 1
+        # The candidates are sorted by their bounds, once one cannot enter the top the rest cannot either
+        if idx < len(candidates) and candidates[idx][0] >= threshold:
+            pruned += len(candidates) - idx
+            idx = len(candidates)
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            bound, to_id = pending.pop(future)
+            yield get_line(to_id, future.result(), True)
+
+    yield {
+        'top': list(ranked),
+        'destinations': len(airline_ids),
+        'cached': len(cached),
+        'fetched': fetched,
+        'pruned': pruned,
+        'approximate': pruned > 0
+    }
@@ -0,0 +1,109 @@
+import argparse
+import json
+import multiprocessing
+import random
+import sqlite3
+import tempfile
+import threading
+from time import time, sleep
+
+import requests
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port
+
+# Upstream requests and time to a settled top of the explore endpoint of service.py, against the stubbed airline
+# sites of loadtest.py with a lowest fare set for each destination: first with nothing known, then with the history
+# of the first round bounding the destinations, then with the history left out for an exact top, then with the fares
+# of the earlier rounds in the cache
+EXPLORE_PORT = 8906
+
+def count_upstream(server):
+    return sum(series[-1] for series in server.upstream_seconds.values.values())
+
+def run_round(server, name, from_id, month, top_k, exact=False):
+    calls = count_upstream(server)
+    start = time()
+    first = None
+    data = {'fromId': from_id, 'month': month, 'topK': top_k}
+    if exact:
+        data['exact'] = 1
+    response = requests.post('http://127.0.0.1:{0}/explore'.format(EXPLORE_PORT), data=data, stream=True)
+    response.raise_for_status()
+    for line in response.iter_lines():
+        if first is None:
+            first = time() - start
+        last = json.loads(line)
+    return {
+        'round': name,
+        'first_line_ms': round(first * 1000, 1),
+        'top_ms': round((time() - start) * 1000, 1),
+        'upstream_requests': count_upstream(server) - calls,
+        'destinations': last['destinations'],
+        'cached': last['cached'],
+        'fetched': last['fetched'],
+        'pruned': last['pruned'],
+        'approximate': last['approximate'],
+        'top': [destination['code'] for destination in last['top']]
+    }
+
+def wait_for_history(server, flush_interval):
+    # Until the writer has nothing left to write, and has had the time to commit it
+    while server.fare_history.stats()['queued']:
+        sleep(0.1)
+    sleep(flush_interval + 0.5)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the upstream requests and time to the top destinations of /explore')
+    parser.add_argument('--origin', default='TPE')
+    parser.add_argument('--month', default='2030-01')
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the stubbed airlines take to answer')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(args.latency, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    directory = tempfile.mkdtemp()
+    configure(directory)
+    import server
+    import history
+    import service
+    from werkzeug.serving import make_server
+    service.HISTORY_DB_PATH = server.fare_history.db_path
+
+    # The same lowest fare of each destination on every stubbed airline, spread wide enough to rank them
+    conn = sqlite3.connect('lcc.db')
+    from_id, = conn.execute('SELECT Id FROM Airport WHERE Code = ?', (args.origin, )).fetchone()
+    codes = [row[0] for row in conn.execute('''SELECT DISTINCT a.Code FROM Route r JOIN Airport a ON r.ToAirportId = a.Id
+                                               WHERE r.FromAirportId = ? AND r.IsActive = 1''', (from_id, ))]
+    conn.close()
+    rng = random.Random(args.seed)
+    requests.post('http://{0}:{1}/fares'.format(STUB_HOSTS['tigerair'], STUB_PORT),
+                  data={code: rng.randint(2, 60) * 500 for code in codes}).raise_for_status()
+
+    http_server = make_server('127.0.0.1', EXPLORE_PORT, service.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    results = [run_round(server, 'cold', from_id, args.month, args.top)]
+    print(results[-1])
+    wait_for_history(server, history.HISTORY_FLUSH_INTERVAL)
+    results.append(run_round(server, 'history', from_id, args.month, args.top))
+    print(results[-1])
+    results.append(run_round(server, 'exact', from_id, args.month, args.top, True))
+    print(results[-1])
+    # Leaving the history out prunes nothing, so that top is exact, while the one pruned on the history is not
+    assert results[-2]['approximate'] == (results[-2]['pruned'] > 0), results[-2]
+    assert results[-1]['pruned'] == 0 and not results[-1]['approximate'], results[-1]
+    # The fares fetched so far, including the fetches abandoned once the top was settled, are kept from now on
+    sleep(args.latency * 10)
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 3600
+    results.append(run_round(server, 'cached', from_id, args.month, args.top))
+    print(results[-1])
+    http_server.shutdown()
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
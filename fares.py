@@ -0,0 +1,52 @@
+import datetime as dt
+import functools
+from array import array
+from calendar import monthrange
+
+# Type code of the price arrays, a signed 32-bit integer on the supported platforms
+PRICE_TYPECODE = 'i'
+
+@functools.lru_cache(maxsize=1024)
+def get_date_axis(start, num_of_days):
+    # ISO dates from start, formatted once and shared by every matrix over the same days
+    return tuple((start + dt.timedelta(days=i)).isoformat() for i in range(num_of_days))
+
+def get_month_axis(month):
+    start = dt.date(int(month[:4]), int(month[5:]), 1)
+    return start, monthrange(start.year, start.month)[1]
+
+def new_prices(num_of_days):
+    return array(PRICE_TYPECODE, bytes(array(PRICE_TYPECODE).itemsize * num_of_days))
+
+def load_prices(blob):
+    prices = array(PRICE_TYPECODE)
+    prices.frombytes(blob)
+    return prices
+
+def fill_prices(prices, start, fares):
+    # Write the {ISO date: price} fares of a page into the prices array, dates outside of the array are dropped
+    for date, price in fares.items():
+        offset = (dt.datetime.strptime(date, '%Y-%m-%d').date() - start).days
+        if 0 <= offset < len(prices) and price:
+            prices[offset] = int(round(price))
+    return prices
+
+class FareMatrix:
+    # Prices of several airlines over one axis of consecutive dates. Each airline has an array
+    # of prices indexed by the day offset from start, 0 standing for a day without a fare.
+    # The arrays are kept as they come from the cache, never copied. Airlines served from
+    # stale cached fares are kept in stale with the time their fares were fetched.
+    def __init__(self, start, num_of_days):
+        self.start = start
+        self.num_of_days = num_of_days
+        self.rows = {}
+        self.stale = {}
+
+    def add(self, airline, prices, stale=None):
+        self.rows[airline] = prices
+        if stale is not None:
+            self.stale[airline] = stale
+        return prices
+
+    def get_dates(self):
+        return get_date_axis(self.start, self.num_of_days)
@@ -0,0 +1,59 @@
+import argparse
+import json
+import multiprocessing
+import tempfile
+from time import time, sleep
+
+import requests
+
+import resilience
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port
+
+# Drive the fetchers of server.py through the stubbed airline sites of loadtest.py while injecting faults,
+# and show how the breakers open, serve stale fares and close again once the sites recover. A site answering
+# pages that cannot be parsed is up, and its breaker stays closed, while a site answering 429 is counted as failing
+
+def set_faults(faults):
+    requests.post('http://{0}:{1}/faults'.format(STUB_HOSTS['tigerair'], STUB_PORT), data=faults).raise_for_status()
+
+def run_round(server, name, month):
+    start = time()
+    fares = server.get_fares(month, 'TPE', 'NRT', [airline.value for airline in server.Airline], 'TWD')
+    print('{0:<10} {1:5.1f}s  {2}  stale: {3}'.format(
+        name, time() - start,
+        ' '.join('{0}={1}'.format(airline.name, breaker.state) for airline, breaker in server.breakers.items() if airline in fares.rows),
+        ', '.join(airline.name for airline in fares.stale) or '-'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the circuit breakers against failing and hanging airline sites')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the healthy stubbed airlines take to answer')
+    parser.add_argument('--healthy', type=int, default=25, help='rounds before the faults, enough to adapt the timeouts')
+    parser.add_argument('--faulty', type=int, default=8)
+    parser.add_argument('--cooldown', type=float, default=3)
+    parser.add_argument('--month', default='2030-01')
+    args = parser.parse_args()
+
+    resilience.BREAKER_COOLDOWN = args.cooldown
+    stub = multiprocessing.Process(target=run_stub, args=(args.latency, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    configure(tempfile.mkdtemp())
+    import server
+
+    for _ in range(args.healthy):
+        run_round(server, 'healthy', args.month)
+    set_faults({'vanilla': 'error', 'jetstar': 'hang'})
+    for _ in range(args.faulty):
+        run_round(server, 'faulty', args.month)
+    set_faults({'vanilla': 'ok', 'jetstar': 'ok'})
+    sleep(args.cooldown)
+    for _ in range(3):
+        run_round(server, 'recovered', args.month)
+    set_faults({'tigerair': 'garbage', 'vanilla': 'throttle'})
+    for _ in range(args.faulty):
+        run_round(server, 'garbled', args.month)
+    assert server.breakers[server.Airline.TIGERAIR_TAIWAN].state == resilience.CLOSED
+    assert server.breakers[server.Airline.VANILLA_AIR].state == resilience.OPEN
+    set_faults({'tigerair': 'ok', 'vanilla': 'ok'})
+    print(json.dumps({airline.name: breaker.stats() for airline, breaker in server.breakers.items()}, indent=2))
+    stub.terminate()
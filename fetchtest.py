@@ -0,0 +1,131 @@
+import argparse
+import json
+import multiprocessing
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+
+import requests
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port
+
+# Wall-clock time of server.get_fares against the stubbed airline sites of loadtest.py, each airline answering
+# after a latency of its own: the airlines and the pages of each airline are fetched at the same time, so a search
+# takes about as long as its slowest airline rather than the sum of them. A hanging airline is given up at the
+# global deadline with the fares of the others returned. A paced pre-warming fetch of prewarm.py holds up no search
+# of the same month, and is held to the deadline of its airline on the time spent upstream only
+AIRLINE_DELAYS = {
+    'tigerair': 0.2,
+    'vanilla': 0.3,
+    'jetstar': 1.0
+}
+# Seconds a search may take beyond its slowest airline, for the parsing and the thread hand-offs
+SLOWEST_MARGIN = 0.5
+# Seconds the pre-warming fetch waits before each of its requests, as prewarm.py waits for the turn of a site
+PREWARM_PACE = 1.0
+
+def post_stub(path, form):
+    requests.post('http://{0}:{1}{2}'.format(STUB_HOSTS['tigerair'], STUB_PORT, path), data=form).raise_for_status()
+
+def time_search(server, month, airlines, rounds):
+    # The median seconds of the searches, and the fares of the last one
+    timings = []
+    for _ in range(rounds):
+        start = time()
+        fares = server.get_fares(month, 'TPE', 'NRT', airlines, 'TWD')
+        timings.append(time() - start)
+    return sorted(timings)[len(timings) // 2], fares
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show that a search takes as long as its slowest airline, not the sum of them')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--month', default='2030-01')
+    parser.add_argument('--deadline', type=float, default=2, help='global deadline of the search with a hanging airline')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(0.05, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    configure(tempfile.mkdtemp())
+    post_stub('/delays', AIRLINE_DELAYS)
+    import server
+
+    airlines = [server.Airline.TIGERAIR_TAIWAN, server.Airline.VANILLA_AIR, server.Airline.JETSTAR]
+    results = {'airlines': {}}
+    for airline in airlines:
+        calls = sum(series[-1] for series in server.upstream_seconds.values.values())
+        seconds, fares = time_search(server, args.month, [airline.value], args.rounds)
+        requests_per_search = (sum(series[-1] for series in server.upstream_seconds.values.values()) - calls) / args.rounds
+        results['airlines'][airline.name] = {'seconds': round(seconds, 3), 'requests': requests_per_search}
+        print(airline.name, results['airlines'][airline.name])
+    seconds, fares = time_search(server, args.month, [airline.value for airline in airlines], args.rounds)
+    slowest = max(result['seconds'] for result in results['airlines'].values())
+    results['all'] = {
+        'seconds': round(seconds, 3),
+        'slowest_airline': slowest,
+        'sum_of_airlines': round(sum(result['seconds'] for result in results['airlines'].values()), 3),
+        # The requests one after another, as before the airlines and their pages were fetched concurrently
+        'sequential_estimate': round(sum(AIRLINE_DELAYS[name] * result['requests']
+                                         for name, result in zip(AIRLINE_DELAYS, results['airlines'].values())), 3)
+    }
+    print('all airlines', results['all'])
+    assert seconds < slowest + SLOWEST_MARGIN, 'the search took longer than its slowest airline'
+    assert all(any(fares.rows[airline]) for airline in airlines)
+
+    # A search starting while Jetstar is pre-warmed fetches on its own instead of waiting for the paced requests,
+    # and the pre-warming finishes past the deadline of the airline as long as its time upstream is within it
+    jetstar = server.Airline.JETSTAR
+    month_start, num_of_days = server.get_month_axis(args.month)
+    pages = len(server.plan_requests(jetstar, [(month_start, month_start.replace(day=num_of_days))], 'TPE', 'NRT', 'TWD'))
+    jetstar_timeout = server.AIRLINE_TIMEOUTS[jetstar]
+    server.AIRLINE_TIMEOUTS[jetstar] = AIRLINE_DELAYS['jetstar'] * pages + SLOWEST_MARGIN * 2
+
+    def pace():
+        sleep(PREWARM_PACE)
+        return PREWARM_PACE
+    executor = ThreadPoolExecutor(max_workers=1)
+    start = time()
+    prewarm = executor.submit(server.prewarm_fares, jetstar, args.month, 'TPE', 'NRT', 'TWD', pace)
+    sleep(PREWARM_PACE / 2)
+    seconds, fares = time_search(server, args.month, [jetstar.value], 1)
+    prices = prewarm.result()
+    results['prewarming'] = {
+        'search_seconds': round(seconds, 3),
+        'prewarm_seconds': round(time() - start, 3),
+        'deadline_seconds': server.AIRLINE_TIMEOUTS[jetstar]
+    }
+    print('jetstar pre-warming', results['prewarming'])
+    assert seconds < results['airlines']['JETSTAR']['seconds'] + SLOWEST_MARGIN, 'the search waited for the pre-warming'
+    assert any(prices) and results['prewarming']['prewarm_seconds'] > server.AIRLINE_TIMEOUTS[jetstar]
+    # With less time than its pages take upstream, the pre-warming gives up on the deadline without fetching them all
+    server.AIRLINE_TIMEOUTS[jetstar] = AIRLINE_DELAYS['jetstar'] * 2
+    start = time()
+    try:
+        server.prewarm_fares(jetstar, args.month, 'TPE', 'NRT', 'TWD', pace)
+    except server.UPSTREAM_FAILURES:
+        # The deadline checked before a page, or the timeout of the page requested last
+        pass
+    else:
+        raise AssertionError('the pre-warming outlived its deadline')
+    print('jetstar pre-warming past its deadline: given up after {0:.3f}s'.format(time() - start))
+    assert time() - start < (AIRLINE_DELAYS['jetstar'] + PREWARM_PACE) * pages
+    server.AIRLINE_TIMEOUTS[jetstar] = jetstar_timeout
+
+    # A hanging airline holds the search up to the global deadline only, and is served its last fares marked stale
+    post_stub('/faults', {'jetstar': 'hang'})
+    server.FETCH_DEADLINE = args.deadline
+    start = time()
+    fares = server.get_fares(args.month, 'TPE', 'NRT', [airline.value for airline in airlines], 'TWD')
+    results['hanging'] = {
+        'seconds': round(time() - start, 3),
+        'answered': [airline.name for airline in airlines if airline not in fares.stale and any(fares.rows[airline])],
+        'stale': [airline.name for airline in fares.stale]
+    }
+    print('jetstar hanging', results['hanging'])
+    assert results['hanging']['seconds'] < args.deadline + SLOWEST_MARGIN
+    assert results['hanging']['answered'] == ['TIGERAIR_TAIWAN', 'VANILLA_AIR'] and results['hanging']['stale'] == ['JETSTAR']
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,261 @@
+import logging
+import argparse
+import queue
+import random
+import sqlite3
+import threading
+import datetime as dt
+from time import time
+
+from migrations import migrate
+
+logger = logging.getLogger('server')
+
+# Observed fares are kept in a database of their own, so that their writes never hold the lock of lcc.db
+HISTORY_DB_PATH = 'history.db'
+# Observations written in one transaction at most, and seconds a partial batch waits for more
+HISTORY_BATCH_SIZE = 5000
+HISTORY_FLUSH_INTERVAL = 2
+# Pages of fares waiting for the writer, the ones beyond it are dropped rather than slowing the requests down
+HISTORY_QUEUE_SIZE = 1000
+# Observations older than these days are downsampled to the lowest price of each day
+HISTORY_RAW_DAYS = 14
+# Days after the travel date that its observations are kept
+HISTORY_RETENTION_DAYS = 365
+# Seconds between two runs of the downsampling and retention job in the writer
+HISTORY_COMPACT_INTERVAL = 3600
+
+HISTORY_MIGRATIONS = [
+    # 1 - Observations clustered by route, airline, travel date and time of observation,
+    # and the time up to which they have been downsampled
+    [
+        '''CREATE TABLE IF NOT EXISTS FareObservation (
+               Origin TEXT NOT NULL,
+               Destination TEXT NOT NULL,
+               AirlineId INTEGER NOT NULL,
+               TravelDate TEXT NOT NULL,
+               ObservedAt INTEGER NOT NULL,
+               Price INTEGER NOT NULL,
+               PRIMARY KEY (Origin, Destination, AirlineId, TravelDate, ObservedAt)) WITHOUT ROWID''',
+        'CREATE TABLE IF NOT EXISTS HistoryCompaction (CompactedUntil INTEGER NOT NULL)',
+        'INSERT INTO HistoryCompaction (CompactedUntil) VALUES (0)'
+    ]
+]
+
+def connect(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA busy_timeout = 5000')
+    return conn
+
+def connect_readonly(db_path):
+    return sqlite3.connect('file:{0}?mode=ro'.format(db_path), uri=True)
+
+def write_observations(conn, rows):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('INSERT OR IGNORE INTO FareObservation VALUES (?, ?, ?, ?, ?, ?)', rows)
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def compact(conn, now=None):
+    # Downsample the observations older than HISTORY_RAW_DAYS that have not been yet,
+    # and drop the ones of travel dates past HISTORY_RETENTION_DAYS
+    now = time() if now is None else now
+    cutoff = int(now - HISTORY_RAW_DAYS * 86400) // 86400 * 86400
+    expired = (dt.date.fromtimestamp(now) - dt.timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        since = conn.execute('SELECT CompactedUntil FROM HistoryCompaction').fetchone()[0]
+        if cutoff > since:
+            conn.execute('''CREATE TEMP TABLE DailyObservation AS
+                            SELECT Origin, Destination, AirlineId, TravelDate, ObservedAt / 86400 * 86400 Day, MIN(Price)
+                            FROM FareObservation
+                            WHERE ObservedAt >= ? AND ObservedAt < ?
+                            GROUP BY Origin, Destination, AirlineId, TravelDate, Day''',
+                         (since, cutoff))
+            conn.execute('DELETE FROM FareObservation WHERE ObservedAt >= ? AND ObservedAt < ?', (since, cutoff))
+            conn.execute('INSERT INTO FareObservation SELECT * FROM temp.DailyObservation')
+            conn.execute('DROP TABLE temp.DailyObservation')
+            conn.execute('UPDATE HistoryCompaction SET CompactedUntil = ?', (cutoff, ))
+        deleted = conn.execute('DELETE FROM FareObservation WHERE TravelDate < ?', (expired, )).rowcount
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+    logger.info('Succeed on compacting the fare history up to {0} and dropping {1} expired observations'.format(
+        dt.datetime.fromtimestamp(cutoff).isoformat(), deleted))
+
+class HistoryWriter:
+    # Observations are queued by the request threads and appended in batches by one thread of its own
+    def __init__(self, db_path=HISTORY_DB_PATH):
+        self.db_path = db_path
+        self.queue = queue.Queue(maxsize=HISTORY_QUEUE_SIZE)
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def record(self, airline_id, origin, destination, fares, observed_at=None):
+        # fares are the {ISO date: price} of one fetched page, days without a fare are not kept
+        observed_at = int(time() if observed_at is None else observed_at)
+        rows = [(origin, destination, airline_id, date, observed_at, int(round(price)))
+                for date, price in fares.items() if price]
+        if not rows:
+            return
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(rows)
+        except queue.Full:
+            self.dropped += len(rows)
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                migrate(self.db_path, HISTORY_MIGRATIONS)
+                self.thread = threading.Thread(target=self.run, name='history-writer', daemon=True)
+                self.thread.start()
+
+    def next_batch(self):
+        # Wait for a first page, then gather more until the batch is full or HISTORY_FLUSH_INTERVAL has passed
+        rows = list(self.queue.get())
+        flush_at = time() + HISTORY_FLUSH_INTERVAL
+        while len(rows) < HISTORY_BATCH_SIZE and time() < flush_at:
+            try:
+                rows.extend(self.queue.get(timeout=max(flush_at - time(), 0)))
+            except queue.Empty:
+                break
+        return rows
+
+    def run(self):
+        conn = connect(self.db_path)
+        compacted_at = 0
+        while True:
+            rows = self.next_batch()
+            try:
+                write_observations(conn, rows)
+                self.written += len(rows)
+            except sqlite3.Error as e:
+                self.failed += len(rows)
+                logger.error('Fail on writing {0} fare observations - {1}'.format(len(rows), repr(e)))
+            if time() - compacted_at >= HISTORY_COMPACT_INTERVAL:
+                compacted_at = time()
+                try:
+                    compact(conn)
+                except sqlite3.Error as e:
+                    logger.error('Fail on compacting the fare history - {0}'.format(repr(e)))
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'queued': self.queue.qsize()
+        }
+
+def get_trend(conn, origin, destination, airline_ids, travel_date, since=0):
+    # Observed prices of one travel date over time, as {airline ID: [[observed time, price], ...]}
+    c = conn.execute('''SELECT AirlineId, ObservedAt, Price FROM FareObservation
+                        WHERE Origin = ? AND Destination = ? AND AirlineId IN ({0}) AND TravelDate = ? AND ObservedAt >= ?
+                        ORDER BY AirlineId, ObservedAt'''.format(','.join('?' * len(airline_ids))),
+                     [origin, destination] + list(airline_ids) + [travel_date, since])
+    trend = {}
+    for airline_id, observed_at, price in c:
+        trend.setdefault(airline_id, []).append([observed_at, price])
+    return trend
+
+def get_cheapest(conn, origin, destination, airline_ids, start, end):
+    # The cheapest price ever observed for each travel date from start to end, with the airline and the time
+    c = conn.execute('''SELECT AirlineId, TravelDate, MIN(Price), ObservedAt FROM FareObservation
+                        WHERE Origin = ? AND Destination = ? AND AirlineId IN ({0}) AND TravelDate BETWEEN ? AND ?
+                        GROUP BY AirlineId, TravelDate'''.format(','.join('?' * len(airline_ids))),
+                     [origin, destination] + list(airline_ids) + [start, end])
+    cheapest = {}
+    for airline_id, travel_date, price, observed_at in c:
+        if travel_date not in cheapest or price < cheapest[travel_date]['price']:
+            cheapest[travel_date] = {
+                'date': travel_date,
+                'airline': airline_id,
+                'price': price,
+                'observedAt': observed_at
+            }
+    return [cheapest[date] for date in sorted(cheapest)]
+
+def get_lowest(conn, origin, start, end):
+    # The lowest price ever observed from origin to each destination for travel dates from start to end
+    c = conn.execute('''SELECT Destination, MIN(Price) FROM FareObservation
+                        WHERE Origin = ? AND TravelDate BETWEEN ? AND ?
+                        GROUP BY Destination''', (origin, start, end))
+    return dict(c.fetchall())
+
+def generate_observations(db_path, routes, days, observations, seed=0):
+    # Synthetic history of routes x days travel dates, observed a number of times each over the last month
+    migrate(db_path, HISTORY_MIGRATIONS)
+    conn = connect(db_path)
+    rng = random.Random(seed)
+    today = dt.date.today()
+    now = int(time())
+    rows = []
+    for idx in range(routes):
+        origin, destination = 'O{0:02}'.format(idx % 100), 'D{0:03}'.format(idx)
+        airline_id = idx % 5 + 1
+        for day in range(days):
+            travel_date = (today + dt.timedelta(days=day)).isoformat()
+            base = rng.randint(1000, 8000)
+            for _ in range(observations):
+                rows.append((origin, destination, airline_id, travel_date, now - rng.randint(0, 30 * 86400),
+                             base + rng.randint(-500, 500)))
+            if len(rows) >= HISTORY_BATCH_SIZE * 10:
+                write_observations(conn, rows)
+                rows = []
+    if rows:
+        write_observations(conn, rows)
+    conn.close()
+
+def benchmark(db_path, queries, seed=0):
+    conn = connect_readonly(db_path)
+    routes = conn.execute('SELECT DISTINCT Origin, Destination, AirlineId FROM FareObservation').fetchall()
+    dates = [row[0] for row in conn.execute('SELECT DISTINCT TravelDate FROM FareObservation WHERE Origin = ? AND Destination = ?',
+                                            routes[0][:2])]
+    rng = random.Random(seed)
+    result = {}
+    for name, query in [
+        ('trend', lambda route: get_trend(conn, route[0], route[1], [route[2]], rng.choice(dates))),
+        ('cheapest', lambda route: get_cheapest(conn, route[0], route[1], [route[2]], dates[0], dates[min(30, len(dates) - 1)]))
+    ]:
+        timings = []
+        for _ in range(queries):
+            route = rng.choice(routes)
+            start = time()
+            query(route)
+            timings.append((time() - start) * 1000)
+        timings.sort()
+        result[name] = {
+            'p50_ms': round(timings[len(timings) // 2], 3),
+            'p99_ms': round(timings[int(len(timings) * 0.99)], 3)
+        }
+    result['observations'] = conn.execute('SELECT COUNT(*) FROM FareObservation').fetchone()[0]
+    conn.close()
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain or benchmark the fare history')
+    parser.add_argument('command', choices=['compact', 'generate', 'benchmark'])
+    parser.add_argument('--db', default=HISTORY_DB_PATH)
+    parser.add_argument('--routes', type=int, default=200)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--observations', type=int, default=30)
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+    if args.command == 'compact':
+        migrate(args.db, HISTORY_MIGRATIONS)
+        compact(connect(args.db))
+    elif args.command == 'generate':
+        generate_observations(args.db, args.routes, args.days, args.observations)
+    else:
+        print(benchmark(args.db, args.queries))
@@ -0,0 +1,47 @@
+import gzip
+
+# Brotli is optional, without it the responses are compressed with gzip only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent as they are, compressing them would save next to nothing
+COMPRESS_MIN_BYTES = 1024
+# Levels of the responses compressed on every request, the catalog ones are compressed once at the highest levels
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Encodings in the order they are preferred when the client accepts several
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip', )
+
+def choose_encoding(accept_encodings, size):
+    # The preferred encoding of the Accept-Encoding header parsed by werkzeug, None to send the body as it is
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    for encoding in ENCODINGS:
+        if accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+def parse_accept_encodings(header):
+    # Qualities of the encodings above in an Accept-Encoding header, for servers without werkzeug such as aservice.py
+    qualities = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0
+        qualities[name] = quality
+    return {encoding: qualities.get(encoding, qualities.get('*', 0)) for encoding in ENCODINGS}
+
+def compress(body, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if best else BROTLI_QUALITY)
+    return gzip.compress(body, 9 if best else GZIP_LEVEL)
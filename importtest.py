@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Import time and RSS of the web processes: service.py and aservice.py are imported in fresh interpreters with
+# python -X importtime, from a directory holding a copy of lcc.db so that the migrations run on the copy. Neither
+# may load the scraping modules of routes.py or the render libraries of old, and routes.py is measured alongside
+SERVING_MODULES = ('service', 'aservice')
+REFERENCE_MODULES = ('routes', )
+FORBIDDEN_MODULES = ('selenium', 'hanziconv', 'bs4', 'pandas', 'altair', 'plotly')
+# Seconds an import of a serving module may take, generous enough for a slow machine
+IMPORT_TIME_BUDGET = 2
+# Peak RSS of a serving process right after the import, in MB, far below the 150 MB of the pandas era
+IMPORT_RSS_BUDGET = 80
+
+CHILD = '''import json, resource, sys
+sys.path.insert(0, {repo!r})
+import {module}
+print(json.dumps({{
+    'loaded': sorted(name for name in {forbidden!r} if name in sys.modules),
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+}}))
+'''
+
+def parse_importtime(stderr, module):
+    # The cumulative microseconds of the module, and the microseconds spent in each module it imported
+    total = None
+    own = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)', line)
+        if match is None:
+            continue
+        own[match.group(4)] = int(match.group(1))
+        # Modules imported at the top level are indented by one space only
+        if match.group(4) == module and len(match.group(3)) == 1:
+            total = int(match.group(2))
+    return total, own
+
+def measure(repo, directory, module):
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              CHILD.format(repo=repo, module=module, forbidden=FORBIDDEN_MODULES)],
+                             cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert process.returncode == 0, process.stderr[-2000:]
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    total, own = parse_importtime(process.stderr, module)
+    result['import_ms'] = total / 1000
+    result['slowest'] = {name: us / 1000 for name, us in sorted(own.items(), key=lambda item: -item[1])[:5]}
+    result['rss_mb'] = result.pop('rss_kb') / 1024
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time, RSS and imported modules of the web processes')
+    parser.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET, help='seconds an import may take')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in SERVING_MODULES + REFERENCE_MODULES:
+        directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(repo, 'lcc.db'), directory)
+        # The first import runs the migrations and builds the caches of the copy, the second one is measured
+        measure(repo, directory, module)
+        results[module] = measure(repo, directory, module)
+        shutil.rmtree(directory)
+        print(module, results[module])
+    for module in SERVING_MODULES:
+        assert not results[module]['loaded'], '{0} loads {1}'.format(module, ', '.join(results[module]['loaded']))
+        assert results[module]['import_ms'] < args.budget * 1000, '{0} takes {1:.0f} ms to import'.format(
+            module, results[module]['import_ms'])
+        assert results[module]['rss_mb'] < IMPORT_RSS_BUDGET, '{0} takes {1:.0f} MB once imported'.format(
+            module, results[module]['rss_mb'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
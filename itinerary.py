@@ -0,0 +1,286 @@
+import datetime as dt
+import heapq
+from collections import defaultdict
+from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import time
+
+from server import Airline, AIRLINE_NAMES, fare_cache, iter_fares
+
+# Only the lowest fare of each day is known, not the flight times, so connections are ruled in days:
+# a connecting leg leaves between MIN_CONNECTION_DAYS and MAX_CONNECTION_DAYS after the previous one
+MIN_CONNECTION_DAYS = 1
+MAX_CONNECTION_DAYS = 2
+MAX_STOPS = 2
+# Days after the end of the month a connecting leg may leave on, for the itineraries leaving on its last days
+CONNECTION_TAIL_DAYS = MAX_STOPS * MAX_CONNECTION_DAYS
+# The part of a leg holding those days, taken from its fares of the next month as cached for the searches of that month
+TAIL = 'tail'
+# Candidates whose legs are fetched together before the bounds are checked again
+ITINERARY_BATCH = 16
+# Legs fetched at the same time
+ITINERARY_CONCURRENCY = 8
+# Parts of legs a search may fetch upstream, those held by the fare cache costing nothing, and seconds it may take.
+# Past either of them the search returns the itineraries found so far, marked as not complete
+ITINERARY_MAX_FETCHES = 200
+ITINERARY_DEADLINE = 15
+
+leg_executor = ThreadPoolExecutor(max_workers=ITINERARY_CONCURRENCY)
+
+class ReachabilityIndex:
+    # Airports reachable from each airport within two flights, with the airports connecting them
+    def __init__(self, catalog):
+        self.version = catalog.version
+        self.airlines = defaultdict(list)
+        self.outbound = defaultdict(set)
+        self.inbound = defaultdict(set)
+        for from_id, edges in catalog.edges.items():
+            for to_id, airline_id in edges:
+                self.airlines[(from_id, to_id)].append(airline_id)
+                self.outbound[from_id].add(to_id)
+                self.inbound[to_id].add(from_id)
+        self.two_hops = {}
+        for from_id, mids in self.outbound.items():
+            vias = defaultdict(set)
+            for mid in mids:
+                for to_id in self.outbound.get(mid, ()):
+                    if to_id != from_id:
+                        vias[to_id].add(mid)
+            self.two_hops[from_id] = vias
+
+    def get_candidates(self, from_id, to_id, max_stops=MAX_STOPS):
+        # Paths of airport IDs from from_id to to_id with up to max_stops stops
+        candidates = []
+        if to_id in self.outbound.get(from_id, ()):
+            candidates.append((from_id, to_id))
+        if max_stops >= 1:
+            for mid in self.two_hops.get(from_id, {}).get(to_id, ()):
+                candidates.append((from_id, mid, to_id))
+        if max_stops >= 2:
+            for mid2 in self.inbound.get(to_id, ()):
+                if mid2 == from_id:
+                    continue
+                for mid1 in self.two_hops.get(from_id, {}).get(mid2, ()):
+                    if mid1 != to_id:
+                        candidates.append((from_id, mid1, mid2, to_id))
+        return candidates
+
+index = None
+
+def get_index(catalog):
+    global index
+    if index is None or index.version != catalog.version:
+        index = ReachabilityIndex(catalog)
+    return index
+
+def get_next_month(month):
+    return (dt.date(int(month[:4]), int(month[5:]), 28) + dt.timedelta(days=4)).strftime('%Y-%m')
+
+def get_cached_bound(origin, destination, airline_ids, month, currency):
+    # The lowest fare of the leg in the month held by the fare cache, 0 when anything is missing as no bound
+    # is known then, infinite when the cached fares have no fare at all. Looked up in memory only, so that
+    # estimating a bound neither reads the table nor counts a hit
+    bound = float('inf')
+    for airline_id in airline_ids:
+        cached = fare_cache.peek_memory((airline_id, origin, destination, month, currency))
+        if cached is None:
+            return 0
+        prices = [price for price in cached if price]
+        if prices:
+            bound = min(bound, min(prices))
+    return bound
+
+def fetch_leg(origin, destination, airline_ids, month, currency):
+    # The cheapest (price, airline name) of each day of the month, None for days without fares
+    num_of_days = monthrange(int(month[:4]), int(month[5:]))[1]
+    days = [None] * num_of_days
+    for airline, prices, stale in iter_fares(month, origin, destination, airline_ids, currency):
+        for idx, price in enumerate(prices):
+            if price and (days[idx] is None or price < days[idx][0]):
+                days[idx] = (price, AIRLINE_NAMES[airline])
+    return days
+
+def price_itinerary(path, legs, num_of_days):
+    # The cheapest itinerary of the path for each departure day of the first num_of_days, as (price, [(leg, day), ...]).
+    # The days of the connecting legs may run past them, into the tail of the next month
+    result = {}
+
+    def extend(leg_idx, day, price, flights):
+        if leg_idx == len(path) - 1:
+            departure = flights[0][1]
+            if departure not in result or price < result[departure][0]:
+                result[departure] = (price, flights)
+            return
+        leg = (path[leg_idx], path[leg_idx + 1])
+        if leg_idx == 0:
+            days = [day]
+        else:
+            days = range(day + MIN_CONNECTION_DAYS, min(day + MAX_CONNECTION_DAYS + 1, len(legs[leg])))
+        for next_day in days:
+            if legs[leg][next_day] is not None:
+                extend(leg_idx + 1, next_day, price + legs[leg][next_day][0], flights + [(leg, next_day)])
+
+    for day in range(num_of_days):
+        extend(0, day, 0, [])
+    return result
+
+def search_itineraries(catalog, from_id, to_id, month, currency, max_stops=MAX_STOPS, deadline=None,
+                       max_fetches=ITINERARY_MAX_FETCHES):
+    # The cheapest direct or connecting itinerary of each departure day of the month
+    reachability = get_index(catalog)
+    codes = {id_: airport[1] for id_, airport in catalog.airports.items()}
+    start = dt.date(int(month[:4]), int(month[5:]), 1)
+    num_of_days = monthrange(start.year, start.month)[1]
+    next_month = get_next_month(month)
+
+    known_airlines = set(airline.value for airline in Airline)
+
+    def get_airline_ids(leg):
+        return [airline_id for airline_id in reachability.airlines[leg] if airline_id in known_airlines]
+
+    def get_part_month(part):
+        return next_month if part == TAIL else month
+
+    # Bounds and fetched days of each part of a leg, the month or its TAIL, the tail of a leg being
+    # bounded by the cached fares of the whole next month until it is fetched
+    bounds = {}
+    parts = {}
+
+    def get_part_bound(leg, part):
+        if (leg, part) not in bounds:
+            airline_ids = get_airline_ids(leg)
+            if not airline_ids:
+                bounds[(leg, part)] = float('inf')
+            else:
+                bounds[(leg, part)] = get_cached_bound(codes[leg[0]], codes[leg[1]], airline_ids, get_part_month(part), currency)
+        return bounds[(leg, part)]
+
+    def get_bound(path):
+        # The first leg leaves in the month, the connecting ones in the month or its tail
+        total = 0
+        for leg_idx, leg in enumerate(zip(path, path[1:])):
+            bound = get_part_bound(leg, month)
+            if leg_idx > 0:
+                bound = min(bound, get_part_bound(leg, TAIL))
+            total += bound
+        return total
+
+    def get_parts(path):
+        for leg_idx, leg in enumerate(zip(path, path[1:])):
+            yield leg, month
+            if leg_idx > 0:
+                yield leg, TAIL
+
+    def get_end_parts(path):
+        # The parts of the first and the last leg, which tell the days a path may serve before the others are fetched
+        yield (path[0], path[1]), month
+        if len(path) > 2:
+            yield (path[-2], path[-1]), month
+            yield (path[-2], path[-1]), TAIL
+
+    def get_days(path):
+        # Departure days the path may serve: days the first leg flies on, with a flight of the last leg
+        # as many connections later as the path has stops
+        days = range(num_of_days)
+        first = (path[0], path[1])
+        if (first, month) in parts:
+            days = [day for day in days if parts[(first, month)][day] is not None]
+        last = (path[-2], path[-1])
+        stops = len(path) - 2
+        if stops and (last, month) in parts and (last, TAIL) in parts:
+            last_days = parts[(last, month)] + parts[(last, TAIL)]
+            days = [day for day in days if any(last_days[last_day] is not None for last_day in range(
+                day + stops * MIN_CONNECTION_DAYS, min(day + stops * MAX_CONNECTION_DAYS + 1, len(last_days))))]
+        return days
+
+    def get_threshold(path):
+        # A path improves no day once its bound reaches the cheapest fare of every day it may serve,
+        # days no path has served yet keeping it in, days it cannot serve leaving it out
+        return max((cheapest[day][0] if day in cheapest else float('inf') for day in get_days(path)), default=float('-inf'))
+
+    def is_cached(leg, part):
+        return all(fare_cache.peek_memory((airline_id, codes[leg[0]], codes[leg[1]], get_part_month(part), currency))
+                   is not None for airline_id in get_airline_ids(leg))
+
+    # Candidates come off the heap cheapest bound first, fewer stops first among equal bounds. A bound only grows as
+    # legs get fetched and the cheapest fare of a day only drops, so a candidate whose bound has grown since it was
+    # pushed goes back in with the new one, and one whose bound reaches the threshold of its days is dropped for good.
+    # The ends of a candidate are fetched before its middle leg, as they often rule out days, if not all of them
+    candidates = reachability.get_candidates(from_id, to_id, max_stops)
+    heap = [(get_bound(path), len(path), path) for path in candidates]
+    heapq.heapify(heap)
+    legs = {}
+    cheapest = {}
+    fetched_legs = 0
+    upstream_legs = 0
+    pruned = 0
+    complete = True
+    while heap:
+        if upstream_legs >= max_fetches or (deadline is not None and time() >= deadline):
+            complete = False
+            break
+        batch = []
+        while heap and len(batch) < ITINERARY_BATCH:
+            bound, length, path = heapq.heappop(heap)
+            if bound >= get_threshold(path):
+                pruned += 1
+                continue
+            current = get_bound(path)
+            if current > bound:
+                heapq.heappush(heap, (current, length, path))
+            else:
+                batch.append(path)
+        if not batch:
+            break
+        missing = set()
+        for path in batch:
+            ends = [part for part in get_end_parts(path) if part not in parts]
+            missing.update(ends if ends else [part for part in get_parts(path) if part not in parts])
+        upstream_legs += sum(1 for leg, part in missing if not is_cached(leg, part))
+        futures = {(leg, part): leg_executor.submit(fetch_leg, codes[leg[0]], codes[leg[1]], get_airline_ids(leg),
+                                                    get_part_month(part), currency)
+                   for leg, part in missing}
+        # Legs still fetched on the deadline are left to fill the fare cache for the next search
+        done, _ = wait(futures.values(), timeout=max(deadline - time(), 0) if deadline is not None else None)
+        for (leg, part), future in futures.items():
+            if future not in done:
+                continue
+            parts[(leg, part)] = future.result()[:CONNECTION_TAIL_DAYS] if part == TAIL else future.result()
+            # The fetched fares are the exact bound of the part, a part without fares rules itself out
+            prices = [day[0] for day in parts[(leg, part)] if day is not None]
+            bounds[(leg, part)] = min(prices) if prices else float('inf')
+        fetched_legs += len(done)
+        for path in batch:
+            if any(part not in parts for part in get_parts(path)):
+                heapq.heappush(heap, (get_bound(path), len(path), path))
+                continue
+            for leg in zip(path, path[1:]):
+                legs[leg] = parts[(leg, month)] + parts.get((leg, TAIL), [])
+            for day, itinerary in price_itinerary(path, legs, num_of_days).items():
+                if day not in cheapest or itinerary[0] < cheapest[day][0]:
+                    cheapest[day] = itinerary
+
+    result = []
+    for day in sorted(cheapest):
+        price, flights = cheapest[day]
+        result.append({
+            'date': (start + dt.timedelta(days=day)).isoformat(),
+            'price': price,
+            'stops': len(flights) - 1,
+            'legs': [{
+                'from': codes[leg[0]],
+                'to': codes[leg[1]],
+                'date': (start + dt.timedelta(days=leg_day)).isoformat(),
+                'airline': legs[leg][leg_day][1],
+                'price': legs[leg][leg_day][0]
+            } for leg, leg_day in flights]
+        })
+    return {
+        'itineraries': result,
+        'candidates': len(candidates),
+        'pruned': pruned,
+        'unexplored': len(heap),
+        'fetchedLegs': fetched_legs,
+        'upstreamLegs': upstream_legs,
+        'complete': complete
+    }
@@ -0,0 +1,154 @@
+import argparse
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from selenium.common.exceptions import WebDriverException
+
+# The Jetstar route discovery of routes.py against local static pages mimicking the Jetstar home page: one with the
+# routes embedded as JSON, read without a browser, and one with the origin and destination panels only, clicked
+# through by a pool of headless browsers, one of them crashing on its second page load to be replaced
+FIXTURE_PORT = 8910
+FIXTURE_ROUTES = {
+    'TPE': ['NRT', 'KIX', 'OKA', 'MEL'],
+    'NRT': ['TPE', 'MEL', 'OOL'],
+    'KIX': ['TPE', 'OKA'],
+    'OKA': ['TPE', 'KIX'],
+    'MEL': ['NRT', 'TPE', 'SYD', 'OOL'],
+    'SYD': ['MEL'],
+    'OOL': ['NRT', 'MEL']
+}
+
+# Buttons of the origin panel pick the origin and fill the destination panel, buttons of the destination panel
+# change the URL to the search of the route, as the clicks on the Jetstar home page do
+PANEL_PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Jetstar</title></head>
+<body>
+<button data-direction-id="origin" aria-expanded="false">From</button>
+<div id="origin-panel01" hidden></div>
+<button data-direction-id="destination" aria-expanded="false">To</button>
+<div id="destination-panel01" hidden></div>
+<script>
+var routes = {routes};
+var origin = null;
+function buttons(panel, codes, onclick) {{
+    panel.innerHTML = '';
+    codes.forEach(function (code) {{
+        var button = document.createElement('button');
+        button.setAttribute('data-value', code);
+        button.textContent = code;
+        button.onclick = function () {{ onclick(code); }};
+        panel.appendChild(button);
+    }});
+}}
+document.querySelector('button[data-direction-id = origin]').onclick = function () {{
+    this.setAttribute('aria-expanded', 'true');
+    document.getElementById('origin-panel01').hidden = false;
+}};
+buttons(document.getElementById('origin-panel01'), Object.keys(routes), function (code) {{
+    origin = code;
+    buttons(document.getElementById('destination-panel01'), routes[code], function (destination) {{
+        history.pushState(null, '', '?origin=' + origin + '&destination=' + destination);
+    }});
+}});
+document.querySelector('button[data-direction-id = destination]').onclick = function () {{
+    // The panel opens a moment later, as it does on the site
+    var button = this;
+    setTimeout(function () {{
+        button.setAttribute('aria-expanded', 'true');
+        document.getElementById('destination-panel01').hidden = false;
+    }}, 100);
+}};
+</script>
+</body></html>'''
+
+# Scripts that are no route data, or carry codes that are not IATA ones, are skipped
+EMBEDDED_PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Jetstar</title>
+<script type="application/json">{{"culture": "zh-TW"}}</script>
+<script type="application/json">not JSON</script>
+<script type="application/json">{{"routes": {routes}}}</script>
+<script type="application/json">{{"routes": {{"tpe": ["nrt"], "TPE": ["NRT", 42]}}}}</script>
+</head><body><button data-direction-id="origin">From</button></body></html>'''
+
+PAGES = {
+    '/panels': PANEL_PAGE.format(routes=json.dumps(FIXTURE_ROUTES)),
+    '/embedded': EMBEDDED_PAGE.format(routes=json.dumps(FIXTURE_ROUTES))
+}
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGES.get(self.path.split('?')[0])
+        if body is None:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FixtureServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class CrashingDriver:
+    # A browser session failing on its second page load, the first origin it discovers, as a crashed Chrome does
+    def __init__(self, driver):
+        self.driver = driver
+        self.loads = 0
+
+    def get(self, url):
+        self.loads += 1
+        if self.loads == 2:
+            raise WebDriverException('chrome not reachable')
+        return self.driver.get(url)
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+def get_expected_pairs():
+    return set((origin, destination) for origin, destinations in FIXTURE_ROUTES.items() for destination in destinations)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the Jetstar route discovery against local static pages')
+    parser.add_argument('--pool-size', type=int, default=3)
+    args = parser.parse_args()
+
+    fixture_server = FixtureServer(('127.0.0.1', FIXTURE_PORT), FixtureHandler)
+    threading.Thread(target=fixture_server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{0}'.format(FIXTURE_PORT)
+    import routes
+    from server import Airline
+    expected = get_expected_pairs()
+
+    # The embedded routes come through the regular source of the airline, without a browser
+    routes.JETSTAR_HOME_URL = base_url + '/embedded'
+    content_hash, etag, last_modified, pairs = routes.fetch_routes(Airline.JETSTAR)
+    assert pairs == expected, pairs ^ expected
+    assert routes.get_jetstar_embedded_routes(PAGES['/panels']) == set()
+    print('embedded routes: {0} pairs'.format(len(pairs)))
+
+    # The panels are clicked through by a pool of browsers, the first session crashing and being replaced
+    created = []
+
+    def factory():
+        driver = routes.create_driver()
+        created.append(driver)
+        return CrashingDriver(driver) if len(created) == 1 else driver
+    try:
+        pairs = routes.get_jetstar_panel_routes(base_url + '/panels', args.pool_size, factory)
+    except WebDriverException as e:
+        if created:
+            raise
+        # e.g. no Chrome or chromedriver on this machine
+        print('panel routes: skipped, no browser could be started - {0}'.format(repr(e)))
+    else:
+        assert pairs == expected, pairs ^ expected
+        assert len(created) <= args.pool_size + 1, len(created)
+        print('panel routes: {0} pairs with {1} browser sessions, one of them replaced'.format(len(pairs), len(created)))
+    fixture_server.shutdown()
@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+from time import time
+
+# Fetch jobs of (airline ID, origin, destination, month, currency), queued by the services and run by worker.py.
+# Their prices are shared through the FareCache table, the queue only tells the state of each job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+# Seconds between two looks at the queue of an idle worker, or at the state of a job being waited for
+JOB_POLL_INTERVAL = 0.05
+# Seconds a worker may hold a job before it is handed to another one, longer than any of AIRLINE_TIMEOUTS
+JOB_LEASE = 60
+# Claims of a job whose workers disappeared before it is failed
+JOB_MAX_ATTEMPTS = 3
+# Seconds finished jobs are kept
+JOB_RETENTION = 3600
+
+class SQLiteJobQueue:
+    # Jobs in the FetchJob table of db_path, created by migrations.py. A job of a key is queued or running
+    # at most once, the services asking for the same key share it
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+    def put(self, key):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('''SELECT Id FROM FetchJob
+                                  WHERE AirlineId = ? AND Origin = ? AND Destination = ? AND Month = ? AND Currency = ?
+                                  AND State IN (?, ?)''', key + (QUEUED, RUNNING)).fetchone()
+            if row is None:
+                job_id = conn.execute('''INSERT INTO FetchJob (AirlineId, Origin, Destination, Month, Currency, State, EnqueuedAt)
+                                         VALUES (?, ?, ?, ?, ?, ?, ?)''', key + (QUEUED, time())).lastrowid
+            else:
+                job_id = row[0]
+            conn.execute('COMMIT')
+            return job_id
+        finally:
+            conn.close()
+
+    def claim(self, airline_ids, worker):
+        # The oldest queued job of the airlines, or a running one whose worker has let its lease expire,
+        # as (job ID, key) or None
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('''SELECT Id, AirlineId, Origin, Destination, Month, Currency, Attempts FROM FetchJob
+                                  WHERE AirlineId IN ({0}) AND (State = ? OR (State = ? AND ClaimedAt < ?))
+                                  ORDER BY Id LIMIT 1'''.format(','.join('?' * len(airline_ids))),
+                               list(airline_ids) + [QUEUED, RUNNING, time() - JOB_LEASE]).fetchone()
+            job = None
+            if row is not None and row[6] >= JOB_MAX_ATTEMPTS:
+                conn.execute('UPDATE FetchJob SET State = ?, Error = ?, FinishedAt = ? WHERE Id = ?',
+                             (FAILED, 'abandoned by its workers', time(), row[0]))
+            elif row is not None:
+                conn.execute('UPDATE FetchJob SET State = ?, ClaimedBy = ?, ClaimedAt = ?, Attempts = Attempts + 1 WHERE Id = ?',
+                             (RUNNING, worker, time(), row[0]))
+                job = row[0], tuple(row[1:6])
+            conn.execute('COMMIT')
+            return job
+        finally:
+            conn.close()
+
+    def finish(self, job_id, error=None):
+        conn = self.connect()
+        try:
+            conn.execute('UPDATE FetchJob SET State = ?, Error = ?, FinishedAt = ? WHERE Id = ?',
+                         (DONE if error is None else FAILED, error, time(), job_id))
+        finally:
+            conn.close()
+
+    def get_state(self, job_id):
+        # (state, error) of the job, None when it has been purged
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT State, Error FROM FetchJob WHERE Id = ?', (job_id, )).fetchone()
+        finally:
+            conn.close()
+
+    def purge(self, before):
+        conn = self.connect()
+        try:
+            return conn.execute('DELETE FROM FetchJob WHERE State IN (?, ?) AND FinishedAt < ?', (DONE, FAILED, before)).rowcount
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self.connect()
+        try:
+            counts = dict(conn.execute('SELECT State, COUNT(*) FROM FetchJob GROUP BY State'))
+        finally:
+            conn.close()
+        return {state: counts.get(state, 0) for state in (QUEUED, RUNNING, DONE, FAILED)}
+
+class FileJobQueue:
+    # Jobs as JSON files moved between a directory for each state. A rename is atomic, so of the workers
+    # renaming the same queued file only one claims it. The job ID is the file name, made of the key
+    def __init__(self, directory):
+        self.directory = directory
+        for state in (QUEUED, RUNNING, DONE, FAILED):
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def get_path(self, state, job_id):
+        return os.path.join(self.directory, state, job_id)
+
+    def put(self, key):
+        job_id = '-'.join(str(part) for part in key) + '.json'
+        if os.path.exists(self.get_path(RUNNING, job_id)):
+            return job_id
+        try:
+            with open(self.get_path(QUEUED, job_id), 'x', encoding='utf-8') as f:
+                json.dump({'key': key, 'attempts': 0, 'enqueued_at': time()}, f)
+        except FileExistsError:
+            pass
+        return job_id
+
+    def claim(self, airline_ids, worker):
+        self.requeue_expired()
+        prefixes = tuple('{0}-'.format(airline_id) for airline_id in airline_ids)
+        entries = [entry for entry in os.scandir(os.path.join(self.directory, QUEUED)) if entry.name.startswith(prefixes)]
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            running = self.get_path(RUNNING, entry.name)
+            try:
+                os.rename(entry.path, running)
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime
+                continue
+            with open(running, encoding='utf-8') as f:
+                job = json.load(f)
+            job['attempts'] += 1
+            job['claimed_by'] = worker
+            if job['attempts'] > JOB_MAX_ATTEMPTS:
+                job['error'] = 'abandoned by its workers'
+                self.move(running, FAILED, job)
+                continue
+            # Writing the file sets its modification time, which starts the lease
+            with open(running, 'w', encoding='utf-8') as f:
+                json.dump(job, f)
+            return entry.name, tuple(job['key'])
+        return None
+
+    def requeue_expired(self):
+        for entry in os.scandir(os.path.join(self.directory, RUNNING)):
+            try:
+                if entry.stat().st_mtime < time() - JOB_LEASE:
+                    os.rename(entry.path, self.get_path(QUEUED, entry.name))
+            except FileNotFoundError:
+                continue
+
+    def move(self, path, state, job):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(path, self.get_path(state, os.path.basename(path)))
+        # An earlier job of the same key has finished the other way
+        other = self.get_path(FAILED if state == DONE else DONE, os.path.basename(path))
+        if os.path.exists(other):
+            os.remove(other)
+
+    def finish(self, job_id, error=None):
+        path = self.get_path(RUNNING, job_id)
+        with open(path, encoding='utf-8') as f:
+            job = json.load(f)
+        job['error'] = error
+        self.move(path, DONE if error is None else FAILED, job)
+
+    def get_state(self, job_id):
+        for state in (QUEUED, RUNNING, DONE, FAILED):
+            path = self.get_path(state, job_id)
+            if os.path.exists(path):
+                if state != FAILED:
+                    return state, None
+                with open(path, encoding='utf-8') as f:
+                    return state, json.load(f).get('error')
+        return None
+
+    def purge(self, before):
+        purged = 0
+        for state in (DONE, FAILED):
+            for entry in os.scandir(os.path.join(self.directory, state)):
+                if entry.stat().st_mtime < before:
+                    os.remove(entry.path)
+                    purged += 1
+        return purged
+
+    def stats(self):
+        return {state: len(os.listdir(os.path.join(self.directory, state))) for state in (QUEUED, RUNNING, DONE, FAILED)}
+
+JOB_QUEUE_BACKENDS = {
+    'sqlite': SQLiteJobQueue,
+    'filesystem': FileJobQueue
+}
+
+def create_queue(backend, path):
+    # path is the database of the sqlite backend, or the directory of the filesystem one
+    return JOB_QUEUE_BACKENDS[backend](path)
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import datetime as dt
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+from time import time, sleep
+
+import aiohttp
+from aiohttp import web
+
+# Load test of the threaded service.py against the async aservice.py, both fetching from stubbed airline endpoints
+# answering after a fixed latency, with the fare cache switched off so that every search goes upstream
+# Each stubbed airline answers on a loopback address of its own, as each airline has a host of its own
+STUB_HOSTS = {
+    'tigerair': '127.0.0.2',
+    'vanilla': '127.0.0.3',
+    'jetstar': '127.0.0.4'
+}
+STUB_PORT = 8901
+SYNC_PORT = 8902
+ASYNC_PORT = 8903
+# Search endpoints put under load, /data/stream being the one the search page of templates/index.html calls
+LOAD_ENDPOINTS = ('/data', '/data/stream')
+
+def get_window(params, date_param, half_width):
+    center = dt.datetime.strptime(params[date_param], '%Y-%m-%d').date()
+    return [(center + dt.timedelta(days=i)).isoformat() for i in range(-half_width, half_width + 1)]
+
+# Seconds a hanging stub takes to answer, longer than any timeout of the fetchers
+STUB_HANG = 60
+
+def create_stub_app(latency):
+    # Faults are set by POST /faults with a form of {airline: 'ok' | 'error' | 'hang' | 'throttle' | 'garbage'}, as used
+    # by faulttest.py, 'garbage' answering 200 with a page of no fares as a site of a new layout would,
+    # the lowest fare of destinations by POST /fares with a form of {destination code: price}, as used by exploretest.py,
+    # and the latency of airlines by POST /delays with a form of {airline: seconds}, as used by fetchtest.py.
+    # GET /counts gives the number of requests answered on each path so far, as used by rangetest.py,
+    # and POST /gaps with a form of {ISO date: '1'} makes those days without any fare, as past days or days without
+    # flights, in place of the days of the last POST
+    faults = {}
+    lowest = {}
+    delays = {}
+    counts = {}
+    gaps = {}
+
+    @web.middleware
+    async def count_requests(request, handler):
+        counts[request.path] = counts.get(request.path, 0) + 1
+        return await handler(request)
+
+    async def answer(name):
+        await asyncio.sleep(STUB_HANG if faults.get(name) == 'hang' else float(delays.get(name, latency)))
+        if faults.get(name) == 'error':
+            raise web.HTTPServiceUnavailable()
+        if faults.get(name) == 'throttle':
+            raise web.HTTPTooManyRequests()
+        if faults.get(name) == 'garbage':
+            raise web.HTTPOk(text='<html><body>Down for maintenance</body></html>', content_type='text/html')
+
+    def get_price(destination):
+        low = int(lowest.get(destination, 1000))
+        return random.randint(low, low + 8000)
+
+    async def set_faults(request):
+        faults.update(await request.post())
+        return web.json_response(faults)
+
+    async def set_fares(request):
+        lowest.update(await request.post())
+        return web.json_response(lowest)
+
+    async def set_delays(request):
+        delays.update(await request.post())
+        return web.json_response(delays)
+
+    async def set_gaps(request):
+        gaps.clear()
+        gaps.update(await request.post())
+        return web.json_response(gaps)
+
+    async def get_counts(request):
+        return web.json_response(counts)
+
+    async def tigerair_taiwan(request):
+        await answer('tigerair')
+        dates = get_window(request.query, 'departureDate', int(request.query['daysBeforeAndAfter']))
+        return web.json_response({'journeyDateMarkets': [{'lowFares': {'lowestFares': [
+            {'date': date + 'T00:00:00', 'price': get_price(request.query['destinationStation'])} for date in dates
+            if date not in gaps]}}]})
+
+    async def vanilla_air_routes(request):
+        await answer('vanilla')
+        return web.json_response({'Result': []})
+
+    async def vanilla_air_fares(request):
+        await answer('vanilla')
+        month = request.query['targetMonth']
+        start = dt.date(int(month[:4]), int(month[4:]), 1)
+        dates = [(start + dt.timedelta(days=i)).isoformat() for i in range(28)]
+        return web.json_response({'Result': [{'FareListOfDay': {date: {'LowestFare': get_price(request.query['destination'])}
+                                                                for date in dates if date not in gaps}}]})
+
+    async def jetstar(request):
+        await answer('jetstar')
+        items = ''.join('<li class="date-selector__option" data-lowfare="?departuredate1={0}">'
+                        '<span data-amount="1">{1}</span></li>'.format(date, get_price(request.query['destination1']))
+                        for date in get_window(request.query, 'departuredate1', 3) if date not in gaps)
+        return web.Response(text='<ul>' + items + '</ul>', content_type='text/html')
+
+    app = web.Application(middlewares=[count_requests])
+    app.router.add_get('/tigerair', tigerair_taiwan)
+    app.router.add_get('/vanilla/routes', vanilla_air_routes)
+    app.router.add_get('/vanilla/fares', vanilla_air_fares)
+    app.router.add_get('/jetstar', jetstar)
+    app.router.add_post('/faults', set_faults)
+    app.router.add_post('/fares', set_fares)
+    app.router.add_post('/delays', set_delays)
+    app.router.add_post('/gaps', set_gaps)
+    app.router.add_get('/counts', get_counts)
+    return app
+
+def run_stub(latency):
+    web.run_app(create_stub_app(latency), host=list(STUB_HOSTS.values()), port=STUB_PORT, print=None)
+
+def configure(directory):
+    # Point the fetchers at the stub, and keep the fare cache and history out of the way
+    import server
+    stubs = {name: 'http://{0}:{1}'.format(host, STUB_PORT) for name, host in STUB_HOSTS.items()}
+    server.TIGERAIR_TAIWAN_URL = stubs['tigerair'] + '/tigerair'
+    server.VANILLA_AIR_ROUTES_URL = stubs['vanilla'] + '/vanilla/routes'
+    server.VANILLA_AIR_FARES_URL = stubs['vanilla'] + '/vanilla/fares'
+    server.JETSTAR_URL = stubs['jetstar'] + '/jetstar'
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 0
+    server.fare_cache.db_path = None
+    server.fare_history.db_path = os.path.join(directory, 'history.db')
+
+def run_sync_service(directory):
+    configure(directory)
+    from werkzeug.serving import make_server
+    from service import app
+    make_server('127.0.0.1', SYNC_PORT, app, threaded=True).serve_forever()
+
+def run_async_service(directory):
+    configure(directory)
+    import aservice
+    web.run_app(aservice.create_app(), host='127.0.0.1', port=ASYNC_PORT, print=None)
+
+def wait_for_port(port, host='127.0.0.1', timeout=30):
+    until = time() + timeout
+    while time() < until:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.2)
+    raise RuntimeError('nothing listening on port {0}'.format(port))
+
+async def run_load(url, forms, requests, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency),
+                                     timeout=aiohttp.ClientTimeout(total=120)) as client:
+        async def search(form):
+            async with semaphore:
+                start = time()
+                async with client.post(url, data=form) as response:
+                    await response.read()
+                    response.raise_for_status()
+                latencies.append(time() - start)
+
+        start = time()
+        await asyncio.gather(*[search(forms[i % len(forms)]) for i in range(requests)])
+        elapsed = time() - start
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 1),
+        'requests_per_second': round(requests / elapsed, 1)
+    }
+
+async def check_page(url, form):
+    # The page and the calls it makes answer in both modes, the stream ending with the line of the table
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as client:
+        async with client.get(url + '/') as response:
+            assert response.status == 200, (url, response.status)
+            assert '/data/stream' in await response.text()
+        # The airport selects and the airline options fill in through GET requests
+        for url_path, query in [('/airport_codes', {'id': 'ALL'}), ('/airport_codes', {'id': form['fromId']}),
+                                ('/airlines', {'fromId': form['fromId'], 'toId': form['toId']})]:
+            async with client.get(url + url_path, params=query) as response:
+                assert response.status == 200, (url, url_path, response.status)
+                assert await response.json(), (url, url_path)
+        async with client.post(url + '/data/stream', data=form) as response:
+            assert response.status == 200, (url, response.status)
+            assert response.content_type == 'application/x-ndjson', response.content_type
+            lines = [json.loads(line) for line in (await response.text()).splitlines()]
+        assert [line.get('airline') for line in lines[:-1]] and 'table' in lines[-1], lines
+
+def get_route_forms(db_path, month, months):
+    # A Tigerair Taiwan route of the database, searched for the three airlines with a fetcher over distinct months,
+    # so that the searches in flight never share an upstream fetch
+    conn = sqlite3.connect(db_path)
+    from_id, to_id = conn.execute('''SELECT r.FromAirportId, r.ToAirportId FROM Route r
+                                     JOIN Airport a ON r.FromAirportId = a.Id
+                                     WHERE r.AirlineId = 1 AND r.IsActive = 1 AND a.CountryId IS NOT NULL
+                                     LIMIT 1''').fetchone()
+    conn.close()
+    start = dt.datetime.strptime(month + '-01', '%Y-%m-%d').date()
+    return [{
+        'fromId': str(from_id),
+        'toId': str(to_id),
+        'month': '{0}-{1:02}'.format(start.year + (start.month - 1 + i) // 12, (start.month - 1 + i) % 12 + 1),
+        'airlines': '1,2,5'
+    } for i in range(months)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the latency and throughput of service.py and aservice.py')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds the stubbed airlines take to answer')
+    parser.add_argument('--month', default=dt.date.today().strftime('%Y-%m'))
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    forms = get_route_forms('lcc.db', args.month, args.concurrency * 2)
+    directory = tempfile.mkdtemp()
+    stub = multiprocessing.Process(target=run_stub, args=(args.latency, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    results = {}
+    for mode, target, port in [('sync', run_sync_service, SYNC_PORT), ('async', run_async_service, ASYNC_PORT)]:
+        process = multiprocessing.Process(target=target, args=(directory, ), daemon=True)
+        process.start()
+        try:
+            wait_for_port(port)
+            url = 'http://127.0.0.1:{0}'.format(port)
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(check_page(url, forms[0]))
+            results[mode] = {endpoint: loop.run_until_complete(run_load(url + endpoint, forms, args.requests, args.concurrency))
+                             for endpoint in LOAD_ENDPOINTS}
+            loop.close()
+        finally:
+            process.terminate()
+            process.join()
+        for endpoint in LOAD_ENDPOINTS:
+            print(mode, endpoint, results[mode][endpoint])
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,140 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# Metrics in the Prometheus text format, kept in process without any client library.
+# Switched off, timers and counters cost one flag check, which is what the benchmark of benchmark.py compares against
+METRICS_ENABLED = True
+# Upper bounds of the buckets of the timing histograms in seconds, and of the size histograms in bytes
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Requests carrying this header collect trace spans, returned in the Server-Timing header of the response
+TRACE_HEADER = 'X-Trace'
+
+registry = []
+# Spans of the request being traced, None when it is not. Python 3.6 takes contextvars from its backport in
+# requirements.txt, whose contexts are per thread only, so aservice.py traces nothing there
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('"', '\\"')) for name, value in zip(names, values)) + '}'
+
+def format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} counter'.format(self.name)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('{0}{1} {2}'.format(self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # Labels to [count of each bucket..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[idx] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} histogram'.format(self.name)]
+        names = self.label_names + ('le', )
+        with self.lock:
+            for labels, series in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'), ), series[:len(self.buckets)] + [None]):
+                    cumulative = series[-1] if count is None else cumulative + count
+                    lines.append('{0}_bucket{1} {2}'.format(self.name, format_labels(names, labels + (format_value(bound), )), cumulative))
+                lines.append('{0}_sum{1} {2}'.format(self.name, format_labels(self.label_names, labels), format_value(series[-2])))
+                lines.append('{0}_count{1} {2}'.format(self.name, format_labels(self.label_names, labels), series[-1]))
+        return lines
+
+class Gauge:
+    # Values read from collect() when the metrics are rendered, e.g. the counters kept by FareCache
+    def __init__(self, name, help_text, collect, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+        self.label_names = label_names
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help_text), '# TYPE {0} gauge'.format(self.name)]
+        for labels, value in sorted(self.collect().items()):
+            lines.append('{0}{1} {2}'.format(self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+def render():
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+@contextmanager
+def timer(histogram, *labels):
+    # Observe the seconds taken by the block, and add them as a span when the request is traced
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        histogram.observe(elapsed, *labels)
+        spans = current_trace.get()
+        if spans is not None:
+            spans.append((histogram.name, labels, elapsed))
+
+def start_trace(enabled=True):
+    # Start the trace of a request, or make sure a thread reused from an earlier request does not keep tracing
+    spans = [] if enabled else None
+    current_trace.set(spans)
+    return spans
+
+def stop_trace():
+    spans = current_trace.get()
+    current_trace.set(None)
+    return spans
+
+def format_server_timing(spans):
+    # Server-Timing header of the spans, in the order they ended
+    return ', '.join('{0};desc="{1}";dur={2:.2f}'.format(name, ' '.join(str(label) for label in labels), elapsed * 1000)
+                     for name, labels, elapsed in spans)
+
+def submit(executor, fn, *args):
+    # Submit to a pool of threads keeping the trace of the caller, so that spans in the pool land in its request
+    return executor.submit(contextvars.copy_context().run, fn, *args)
@@ -0,0 +1,129 @@
+import logging
+import sqlite3
+
+logger = logging.getLogger('server')
+
+# Each list of statements upgrades the schema by one version, the version applied last is kept in PRAGMA user_version.
+# Never edit a migration that has been released, append a new one instead.
+MIGRATIONS = [
+    # 1 - Indexes for the route lookups of service.py and server.get_routes, and a unique route key
+    [
+        '''DELETE FROM Route WHERE Id NOT IN (SELECT MIN(Id) FROM Route
+                                             GROUP BY AirlineId, FromAirportId, ToAirportId)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS RouteKeyIdx ON Route (AirlineId, FromAirportId, ToAirportId)',
+        'CREATE INDEX IF NOT EXISTS RouteFromToIdx ON Route (FromAirportId, ToAirportId, IsActive, AirlineId)'
+    ],
+    # 2 - Persistent tier of the fare cache
+    [
+        '''CREATE TABLE IF NOT EXISTS FareCache (
+               AirlineId INTEGER NOT NULL,
+               Origin TEXT NOT NULL,
+               Destination TEXT NOT NULL,
+               Month TEXT NOT NULL,
+               Currency TEXT NOT NULL,
+               Data TEXT NOT NULL,
+               FetchedAt REAL NOT NULL,
+               PRIMARY KEY (AirlineId, Origin, Destination, Month, Currency))'''
+    ],
+    # 3 - Version of the airport and route data, bumped by server.get_routes so that catalog.py reloads
+    [
+        'CREATE TABLE IF NOT EXISTS Catalog (Version INTEGER NOT NULL)',
+        'INSERT INTO Catalog (Version) VALUES (1)'
+    ],
+    # 4 - Search history read by prewarm.py, and the flag of fares cached by it
+    [
+        '''CREATE TABLE IF NOT EXISTS SearchHistory (
+               Id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+               FromAirportId INTEGER NOT NULL,
+               ToAirportId INTEGER NOT NULL,
+               Month TEXT NOT NULL,
+               AirlineId INTEGER NOT NULL,
+               SearchedAt REAL NOT NULL)''',
+        'CREATE INDEX IF NOT EXISTS SearchHistorySearchedAtIdx ON SearchHistory (SearchedAt)',
+        'ALTER TABLE FareCache ADD COLUMN Prewarmed INTEGER NOT NULL DEFAULT 0'
+    ],
+    # 5 - Time of the last metadata lookup of airports and countries, read by enrichment.py
+    [
+        'ALTER TABLE Airport ADD COLUMN MetadataUpdatedAt REAL',
+        'ALTER TABLE Country ADD COLUMN MetadataUpdatedAt REAL'
+    ],
+    # 6 - Cached fares are kept as the bytes of price arrays instead of JSON, the old ones are dropped
+    [
+        'DELETE FROM FareCache'
+    ],
+    # 7 - Content hash and HTTP validators of the route source of each airline, read by routes.get_routes
+    [
+        '''CREATE TABLE IF NOT EXISTS RouteSource (
+               AirlineId INTEGER NOT NULL PRIMARY KEY,
+               ContentHash TEXT NOT NULL,
+               ETag TEXT,
+               LastModified TEXT,
+               CheckedAt REAL NOT NULL)'''
+    ],
+    # 8 - Queue of the fetch jobs of jobqueue.py, a key queued or running at most once
+    [
+        '''CREATE TABLE IF NOT EXISTS FetchJob (
+               Id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+               AirlineId INTEGER NOT NULL,
+               Origin TEXT NOT NULL,
+               Destination TEXT NOT NULL,
+               Month TEXT NOT NULL,
+               Currency TEXT NOT NULL,
+               State TEXT NOT NULL,
+               Attempts INTEGER NOT NULL DEFAULT 0,
+               ClaimedBy TEXT,
+               ClaimedAt REAL,
+               EnqueuedAt REAL NOT NULL,
+               FinishedAt REAL,
+               Error TEXT)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS FetchJobPendingIdx ON FetchJob (AirlineId, Origin, Destination, Month, Currency)
+               WHERE State IN ('queued', 'running')''',
+        'CREATE INDEX IF NOT EXISTS FetchJobStateIdx ON FetchJob (State, AirlineId, Id)'
+    ],
+    # 9 - Price watches of watch.py, Airlines being the comma-separated IDs as in the search form,
+    # and the price last notified so that a watch is not notified again until it drops further
+    [
+        '''CREATE TABLE IF NOT EXISTS Watch (
+               Id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+               FromAirportId INTEGER NOT NULL,
+               ToAirportId INTEGER NOT NULL,
+               Month TEXT NOT NULL,
+               Airlines TEXT NOT NULL,
+               Threshold INTEGER NOT NULL,
+               CreatedAt REAL NOT NULL,
+               NotifiedPrice INTEGER,
+               NotifiedAt REAL,
+               IsActive INTEGER NOT NULL DEFAULT 1)''',
+        'CREATE INDEX IF NOT EXISTS WatchActiveIdx ON Watch (IsActive, Month, FromAirportId, ToAirportId)'
+    ],
+    # 10 - Time of the last change of the airport and route data, the Last-Modified of the catalog responses
+    [
+        'ALTER TABLE Catalog ADD COLUMN UpdatedAt REAL',
+        "UPDATE Catalog SET UpdatedAt = CAST(strftime('%s', 'now') AS REAL)"
+    ],
+    # 11 - Of duplicate routes, migration 1 kept the first one, inactive even when a later one was active. The route
+    # sources are forgotten, so that the next run of routes.py diffs every airline and switches such routes back on
+    [
+        'DELETE FROM RouteSource'
+    ]
+]
+
+def migrate(db_path, migrations=MIGRATIONS):
+    # Other databases, e.g. the one of history.py, bring their own list of migrations
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for idx in range(version, len(migrations)):
+            # Apply the statements and bump the version in one transaction, so a failed migration leaves nothing behind
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in migrations[idx]:
+                    conn.execute(statement)
+                conn.execute('PRAGMA user_version = {0}'.format(idx + 1))
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            logger.info('Succeed on migrating the database {0} to version {1}'.format(db_path, idx + 1))
+    finally:
+        conn.close()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+
+from migrations import MIGRATIONS, migrate
+
+# Query plans of the route lookups on a migrated copy of lcc.db: each of them has to search Route through one of the
+# indexes of migration 1, never scan the table. Duplicate routes made up in the copy check which one migration 1 keeps,
+# and a route source recorded before migration 11 checks that the next routes.py run diffs every airline again
+HOT_QUERIES = [
+    ('/airport_codes', '''SELECT DISTINCT a.Id, a.Code, a.Name, IFNULL(c.Name, "Other") CountryName FROM Route r
+                          JOIN Airport a ON r.ToAirportId = a.Id
+                          JOIN Country c ON a.CountryId = c.Id
+                          WHERE r.FromAirportId = ? AND r.IsActive = 1''', (1, ), 'RouteFromToIdx'),
+    ('/airlines', '''SELECT a.Id, a.Name FROM Airline a
+                     JOIN Route r ON a.Id = r.AirlineId
+                     WHERE r.FromAirportId = ? AND r.ToAirportId = ? AND r.IsActive = 1''', (1, 2), 'RouteFromToIdx'),
+    ('routes.apply_route_diff', '''UPDATE Route SET IsActive = 0
+                                   WHERE AirlineId = ? AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
+                                   AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''', (1, 'TPE', 'NRT'), 'RouteKeyIdx'),
+    ('prewarm.get_hot_searches', '''SELECT h.AirlineId, COUNT(*) FROM SearchHistory h
+                                    JOIN Route r ON r.AirlineId = h.AirlineId AND r.FromAirportId = h.FromAirportId
+                                                 AND r.ToAirportId = h.ToAirportId AND r.IsActive = 1
+                                    WHERE h.SearchedAt >= ?
+                                    GROUP BY h.AirlineId, h.FromAirportId, h.ToAirportId''', (0, ), None)
+]
+
+def get_route_plan(conn, sql, params):
+    # The steps of the plan that read Route, whatever alias the query gives it
+    plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+    return [detail for detail in plan if re.match(r'(SCAN|SEARCH)( TABLE)? (Route|r)\b', detail)]
+
+def check_plans(conn):
+    for name, sql, params, index in HOT_QUERIES:
+        steps = get_route_plan(conn, sql, params)
+        print(name, steps)
+        assert steps, 'no step of the plan of {0} reads Route'.format(name)
+        for step in steps:
+            assert step.startswith('SEARCH') and 'INDEX' in step, 'the plan of {0} scans Route - {1}'.format(name, step)
+            assert index is None or index in step, 'the plan of {0} does not use {1} - {2}'.format(name, index, step)
+
+def add_duplicates(conn):
+    # An inactive route with an active duplicate added after it, and an inactive route duplicated by an inactive one
+    active_key = conn.execute('SELECT Id, AirlineId, FromAirportId, ToAirportId FROM Route WHERE IsActive = 1 ORDER BY Id LIMIT 1').fetchone()
+    inactive_key = conn.execute('SELECT Id, AirlineId, FromAirportId, ToAirportId FROM Route WHERE IsActive = 1 ORDER BY Id LIMIT 1 OFFSET 1').fetchone()
+    conn.execute('UPDATE Route SET IsActive = 0 WHERE Id IN (?, ?)', (active_key[0], inactive_key[0]))
+    conn.execute('INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive) VALUES (?, ?, ?, 1)', active_key[1:])
+    conn.execute('INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive) VALUES (?, ?, ?, 0)', inactive_key[1:])
+    conn.commit()
+    # Migration 1 as released keeps the first of the duplicates, for routes.py to switch the route back on
+    return {active_key[1:]: (active_key[0], 0), inactive_key[1:]: (inactive_key[0], 0)}
+
+def check_duplicates(conn, expected):
+    for key, row in expected.items():
+        rows = conn.execute('SELECT Id, IsActive FROM Route WHERE AirlineId = ? AND FromAirportId = ? AND ToAirportId = ?',
+                            key).fetchall()
+        print('route', key, rows)
+        assert rows == [row], 'expected {0} of the duplicates of {1}, kept {2}'.format(row, key, rows)
+
+def check_route_sources(db_path):
+    # A database migrated up to migration 10 with a route source recorded forgets it
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'lcc.db')
+    shutil.copy(db_path, path)
+    migrate(path, MIGRATIONS[:10])
+    conn = sqlite3.connect(path)
+    conn.execute("INSERT OR REPLACE INTO RouteSource VALUES (1, 'hash', NULL, NULL, 0)")
+    conn.commit()
+    migrate(path)
+    sources = conn.execute('SELECT COUNT(*) FROM RouteSource').fetchone()[0]
+    print('route sources after migration 11', sources)
+    assert sources == 0, sources
+    conn.close()
+    shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the route lookups search an index of Route')
+    parser.add_argument('--db', default='lcc.db', help='database to check a migrated copy of')
+    args = parser.parse_args()
+
+    check_route_sources(args.db)
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'lcc.db')
+    shutil.copy(args.db, db_path)
+    conn = sqlite3.connect(db_path)
+    expected = None
+    if conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+        expected = add_duplicates(conn)
+    migrate(db_path)
+    if expected is not None:
+        check_duplicates(conn, expected)
+    check_plans(conn)
+    conn.close()
+    shutil.rmtree(directory)
@@ -0,0 +1,137 @@
+import random
+import sqlite3
+import threading
+from time import time, strftime
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from server import logger, Airline, DB_LCC_PATH, FARE_CACHE_TTLS, fare_cache, get_cache_stats, prewarm_fares
+from migrations import migrate
+
+# Seconds between two rounds of pre-warming
+PREWARM_INTERVAL = 60
+# Seconds of search history that decide the popular searches
+PREWARM_HISTORY = 7 * 24 * 3600
+# Number of (route, month, airline) combinations kept warm
+PREWARM_TOP_N = 50
+# Cached fares expiring within these seconds are refreshed
+PREWARM_MARGIN = 120
+# Upstream fetches of pre-warming running at the same time, kept small to leave room for the users
+PREWARM_CONCURRENCY = 2
+# Minimum seconds between two pre-warming requests to the site of an airline, plus a random jitter.
+# Every request counts, e.g. each of the five weeks of a Jetstar month
+PREWARM_HOST_INTERVALS = {
+    Airline.TIGERAIR_TAIWAN: 2,
+    Airline.VANILLA_AIR: 2,
+    Airline.SCOOT: 2,
+    Airline.PEACH_AVIATION: 2,
+    Airline.JETSTAR: 5
+}
+PREWARM_JITTER = 3
+
+class Prewarmer:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=PREWARM_CONCURRENCY)
+        self.host_lock = threading.Lock()
+        self.host_next = {airline: 0 for airline in Airline}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.refreshed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.purged = 0
+
+    def purge_history(self):
+        # Searches older than the history that decides the popular ones are never read again
+        conn = sqlite3.connect(self.db_path)
+        try:
+            purged = conn.execute('DELETE FROM SearchHistory WHERE SearchedAt < ?', (time() - PREWARM_HISTORY, )).rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        self.purged += purged
+        return purged
+
+    def get_hot_searches(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('''SELECT h.AirlineId, fap.Code, tap.Code, h.Month, IFNULL(c.Currency, "TWD"), COUNT(*) Searches
+                                   FROM SearchHistory h
+                                   JOIN Route r ON r.AirlineId = h.AirlineId AND r.FromAirportId = h.FromAirportId
+                                                AND r.ToAirportId = h.ToAirportId AND r.IsActive = 1
+                                   JOIN Airport fap ON h.FromAirportId = fap.Id
+                                   JOIN Airport tap ON h.ToAirportId = tap.Id
+                                   LEFT JOIN Country c ON fap.CountryId = c.Id
+                                   WHERE h.SearchedAt >= ? AND h.Month >= ?
+                                   GROUP BY h.AirlineId, h.FromAirportId, h.ToAirportId, h.Month
+                                   ORDER BY Searches DESC
+                                   LIMIT ?''',
+                                (time() - PREWARM_HISTORY, strftime('%Y-%m'), PREWARM_TOP_N)).fetchall()
+        finally:
+            conn.close()
+
+    def wait_for_host(self, airline):
+        # Reserve the next free slot of the airline's site, then wait for it outside the lock.
+        # Called before every upstream request of a refresh, returning the seconds waited
+        with self.host_lock:
+            slot = max(time(), self.host_next[airline])
+            self.host_next[airline] = slot + PREWARM_HOST_INTERVALS[airline] + random.uniform(0, PREWARM_JITTER)
+        waited = max(slot - time(), 0)
+        self.stop_event.wait(waited)
+        return waited
+
+    def refresh(self, airline, origin, destination, month, currency):
+        if self.stop_event.is_set():
+            return
+        try:
+            prewarm_fares(airline, month, origin, destination, currency, lambda: self.wait_for_host(airline))
+        except Exception as e:
+            self.failed += 1
+            logger.error('Fail on pre-warming fares of the airline with ID {0} for {1}-{2} in {3} - {4}'.format(
+                airline.value, origin, destination, month, repr(e)))
+        else:
+            self.refreshed += 1
+
+    def run_round(self):
+        self.purge_history()
+        futures = []
+        for airline_id, origin, destination, month, currency, searches in self.get_hot_searches():
+            fetched_at = fare_cache.fetched_at((airline_id, origin, destination, month, currency))
+            if fetched_at is not None and fetched_at + FARE_CACHE_TTLS[airline_id] - time() > PREWARM_MARGIN:
+                self.skipped += 1
+                continue
+            futures.append(self.executor.submit(self.refresh, Airline(airline_id), origin, destination, month, currency))
+        # Finish the round before planning the next one, so that the queue never piles up
+        wait(futures)
+        logger.info('Pre-warming round finished - {0}'.format(self.stats()))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.run_round()
+            except Exception as e:
+                logger.error('Fail on pre-warming fares - {0}'.format(repr(e)))
+            self.stop_event.wait(PREWARM_INTERVAL + random.uniform(0, PREWARM_JITTER))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='prewarmer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        stats = get_cache_stats()
+        return {
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'purged': self.purged,
+            'prewarmed_hits': stats['prewarmed_hits'],
+            'prewarmed_hit_ratio': stats['prewarmed_hit_ratio']
+        }
+
+if __name__ == '__main__':
+    # Running on its own, the fares are shared with the services through the FareCache table
+    migrate(DB_LCC_PATH)
+    Prewarmer(DB_LCC_PATH).run()
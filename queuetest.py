@@ -0,0 +1,89 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from time import time, sleep
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port
+
+# Throughput of the fetch jobs of jobqueue.py run by 1, 2, 4... worker processes of worker.py against the
+# stubbed airline sites of loadtest.py, the stubs answering after a fixed latency like the real sites
+
+def run_worker(directory, backend, path, threads, ready):
+    configure(directory)
+    import server
+    from jobqueue import create_queue
+    from worker import Worker
+    # The prices go to the FareCache table of the copied database, as they would for the services
+    server.fare_cache.db_path = os.path.join(directory, 'lcc.db')
+    concurrency = {airline: threads if airline.value in (1, 2, 5) else 0 for airline in server.Airline}
+    worker = Worker(create_queue(backend, path), concurrency)
+    worker.start()
+    ready.set()
+    worker.stop_event.wait()
+
+def run_round(backend, workers, threads, jobs):
+    from migrations import migrate
+    from jobqueue import create_queue
+    directory = tempfile.mkdtemp()
+    shutil.copy('lcc.db', directory)
+    migrate(os.path.join(directory, 'lcc.db'))
+    path = os.path.join(directory, 'lcc.db') if backend == 'sqlite' else os.path.join(directory, 'jobs')
+    queue = create_queue(backend, path)
+
+    processes = []
+    for _ in range(workers):
+        ready = multiprocessing.Event()
+        process = multiprocessing.Process(target=run_worker, args=(directory, backend, path, threads, ready), daemon=True)
+        process.start()
+        processes.append((process, ready))
+    for process, ready in processes:
+        ready.wait()
+
+    # Distinct months, so that no two jobs share a key
+    start = time()
+    for idx in range(jobs):
+        month = '{0}-{1:02}'.format(2030 + idx // 36, idx // 3 % 12 + 1)
+        queue.put(([1, 2, 5][idx % 3], 'TPE', 'NRT', month, 'TWD'))
+    while True:
+        stats = queue.stats()
+        if stats['done'] + stats['failed'] >= jobs:
+            break
+        sleep(0.05)
+    elapsed = time() - start
+    for process, ready in processes:
+        process.terminate()
+    return {
+        'workers': workers,
+        'seconds': round(elapsed, 2),
+        'jobs_per_second': round(jobs / elapsed, 1),
+        'failed': stats['failed']
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show how the fetch throughput scales with the number of worker processes')
+    parser.add_argument('--backend', choices=['sqlite', 'filesystem'], default='sqlite')
+    parser.add_argument('--workers', default='1,2,4,8', help='numbers of worker processes to compare')
+    parser.add_argument('--threads', type=int, default=2, help='jobs of each airline run at the same time by one worker')
+    parser.add_argument('--jobs', type=int, default=240)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds the stubbed airlines take to answer')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(args.latency, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    # Parsing and the stubs share the CPUs, so the scaling flattens out once the workers outnumber them
+    print('{0} CPUs'.format(os.cpu_count()))
+    results = []
+    for workers in [int(workers) for workers in args.workers.split(',')]:
+        result = run_round(args.backend, workers, args.threads, args.jobs)
+        result['speedup'] = round(result['jobs_per_second'] / results[0]['jobs_per_second'], 2) if results else 1.0
+        results.append(result)
+        print(result)
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,101 @@
+import argparse
+import datetime as dt
+import json
+import multiprocessing
+import tempfile
+
+import requests
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port
+
+# Upstream requests of the date-range search against the request-counting stubs of loadtest.py: a range asks each
+# airline for the fewest windows, pages and months covering it, fewer than the month searches covering the same
+# dates, and whole months found fresh in the fare cache are not asked for again
+STUB_PATHS = {
+    'tigerair': '/tigerair',
+    'vanilla_transit': '/vanilla/routes',
+    'vanilla': '/vanilla/fares',
+    'jetstar': '/jetstar'
+}
+
+def get_counts():
+    response = requests.get('http://{0}:{1}/counts'.format(STUB_HOSTS['tigerair'], STUB_PORT))
+    response.raise_for_status()
+    counts = response.json()
+    return {name: counts.get(path, 0) for name, path in STUB_PATHS.items()}
+
+def count_requests(search):
+    # The requests the stub answered during search(), and what search() returned
+    before = get_counts()
+    result = search()
+    return {name: count - before[name] for name, count in get_counts().items()}, result
+
+def get_expected(server, segments):
+    # The requests plan_requests makes for the segments, with the transit lookup of Vanilla Air
+    months = set(month for start, end in segments for month in server.plan_months(start, end))
+    return {
+        'tigerair': sum(len(server.plan_windows(start, end, server.TIGERAIR_TAIWAN_HALF_WIDTH)) for start, end in segments),
+        'vanilla_transit': 1 if months else 0,
+        'vanilla': len(months),
+        'jetstar': sum(len(server.plan_windows(start, end, server.JETSTAR_HALF_WIDTH)) for start, end in segments)
+    }
+
+def check_range(server, start, end, airlines):
+    counts, fares = count_requests(lambda: server.get_fare_range(start, end, 'TPE', 'NRT', airlines, 'TWD'))
+    # Every date of the range has a fare of the airlines whose stub answers every date of a window
+    for airline in (server.Airline.TIGERAIR_TAIWAN, server.Airline.JETSTAR):
+        assert len(fares.rows[airline]) == fares.num_of_days and all(fares.rows[airline]), airline
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count the upstream requests of the date-range search')
+    parser.add_argument('--start', default='2030-01-15', help='first date of the long range')
+    parser.add_argument('--days', type=int, default=90, help='days of the long range')
+    parser.add_argument('--around', type=int, default=3, help='days before and after the date of the short range')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(0.01, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    configure(tempfile.mkdtemp())
+    import server
+    airlines = [airline.value for airline in (server.Airline.TIGERAIR_TAIWAN, server.Airline.VANILLA_AIR,
+                                              server.Airline.JETSTAR)]
+    results = {}
+
+    # A long range against the month searches covering the same dates
+    start = dt.datetime.strptime(args.start, '%Y-%m-%d').date()
+    end = start + dt.timedelta(days=args.days - 1)
+    counts = check_range(server, start, end, airlines)
+    monthly = {name: 0 for name in STUB_PATHS}
+    for month in server.plan_months(start, end):
+        month_counts, fares = count_requests(lambda: server.get_fares(month, 'TPE', 'NRT', airlines, 'TWD'))
+        monthly = {name: monthly[name] + month_counts[name] for name in STUB_PATHS}
+    results['range'] = {'days': args.days, 'requests': counts, 'monthly_requests': monthly}
+    print('range', results['range'])
+    assert counts == get_expected(server, [(start, end)]), counts
+    assert sum(counts.values()) < sum(monthly.values())
+
+    # A few days around a date, one window or month of each airline
+    center = start + dt.timedelta(days=args.days // 2)
+    counts = check_range(server, center - dt.timedelta(days=args.around), center + dt.timedelta(days=args.around), airlines)
+    results['around'] = {'days': args.around * 2 + 1, 'requests': counts}
+    print('around', results['around'])
+    assert counts == get_expected(server, [(center - dt.timedelta(days=args.around), center + dt.timedelta(days=args.around))]), counts
+
+    # The month in the middle of a range is taken from the fare cache, the dates on either side are planned apart
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 3600
+    first, last = server.get_month_axis(server.plan_months(start, end)[1])
+    last = first + dt.timedelta(days=last - 1)
+    server.get_fares(first.strftime('%Y-%m'), 'TPE', 'NRT', airlines, 'TWD')
+    segments = [(first - dt.timedelta(days=10), first - dt.timedelta(days=1)), (last + dt.timedelta(days=1), last + dt.timedelta(days=10))]
+    counts = check_range(server, segments[0][0], segments[1][1], airlines)
+    results['cached_month'] = {'days': (segments[1][1] - segments[0][0]).days + 1, 'requests': counts}
+    print('cached month', results['cached_month'])
+    assert counts == get_expected(server, segments), counts
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
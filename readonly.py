@@ -0,0 +1,34 @@
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads running the queries of the async server, each with a read-only connection of its own
+READONLY_THREADS = 4
+
+class ReadOnlyDatabase:
+    # SQLite queries for an event loop, run in a small pool of threads so that the loop never blocks on the disk
+    def __init__(self, db_path, threads=READONLY_THREADS):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='readonly')
+        self.local = threading.local()
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect('file:{0}?mode=ro'.format(self.db_path), uri=True)
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def query(self, sql, params):
+        return self.get_connection().execute(sql, params).fetchall()
+
+    async def fetchall(self, sql, params=()):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.query, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        rows = await self.fetchall(sql, params)
+        return rows[0] if rows else None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
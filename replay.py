@@ -0,0 +1,167 @@
+import argparse
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import tempfile
+import threading
+from string import ascii_uppercase
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+from aiohttp import web
+
+import sessions
+from server import logger
+
+# Responses of the airline and Wikipedia sites recorded once into a directory of fixtures, then served
+# by a local replay server that the fetchers are pointed at, so that benchmark.py runs without the sites
+FIXTURES_DIR = 'fixtures'
+REPLAY_HOST = '127.0.0.1'
+REPLAY_PORT = 8904
+# Module constants pointed at the replay server, every string constant whose name ends in _URL
+REPLAYED_MODULES = ('server', 'routes', 'enrichment')
+# Query parameters changing on every request, e.g. the timestamp Vanilla Air asks for against caching
+REPLAY_IGNORED_PARAMS = ('__ts', )
+
+def get_key(host, path, query):
+    # The same request whatever the order of its query parameters
+    query = sorted((name, value) for name, value in query if name not in REPLAY_IGNORED_PARAMS)
+    return host + path + ('?' + urlencode(query) if query else '')
+
+def load_index(directory):
+    path = os.path.join(directory, 'index.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+class Recorder:
+    # Installed as sessions.recorder, keeping the body of every successful response with its content type
+    def __init__(self, directory=FIXTURES_DIR):
+        self.directory = directory
+        self.index = load_index(directory)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, url, params, response):
+        if response.status_code != 200:
+            return
+        split = urlsplit(requests.Request('GET', url, params=params).prepare().url)
+        key = get_key(split.netloc, split.path, parse_qsl(split.query, keep_blank_values=True))
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        with self.lock:
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(response.content)
+            self.index[key] = {
+                'url': url,
+                'content_type': response.headers.get('Content-Type', 'application/octet-stream'),
+                'body': name
+            }
+            with open(os.path.join(self.directory, 'index.json'), 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, indent=2, sort_keys=True)
+
+def record(directory, origin, destination, month, currency):
+    # Fetch one search of every airline, the route source of every airline and the Wikipedia pages of
+    # enrichment.py from the live sites, keeping the responses. The search is kept in search.json
+    import server
+    import routes
+    import enrichment
+    server.fare_cache.db_path = None
+    server.fare_history.db_path = os.path.join(tempfile.mkdtemp(), 'history.db')
+    sessions.recorder = Recorder(directory)
+    try:
+        server.get_fares(month, origin, destination, [airline.value for airline in server.Airline], currency)
+        for airline in routes.ROUTE_SOURCES:
+            try:
+                routes.fetch_routes(airline)
+            except Exception as e:
+                logger.error('Fail on recording the routes of the airline with ID {0} - {1}'.format(airline.value, repr(e)))
+        page_cache = enrichment.PageCache(tempfile.mkdtemp())
+        urls = [url.format(capital) for capital in ascii_uppercase
+                for url in (enrichment.EN_AIRPORTS_URL, enrichment.ZH_AIRPORTS_URL)] + [enrichment.CURRENCIES_URL]
+        for url in urls:
+            try:
+                page_cache.get(url)
+            except Exception as e:
+                logger.error('Fail on recording the page {0} - {1}'.format(url, repr(e)))
+    finally:
+        sessions.recorder = None
+    with open(os.path.join(directory, 'search.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'origin': origin,
+            'destination': destination,
+            'month': month,
+            'currency': currency
+        }, f, indent=2)
+    return len(load_index(directory))
+
+def create_replay_app(directory=FIXTURES_DIR, latency=0):
+    # Requests to /<host>/<path> are answered with the fixture of the same host, path and query after latency
+    # seconds. A query never recorded, e.g. another month, is answered with a fixture of the same path
+    index = load_index(directory)
+    bodies = {}
+    by_path = {}
+    for key, entry in index.items():
+        with open(os.path.join(directory, entry['body']), 'rb') as f:
+            bodies[key] = (f.read(), entry['content_type'])
+        by_path.setdefault(key.split('?')[0], bodies[key])
+    counts = {'exact': 0, 'path': 0, 'missing': 0}
+
+    async def replay(request):
+        await asyncio.sleep(latency)
+        target = request.raw_path.split('?')[0][1:]
+        host, _, path = target.partition('/')
+        body = bodies.get(get_key(host, '/' + path, request.query.items()))
+        if body is not None:
+            counts['exact'] += 1
+        else:
+            body = by_path.get(target)
+            if body is None:
+                counts['missing'] += 1
+                raise web.HTTPNotFound()
+            counts['path'] += 1
+        return web.Response(body=body[0], headers={'Content-Type': body[1]})
+
+    async def get_counts(request):
+        return web.json_response(counts)
+
+    app = web.Application()
+    # Before the catch-all route, as the fixtures never hold a host named _replay
+    app.router.add_get('/_replay/counts', get_counts)
+    app.router.add_get('/{target:.*}', replay)
+    return app
+
+def run_replay(directory=FIXTURES_DIR, latency=0, host=REPLAY_HOST, port=REPLAY_PORT):
+    web.run_app(create_replay_app(directory, latency), host=host, port=port, print=None)
+
+def point_at_replay(base='http://{0}:{1}'.format(REPLAY_HOST, REPLAY_PORT)):
+    # Rewrite the URL constants of the fetchers from http(s)://<host>/<path> to <base>/<host>/<path>
+    for name in REPLAYED_MODULES:
+        module = importlib.import_module(name)
+        for attr, value in list(vars(module).items()):
+            if attr.endswith('_URL') and isinstance(value, str) and '://' in value:
+                setattr(module, attr, base + '/' + value.split('://', 1)[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record the responses of the airline sites, or replay them locally')
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record', help='record one search, the route sources and the Wikipedia pages')
+    record_parser.add_argument('--origin', default='TPE')
+    record_parser.add_argument('--destination', default='NRT')
+    record_parser.add_argument('--month', required=True, help='YYYY-MM')
+    record_parser.add_argument('--currency', default='TWD')
+    serve_parser = subparsers.add_parser('serve', help='serve the recorded responses')
+    serve_parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each response')
+    serve_parser.add_argument('--port', type=int, default=REPLAY_PORT)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    args = parser.parse_args()
+    # Subcommands cannot be required before Python 3.7
+    if args.command is None:
+        parser.error('a command is required')
+
+    if args.command == 'record':
+        print('{0} responses recorded'.format(record(args.fixtures, args.origin, args.destination, args.month, args.currency)))
+    else:
+        run_replay(args.fixtures, args.latency, port=args.port)
@@ -0,0 +1,116 @@
+import threading
+from collections import deque
+from time import time
+
+# Upstream fetches of an airline kept to work out its latency percentiles
+LATENCY_WINDOW = 200
+# Fetches needed before the timeout of an airline follows its latency rather than the configured one
+LATENCY_MIN_SAMPLES = 20
+# An adaptive timeout is the 99th percentile of the latency times this, within the bounds below
+TIMEOUT_MULTIPLIER = 2
+TIMEOUT_MIN = 3
+# Upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, float('inf'))
+# Failures in a row that open the breaker of an airline, and seconds before one fetch is let through to probe it
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60
+# Statuses of a site failing or turning requests away, counted by the breakers with the transport errors and timeouts
+FAILURE_STATUSES = (429, 500, 502, 503, 504)
+
+class CircuitOpen(Exception):
+    pass
+
+class UpstreamError(Exception):
+    # A page answered with one of FAILURE_STATUSES
+    def __init__(self, status, url):
+        super().__init__('{0} answered {1}'.format(url, status))
+        self.status = status
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    # Health of the upstream of one airline. The breaker opens after BREAKER_FAILURES failed fetches in a row,
+    # then lets a single probe through every BREAKER_COOLDOWN seconds until one succeeds
+    def __init__(self, max_timeout):
+        self.max_timeout = max_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.successes = 0
+        self.errors = 0
+        self.skips = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time() - self.opened_at >= BREAKER_COOLDOWN:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.skips += 1
+            return False
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.histogram[next(idx for idx, bound in enumerate(LATENCY_BUCKETS) if latency <= bound)] += 1
+            self.successes += 1
+            self.failures = 0
+            self.state = CLOSED
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.errors += 1
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= BREAKER_FAILURES:
+                self.state = OPEN
+                self.opened_at = time()
+
+    def release(self):
+        # A fetch that failed on its own, e.g. a page that could not be parsed, says nothing of the health of the site:
+        # neither a success nor a failure, only the probe it may have been is over
+        with self.lock:
+            self.probing = False
+
+    def get_percentile(self, percentile):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    def get_timeout(self):
+        # Seconds allowed for a whole month of the airline, the configured timeout until enough fetches are seen
+        if len(self.latencies) < LATENCY_MIN_SAMPLES:
+            return self.max_timeout
+        return min(max(self.get_percentile(99) * TIMEOUT_MULTIPLIER, TIMEOUT_MIN), self.max_timeout)
+
+    def stats(self):
+        p50, p90, p99 = (self.get_percentile(p) for p in (50, 90, 99))
+        timeout = self.get_timeout()
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'successes': self.successes,
+                'errors': self.errors,
+                'skips': self.skips,
+                'timeout': timeout,
+                'latency': {
+                    'p50': p50,
+                    'p90': p90,
+                    'p99': p99,
+                    'buckets': [[bound if bound != float('inf') else '+Inf', count]
+                                for bound, count in zip(LATENCY_BUCKETS, self.histogram)]
+                }
+            }
@@ -0,0 +1,320 @@
+import argparse
+import hashlib
+import json
+import re
+import sqlite3
+from time import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from bs4 import BeautifulSoup
+
+from server import logger, Airline, DB_LCC_PATH
+from sessions import http_get
+from migrations import migrate
+from browsers import BrowserPool, create_driver
+from enrichment import enrich_metadata
+
+TIGERAIR_TAIWAN_HOME_URL = 'http://www.tigerairtw.com/en/'
+VANILLA_AIR_SCRIPT_URL = 'https://www.vanilla-air.com/common/js/vnl.js'
+SCOOT_HOME_URL = 'https://www.flyscoot.com/en/'
+PEACH_AVIATION_WIDGET_URL = 'http://www.flypeach.com/widget/widgetvars.js'
+JETSTAR_HOME_URL = 'http://www.jetstar.com/tw/zh/home'
+# Browser sessions clicking through the Jetstar panels at the same time
+BROWSER_POOL_SIZE = 4
+# Seconds to wait for a page to react to a click
+BROWSER_WAIT = 10
+# Extra attempts of an origin whose browser session crashed
+BROWSER_RETRIES = 2
+
+def apply_routes(c, airline, pairs):
+    # Stage the fetched (origin, destination) codes, then update the tables in a few set-based statements
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS RouteStaging (
+                     FromCode TEXT NOT NULL,
+                     ToCode TEXT NOT NULL,
+                     FromAirportId INTEGER,
+                     ToAirportId INTEGER,
+                     PRIMARY KEY (FromCode, ToCode))''')
+    c.execute('CREATE INDEX IF NOT EXISTS temp.RouteStagingIdx ON RouteStaging (FromAirportId, ToAirportId)')
+    c.execute('DELETE FROM RouteStaging')
+    c.executemany('INSERT OR IGNORE INTO RouteStaging (FromCode, ToCode) VALUES (?, ?)', pairs)
+    c.execute('''INSERT OR IGNORE INTO Airport (Code)
+                 SELECT FromCode FROM RouteStaging UNION SELECT ToCode FROM RouteStaging''')
+    c.execute('''UPDATE RouteStaging
+                 SET FromAirportId = (SELECT Id FROM Airport WHERE Code = FromCode),
+                     ToAirportId = (SELECT Id FROM Airport WHERE Code = ToCode)''')
+    c.execute('''UPDATE Route SET IsActive = EXISTS (SELECT 1 FROM RouteStaging s
+                                                     WHERE s.FromAirportId = Route.FromAirportId
+                                                     AND s.ToAirportId = Route.ToAirportId)
+                 WHERE AirlineId = ?''',
+              (airline.value, ))
+    c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
+                 SELECT ?, FromAirportId, ToAirportId, 1 FROM (
+                     SELECT FromAirportId, ToAirportId FROM RouteStaging
+                     EXCEPT
+                     SELECT FromAirportId, ToAirportId FROM Route WHERE AirlineId = ?)''',
+              (airline.value, airline.value))
+    c.execute('DELETE FROM RouteStaging')
+
+def apply_route_diff(c, airline, pairs):
+    # Compare the fetched (origin, destination) codes with the active routes of the airline and only write the
+    # routes added or removed, returning how many of each
+    c.execute('''SELECT fap.Code, tap.Code FROM Route r
+                 JOIN Airport fap ON r.FromAirportId = fap.Id
+                 JOIN Airport tap ON r.ToAirportId = tap.Id
+                 WHERE r.AirlineId = ? AND r.IsActive = 1''', (airline.value, ))
+    active = set(c.fetchall())
+    added = sorted(pairs - active)
+    removed = sorted(active - pairs)
+    c.executemany('''UPDATE Route SET IsActive = 0
+                     WHERE AirlineId = ? AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
+                     AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
+                  [(airline.value, origin, destination) for origin, destination in removed])
+    c.executemany('INSERT OR IGNORE INTO Airport (Code) VALUES (?)',
+                  [(code, ) for code in set(code for pair in added for code in pair)])
+    # Routes that were active once are switched back on, the others are inserted
+    c.executemany('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
+                     VALUES (?, (SELECT Id FROM Airport WHERE Code = ?), (SELECT Id FROM Airport WHERE Code = ?), 1)
+                     ON CONFLICT (AirlineId, FromAirportId, ToAirportId) DO UPDATE SET IsActive = 1''',
+                  [(airline.value, origin, destination) for origin, destination in added])
+    return len(added), len(removed)
+
+def get_jetstar_embedded_routes(html):
+    # Look for route data embedded in the page, a JSON object mapping origin codes to lists of destination codes,
+    # so that the routes can be read without clicking through the panels
+    pairs = set()
+    soup = BeautifulSoup(html, 'html.parser')
+    for script in soup.find_all('script', type='application/json'):
+        try:
+            data = json.loads(script.string or '')
+        except ValueError:
+            continue
+        routes = data.get('routes') if isinstance(data, dict) else None
+        if not isinstance(routes, dict):
+            continue
+        for origin, destinations in routes.items():
+            if re.fullmatch(r'[A-Z]{3}', origin) and isinstance(destinations, list):
+                pairs.update((origin, destination) for destination in destinations
+                             if isinstance(destination, str) and re.fullmatch(r'[A-Z]{3}', destination))
+    return pairs
+
+def open_jetstar_origins(driver, home_url):
+    driver.get(home_url)
+    driver.execute_script('document.querySelector("button[data-direction-id = origin]").click();')
+    soup = BeautifulSoup(driver.page_source, 'html.parser')
+    panel_from = soup.find('div', id='origin-panel01')
+    return [button.attrs['data-value'] for button in panel_from.find_all('button', attrs={'data-value': True})]
+
+def get_jetstar_destinations(driver, home_url, origin):
+    # Start from a fresh page for every origin, so that workers never depend on each other's state
+    pairs = set()
+    wait = WebDriverWait(driver, BROWSER_WAIT)
+    open_jetstar_origins(driver, home_url)
+    driver.execute_script('document.querySelector("#origin-panel01 button[data-value = \'{0}\']").click();'.format(origin))
+    driver.execute_script('document.querySelector("button[data-direction-id = destination]").click();')
+    wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, 'button[data-direction-id = destination][aria-expanded = true]')))
+    soup = BeautifulSoup(driver.page_source, 'html.parser')
+    panel_to = soup.find('div', id='destination-panel01')
+    for airport_to in panel_to.find_all('button', attrs={'data-value': True}):
+        driver.execute_script('document.querySelector("#destination-panel01 button[data-value = \'{0}\']").click();'.format(airport_to.attrs['data-value']))
+        wait.until(EC.url_changes(driver.current_url))
+        codes = re.search(r'origin=([A-Z]{3})&destination=([A-Z]{3})', driver.current_url)
+        pairs.add((codes[1], codes[2]))
+    return pairs
+
+def discover_jetstar_origin(pool, home_url, origin):
+    for attempt in range(BROWSER_RETRIES + 1):
+        try:
+            with pool.driver() as driver:
+                return get_jetstar_destinations(driver, home_url, origin)
+        except WebDriverException as e:
+            # The pool has dropped the crashed session, try again with a fresh one
+            if attempt == BROWSER_RETRIES:
+                raise
+            logger.error('Fail on discovering Jetstar routes from {0}, retrying - {1}'.format(origin, repr(e)))
+
+def get_jetstar_panel_routes(home_url=JETSTAR_HOME_URL, pool_size=BROWSER_POOL_SIZE, factory=create_driver):
+    # Without embedded data, click through the panels, with the origins split across a pool of browsers
+    pairs = set()
+    pool = BrowserPool(pool_size, factory)
+    try:
+        with pool.driver() as driver:
+            origins = open_jetstar_origins(driver, home_url)
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for destinations in executor.map(lambda origin: discover_jetstar_origin(pool, home_url, origin), origins):
+                pairs.update(destinations)
+    finally:
+        pool.close()
+    return pairs
+
+# Each source of routes is read into a canonical text, whose hash is kept in the RouteSource table,
+# then parsed from that text into (origin, destination) codes
+def extract_tigerair_taiwan(response):
+    return re.search(r'var StationList = (.+?);', response.text)[1]
+
+def parse_tigerair_taiwan_routes(text):
+    pairs = set()
+    for station in json.loads(text)['stations']:
+        if not station['airportCode'].startswith('X'):
+            for market in station['markets']:
+                if not market.startswith('X'):
+                    pairs.add((station['airportCode'], market))
+    return pairs
+
+def extract_vanilla_air(response):
+    text = response.text
+    for remove_line in set(re.findall(r'.*//.*', text)):
+        text = text.replace(remove_line, '')
+    return re.search(r'"oandd":({.+?})', re.sub(r'[\r\n\t ]', '', text))[1]
+
+def parse_vanilla_air_routes(text):
+    data = json.loads(text)
+    return set((station, destination) for station in data for destination in data[station])
+
+def extract_scoot(response):
+    return re.search(r'<script id="city_pairs_data">(.+?)</script>', response.text)[1]
+
+def parse_scoot_routes(text):
+    pairs = set()
+    for country in json.loads(text)[0]:
+        for airport in country['markets']:
+            for dest_country in airport['destinations']:
+                for destination in dest_country['destinations']:
+                    pairs.add((airport['origin']['station_code'], destination['station_code']))
+    return pairs
+
+def extract_peach_aviation(response):
+    response.encoding = 'UTF-8'
+    return re.search(r'routes:(.+?),landingPages:', re.sub(r'[\r\n\t ]', '', response.text))[1].replace('ori', '"ori"').replace('dest', '"dest"')
+
+def parse_peach_aviation_routes(text):
+    return set((route['ori'], route['dest']) for route in json.loads(text))
+
+def extract_jetstar(response):
+    # The home page changes on every load, so the text is made of the sorted routes, embedded in the page or
+    # clicked through the panels. Only the writes can be skipped when they have not changed
+    pairs = get_jetstar_embedded_routes(response.text) or get_jetstar_panel_routes(get_route_source_url(Airline.JETSTAR))
+    return json.dumps(sorted(pairs))
+
+def parse_jetstar_routes(text):
+    return set(tuple(pair) for pair in json.loads(text))
+
+ROUTE_SOURCES = {
+    Airline.TIGERAIR_TAIWAN: (extract_tigerair_taiwan, parse_tigerair_taiwan_routes),
+    Airline.VANILLA_AIR: (extract_vanilla_air, parse_vanilla_air_routes),
+    Airline.SCOOT: (extract_scoot, parse_scoot_routes),
+    Airline.PEACH_AVIATION: (extract_peach_aviation, parse_peach_aviation_routes),
+    Airline.JETSTAR: (extract_jetstar, parse_jetstar_routes)
+}
+
+def get_route_source_url(airline):
+    # Read when fetching, so that replay.py can point the constants at its server
+    return {
+        Airline.TIGERAIR_TAIWAN: TIGERAIR_TAIWAN_HOME_URL,
+        Airline.VANILLA_AIR: VANILLA_AIR_SCRIPT_URL,
+        Airline.SCOOT: SCOOT_HOME_URL,
+        Airline.PEACH_AVIATION: PEACH_AVIATION_WIDGET_URL,
+        Airline.JETSTAR: JETSTAR_HOME_URL
+    }[airline]
+
+def fetch_routes(airline, source=None):
+    # Fetch the source of the airline, conditionally on the (content hash, ETag, Last-Modified) of its last refresh.
+    # Returns the new (content hash, ETag, Last-Modified, pairs), pairs being None when the source has not changed
+    extract, parse = ROUTE_SOURCES[airline]
+    url = get_route_source_url(airline)
+    content_hash, etag, last_modified = source if source is not None else (None, None, None)
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+    response = http_get(url, headers=headers)
+    if response.status_code == 304:
+        return content_hash, etag, last_modified, None
+    text = extract(response)
+    new_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    pairs = parse(text) if new_hash != content_hash else None
+    return new_hash, response.headers.get('ETag'), response.headers.get('Last-Modified'), pairs
+
+def get_routes(airlines=None, full=False):
+    # Refresh the routes of the airlines, all of them by default, fetching their sources in parallel.
+    # Unchanged sources are skipped and only the added and removed routes are written. With full set,
+    # every source is refetched and all the routes of the airlines are rewritten
+    success_stat = 'Succeed on fetching route data of the airline with ID {0} - {1}'
+    failure_stat = 'Fail on fetching route data of the airline with ID {0} - {1}'
+    migrate(DB_LCC_PATH)
+    conn = sqlite3.connect(DB_LCC_PATH)
+    c = conn.cursor()
+    airlines = airlines or list(Airline)
+    sources = {}
+    if not full:
+        c.execute('SELECT AirlineId, ContentHash, ETag, LastModified FROM RouteSource')
+        sources = {row[0]: row[1:] for row in c.fetchall()}
+
+    changes = {}
+    changed = full
+    with ThreadPoolExecutor(max_workers=len(airlines)) as executor:
+        futures = {executor.submit(fetch_routes, airline, sources.get(airline.value)): airline for airline in airlines}
+        # The database is written from this thread only, one airline at a time as their sources arrive
+        for future in as_completed(futures):
+            airline = futures[future]
+            try:
+                content_hash, etag, last_modified, pairs = future.result()
+                if pairs is None:
+                    change = 'unchanged'
+                elif full:
+                    apply_routes(c, airline, pairs)
+                    change = 'rewritten'
+                else:
+                    added, removed = apply_route_diff(c, airline, pairs)
+                    changed = changed or added > 0 or removed > 0
+                    change = '+{0} -{1}'.format(added, removed)
+                c.execute('''INSERT OR REPLACE INTO RouteSource (AirlineId, ContentHash, ETag, LastModified, CheckedAt)
+                             VALUES (?, ?, ?, ?, ?)''', (airline.value, content_hash, etag, last_modified, time()))
+            except Exception as e:
+                conn.rollback()
+                changes[airline] = 'failed'
+                logger.error(failure_stat.format(airline.value, repr(e)))
+            else:
+                conn.commit()
+                changes[airline] = change
+                logger.info(success_stat.format(airline.value, change))
+
+    # Names, countries and currencies looked up anew change what the services list as well
+    changed = enrich_metadata(c)['changed'] > 0 or changed
+
+    # Let the running services know that the airport and route data has changed
+    if changed:
+        bump_catalog(c)
+    conn.commit()
+    conn.close()
+    return changes
+
+def bump_catalog(c):
+    # catalog.py reloads on a new version, and the ETags of the catalog responses change with it
+    c.execute('UPDATE Catalog SET Version = Version + 1, UpdatedAt = ?', (time(), ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh the routes of the airlines in the database')
+    parser.add_argument('--airline', action='append', choices=[airline.name.lower() for airline in Airline],
+                        help='airline to refresh, may be given more than once, all of them by default')
+    parser.add_argument('--full', action='store_true', help='refetch every source and rewrite all the routes')
+    parser.add_argument('--bump-catalog', action='store_true',
+                        help='fetch nothing, only have the services reload the airports and routes, e.g. after editing lcc.db by hand')
+    args = parser.parse_args()
+
+    if args.bump_catalog:
+        migrate(DB_LCC_PATH)
+        conn = sqlite3.connect(DB_LCC_PATH)
+        bump_catalog(conn.cursor())
+        conn.commit()
+        print('catalog version {0}'.format(conn.execute('SELECT Version FROM Catalog').fetchone()[0]))
+        conn.close()
+    else:
+        changes = get_routes([Airline[name.upper()] for name in args.airline or []], args.full)
+        for airline, change in changes.items():
+            print('{0:<16} {1}'.format(airline.name.lower(), change))
@@ -1,24 +1,23 @@
 import logging
 from logging.handlers import RotatingFileHandler
-import requests
 import json
 import datetime as dt
 import re
-import sqlite3
+import uuid
 from enum import Enum, unique
-from time import time
+from time import time, sleep
 from calendar import monthrange
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 
-import pandas as pd
-import altair as alt
-import plotly.offline as offline
-import plotly.graph_objs as go
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from bs4 import BeautifulSoup
-from hanziconv import HanziConv
+from requests.exceptions import RequestException
+
+from cache import FareCache
+from fares import FareMatrix, get_month_axis, new_prices, fill_prices
+from history import HistoryWriter
+from jobqueue import FAILED, JOB_POLL_INTERVAL, create_queue
+from metrics import SIZE_BUCKETS, Counter, Histogram, Gauge, timer, submit
+from resilience import FAILURE_STATUSES, CircuitBreaker, CircuitOpen, UpstreamError
+from sessions import http_get
 
 # Set the logger
 logger = logging.getLogger('server')
@@ -29,6 +28,23 @@ rfh.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s in %(filename)s
 logger.addHandler(rfh)
 
 DB_LCC_PATH = 'lcc.db'
+# Seconds allowed for a single upstream HTTP request
+REQUEST_TIMEOUT = 10
+# Seconds allowed for the whole search, whatever arrives after it is dropped
+FETCH_DEADLINE = 25
+# Failures of the site itself, counted by the breaker of the airline: transport errors, retries given up on,
+# timeouts and pages answered with one of FAILURE_STATUSES
+UPSTREAM_FAILURES = (RequestException, FutureTimeoutError, UpstreamError)
+# Days before and after the requested date that one search of these airlines shows
+TIGERAIR_TAIWAN_HALF_WIDTH = 15
+JETSTAR_HALF_WIDTH = 3
+# Longest span of days a date-range search may ask for
+RANGE_MAX_DAYS = 190
+
+TIGERAIR_TAIWAN_URL = 'https://tiger-wkgk.matchbyte.net/wkapi/v1.0/flightsearch'
+VANILLA_AIR_ROUTES_URL = 'https://www.vanilla-air.com/api/booking/segment/route.json'
+VANILLA_AIR_FARES_URL = 'https://www.vanilla-air.com/api/booking/flight-fare/list.json'
+JETSTAR_URL = 'https://booking.jetstar.com/tw/zh/booking/search-flights'
 
 @unique
 class Airline(Enum):
@@ -38,489 +54,517 @@ class Airline(Enum):
     PEACH_AVIATION = 4
     JETSTAR = 5
 
-def init_prices(month, num_of_days, airline):
-    data = []
-    for i in range(num_of_days):
-        data.append({
-            'Airline': airline,
-            'Date': month + '-{0:02}'.format(i + 1),
-            'Price': 0
-        })
-    return data
-
-def reset_prices(data, num_of_days):
-    for i in range(num_of_days):
-        data[i]['Price'] = 0
-    return data
-    
-def get_fares(month, origin, destination, airlines, currency):
-    result = []
-    today = dt.date.today()
-    num_of_days = monthrange(int(month[:4]), int(month[5:]))[1]
-    success_stat = 'Succeed on getting fares of the airline with ID {0}'
-    failure_stat = 'Fail on getting fares of the airline with ID {0} - {1}'
-    # Use the API to fetch the JSON data directly
-    if Airline.TIGERAIR_TAIWAN.value in airlines:
-        data = init_prices(month, num_of_days, 'Tigerair Taiwan')
-        payload = {
-            'adults': '1',
-            'children': '0',
-            'infants': '0',
-            'originStation': origin,
-            'destinationStation': destination,
-            'departureDate': month + '-16',
-            'includeoverbooking': 'false',
-            'daysBeforeAndAfter': '15',
-            'locale': 'zh-TW'
-        }
-        try:
-            response = requests.get('https://tiger-wkgk.matchbyte.net/wkapi/v1.0/flightsearch', params=payload)
-            js = json.loads(response.text)
-            fares = js['journeyDateMarkets'][0]['lowFares']['lowestFares']
-            for i in range(num_of_days):
-                if data[i]['Date'] == fares[i]['date'][:10]:
-                    data[i]['Price'] = int(fares[i]['price']) if fares[i]['price'] > 0 else 0
-        except Exception as e:
-            reset_prices(data, num_of_days)
-            logger.error(failure_stat.format(Airline.TIGERAIR_TAIWAN.value, repr(e)))
-        else:
-            logger.info(success_stat.format(Airline.TIGERAIR_TAIWAN.value))
-
-        result.extend(data)
+# Seconds allowed for each airline to return the fares of a whole month
+AIRLINE_TIMEOUTS = {
+    Airline.TIGERAIR_TAIWAN: 15,
+    Airline.VANILLA_AIR: 15,
+    Airline.SCOOT: 15,
+    Airline.PEACH_AVIATION: 15,
+    Airline.JETSTAR: 20
+}
+# Seconds that fetched fares of each airline are served from the cache
+FARE_CACHE_TTLS = {
+    Airline.TIGERAIR_TAIWAN.value: 600,
+    Airline.VANILLA_AIR.value: 900,
+    Airline.SCOOT.value: 900,
+    Airline.PEACH_AVIATION.value: 900,
+    Airline.JETSTAR.value: 1800
+}
+FARE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Keep the fare cache in the database too so that it survives restarts, None to keep it in memory only
+FARE_CACHE_DB_PATH = DB_LCC_PATH
+# Backend of the queue of fetch jobs run by worker.py, 'sqlite' or 'filesystem', None to fetch inside the service.
+# The path is the database of the sqlite backend, or the directory of the filesystem one. The prices
+# are shared through the FareCache table, so the queue needs FARE_CACHE_DB_PATH
+FETCH_QUEUE_BACKEND = None
+FETCH_QUEUE_PATH = DB_LCC_PATH
+
+def plan_windows(start, end, half_width):
+    # Centers of the fewest windows of (2 * half_width + 1) days covering the dates from start to end,
+    # e.g. a whole month is covered by Jetstar's weeks centered on the 4th, 11th, 18th, 25th and 28th
+    centers = []
+    day = start
+    while day <= end:
+        center = day + dt.timedelta(days=half_width)
+        if center + dt.timedelta(days=half_width) > end:
+            center = max(end - dt.timedelta(days=half_width), start)
+        centers.append(center)
+        day = center + dt.timedelta(days=half_width + 1)
+    return centers
+
+def plan_months(start, end):
+    months = []
+    day = start.replace(day=1)
+    while day <= end:
+        months.append(day.strftime('%Y-%m'))
+        day = (day + dt.timedelta(days=32)).replace(day=1)
+    return months
+
+def tigerair_taiwan_window_request(center, origin, destination, currency):
     # Use the API to fetch the JSON data directly
-    if Airline.VANILLA_AIR.value in airlines:
-        data = init_prices(month, num_of_days, 'Vanilla Air')
-        try:
-            # In Vanilla's system, additional search for transit is needed
-            payload = {
-                '__ts': int(time() * 1000),
-                'version': '1.1'
-            }
-            response = requests.get('https://www.vanilla-air.com/api/booking/segment/route.json', params=payload)
-            js = json.loads(response.text)
-            for route in js['Result']:
-                if route['BoardPoint'] == origin and route['OffPoint'] == destination:
-                    transit = route['TransitPoint']
-                    break
-            else:
-                transit = None
-
-            payload = {
-                '__ts': int(time() * 1000),
-                'adultCount': '1',
-                'childCount': '0',
-                'couponCode': '',
-                'currency': currency,
-                'destination': destination,
-                'infantCount': '0',
-                'isMultiFlight': 'true',
-                'origin': origin,
-                'searchCurrency': currency,
-                'targetMonth': month.replace('-', ''),
-                'version': '1.0',
-                'channel': 'pc'
-            }
-            if transit is not None:
-                payload['transitPoint'] = transit
-            response = requests.get('https://www.vanilla-air.com/api/booking/flight-fare/list.json', params=payload)
-            js = json.loads(response.text)
-            fares = js['Result'][0]['FareListOfDay']
-            for i in range(num_of_days):
-                data[i]['Price'] = fares[month + '-{0:02}'.format(i + 1)]['LowestFare']
-        except Exception as e:
-            reset_prices(data, num_of_days)
-            logger.error(failure_stat.format(Airline.VANILLA_AIR.value, repr(e)))
-        else:
-            logger.info(success_stat.format(Airline.VANILLA_AIR.value))
-
-        result.extend(data)
-
-    if Airline.SCOOT.value in airlines:
-        data = init_prices(month, num_of_days, 'Scoot')
-
-        # To be constructed... fetch Scoot fares
+    payload = {
+        'adults': '1',
+        'children': '0',
+        'infants': '0',
+        'originStation': origin,
+        'destinationStation': destination,
+        'departureDate': center.isoformat(),
+        'includeoverbooking': 'false',
+        'daysBeforeAndAfter': str(TIGERAIR_TAIWAN_HALF_WIDTH),
+        'locale': 'zh-TW'
+    }
+    return TIGERAIR_TAIWAN_URL, payload, {}
+
+def parse_tigerair_taiwan_window(text):
+    js = json.loads(text)
+    fares = js['journeyDateMarkets'][0]['lowFares']['lowestFares']
+    return {fare['date'][:10]: int(fare['price']) if fare['price'] > 0 else 0 for fare in fares}
+
+def vanilla_air_routes_request():
+    # In Vanilla's system, additional search for transit is needed
+    payload = {
+        '__ts': int(time() * 1000),
+        'version': '1.1'
+    }
+    return VANILLA_AIR_ROUTES_URL, payload, {}
 
-        result.extend(data)
+def parse_vanilla_air_transit(text, origin, destination):
+    js = json.loads(text)
+    for route in js['Result']:
+        if route['BoardPoint'] == origin and route['OffPoint'] == destination:
+            return route['TransitPoint']
+    return None
 
-    if Airline.PEACH_AVIATION.value in airlines:
-        data = init_prices(month, num_of_days, 'Peach Aviation')
+def vanilla_air_month_request(month, origin, destination, currency, transit):
+    # Use the API to fetch the JSON data directly
+    payload = {
+        '__ts': int(time() * 1000),
+        'adultCount': '1',
+        'childCount': '0',
+        'couponCode': '',
+        'currency': currency,
+        'destination': destination,
+        'infantCount': '0',
+        'isMultiFlight': 'true',
+        'origin': origin,
+        'searchCurrency': currency,
+        'targetMonth': month.replace('-', ''),
+        'version': '1.0',
+        'channel': 'pc'
+    }
+    if transit is not None:
+        payload['transitPoint'] = transit
+    return VANILLA_AIR_FARES_URL, payload, {}
 
-        # To be constructed... fetch Peach Aviation fares
+def parse_vanilla_air_month(text):
+    js = json.loads(text)
+    fares = js['Result'][0]['FareListOfDay']
+    return {date: fare['LowestFare'] for date, fare in fares.items()}
 
-        result.extend(data)
+def jetstar_window_request(center, origin, destination, currency):
     # Use requests and fake the browser to send GET requests as to fetch the data
-    if Airline.JETSTAR.value in airlines:
-        data = init_prices(month, num_of_days, 'Jetstar')
-        payload = {
-            'origin1': origin,
-            'destination1': destination,
-            'departuredate1': '',
-            'adults': '1',
-            'children': '0',
-            'infants': '0',
-            'currency': currency
-        }
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.84 Safari/537.36'
-        }
-        # Jetstar system shows data of a week for one search, so 5 times search is needed to cover the whole month
-        try:
-            for i in range(5):
-                payload['departuredate1'] = month + '-{0:02}'.format(i * 7 + 4 if i < 4 else 28)
-                response = requests.get('https://booking.jetstar.com/tw/zh/booking/search-flights', headers=headers, params=payload)
-                soup = BeautifulSoup(response.text, 'html.parser')
-                for li in soup.find_all('li', class_='date-selector__option'):
-                    date = re.search(r'departuredate1=(\d{4}-\d{2}-\d{2})', li.attrs['data-lowfare'])
-                    price = li.find('span', attrs={'data-amount': True})
-                    if data[int(date[1][-2:]) - 1]['Date'] == date[1] and price is not None and re.search(r'\d', price.text):
-                        data[int(date[1][-2:]) - 1]['Price'] = int(round(float(price.text.replace(',', ''))))
-        except Exception as e:
-            reset_prices(data, num_of_days)
-            logger.error(failure_stat.format(Airline.JETSTAR.value, repr(e)))
-        else:
-            logger.info(success_stat.format(Airline.JETSTAR.value))
-
-        result.extend(data)
-
-    return result
-
-def get_routes():
-    success_stat = 'Succeed on fetching route data of the airline with ID {0}'
-    failure_stat = 'Fail on fetching route data of the airline with ID {0} - {1}'
-    conn = sqlite3.connect(DB_LCC_PATH)
-    c = conn.cursor()
-    # Tigerair Taiwan
-    try:
-        response = requests.get('http://www.tigerairtw.com/en/')
-        data = json.loads(re.search(r'var StationList = (.+?);', response.text)[1])
-        c.execute('UPDATE Route SET IsActive = 0 WHERE AirlineId = ?',
-                  (Airline.TIGERAIR_TAIWAN.value, ))
-        for station in data['stations']:
-            if not station['airportCode'].startswith('X'):
-                c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                          (station['airportCode'], ))
-                if c.fetchone() is None:
-                    c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                              (station['airportCode'], ))
-
-                for market in station['markets']:
-                    if not market.startswith('X'):
-                        c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                                  (market, ))
-                        if c.fetchone() is None:
-                            c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                                      (market, ))
-
-                        c.execute('''SELECT r.Id FROM Route r
-                                     JOIN Airport fap ON r.FromAirportId = fap.Id
-                                     JOIN Airport tap ON r.ToAirportId = tap.Id
-                                     WHERE r.AirlineId = ? and fap.Code = ? and tap.Code = ?''',
-                                  (Airline.TIGERAIR_TAIWAN.value, station['airportCode'], market))
-                        if c.fetchone() is None:
-                            c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
-                                         SELECT ?, fap.Id, tap.Id, 1 FROM Airport fap, Airport tap
-                                         WHERE fap.Code = ? and tap.Code = ?''',
-                                      (Airline.TIGERAIR_TAIWAN.value, station['airportCode'], market))
-                        else:
-                            c.execute('''UPDATE Route SET IsActive = 1
-                                         WHERE AirlineId = ?
-                                         AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
-                                         AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
-                                      (Airline.TIGERAIR_TAIWAN.value, station['airportCode'], market))
-    except Exception as e:
-        conn.rollback()
-        logger.error(failure_stat.format(Airline.TIGERAIR_TAIWAN.value, repr(e)))
-    else:
-        conn.commit()
-        logger.info(success_stat.format(Airline.TIGERAIR_TAIWAN.value))
-
-    # Vanilla Air
-    try:
-        response = requests.get('https://www.vanilla-air.com/common/js/vnl.js')
-        text = response.text
-        for remove_line in set(re.findall(r'.*//.*', text)):
-            text = text.replace(remove_line, '')
-        data = json.loads(re.search(r'"oandd":({.+?})', re.sub(r'[\r\n\t ]', '', text))[1])
-        c.execute('UPDATE Route SET IsActive = 0 WHERE AirlineId = ?',
-                  (Airline.VANILLA_AIR.value, ))
-        for station in data:
-            c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                      (station, ))
-            if c.fetchone() is None:
-                c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                          (station, ))
-
-            for destination in data[station]:
-                c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                          (destination, ))
-                if c.fetchone() is None:
-                    c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                              (destination, ))
-
-                c.execute('''SELECT r.Id FROM Route r
-                             JOIN Airport fap ON r.FromAirportId = fap.Id
-                             JOIN Airport tap ON r.ToAirportId = tap.Id
-                             WHERE r.AirlineId = ? and fap.Code = ? and tap.Code = ?''',
-                          (Airline.VANILLA_AIR.value, station, destination))
-                if c.fetchone() is None:
-                    c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
-                                 SELECT ?, fap.Id, tap.Id, 1 FROM Airport fap, Airport tap
-                                 WHERE fap.Code = ? and tap.Code = ?''',
-                              (Airline.VANILLA_AIR.value, station, destination))
-                else:
-                    c.execute('''UPDATE Route SET IsActive = 1
-                                 WHERE AirlineId = ?
-                                 AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
-                                 AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
-                              (Airline.VANILLA_AIR.value, station, destination))
-    except Exception as e:
-        conn.rollback()
-        logger.error(failure_stat.format(Airline.VANILLA_AIR.value, repr(e)))
-    else:
-        conn.commit()
-        logger.info(success_stat.format(Airline.VANILLA_AIR.value))
-
-    # Scoot
+    payload = {
+        'origin1': origin,
+        'destination1': destination,
+        'departuredate1': center.isoformat(),
+        'adults': '1',
+        'children': '0',
+        'infants': '0',
+        'currency': currency
+    }
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/63.0.3239.84 Safari/537.36'
+    }
+    return JETSTAR_URL, payload, headers
+
+def parse_jetstar_window(text):
+    # Imported on first use, as only Jetstar needs an HTML parser
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(text, 'html.parser')
+    prices = {}
+    for li in soup.find_all('li', class_='date-selector__option'):
+        date = re.search(r'departuredate1=(\d{4}-\d{2}-\d{2})', li.attrs['data-lowfare'])
+        price = li.find('span', attrs={'data-amount': True})
+        if price is not None and re.search(r'\d', price.text):
+            prices[date[1]] = int(round(float(price.text.replace(',', ''))))
+    return prices
+
+def fetch_page(request, parse, timeout=REQUEST_TIMEOUT, label=''):
+    # request is a tuple of (URL, query parameters, headers), shared with the async client of aservice.py.
+    # The HTTP request and the parsing are timed apart under the label, the lowercase name of the airline
+    url, params, headers = request
     try:
-        response = requests.get('https://www.flyscoot.com/en/')
-        data = json.loads(re.search(r'<script id="city_pairs_data">(.+?)</script>', response.text)[1])
-        c.execute('UPDATE Route SET IsActive = 0 WHERE AirlineId = ?',
-                  (Airline.SCOOT.value, ))
-        for country in data[0]:
-            for airport in country['markets']:
-                c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                          (airport['origin']['station_code'], ))
-                if c.fetchone() is None:
-                    c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                              (airport['origin']['station_code'], ))
-
-                for dest_country in airport['destinations']:
-                    for destination in dest_country['destinations']:
-                        c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                                  (destination['station_code'], ))
-                        if c.fetchone() is None:
-                            c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                                      (destination['station_code'], ))
-
-                        c.execute('''SELECT r.Id FROM Route r
-                                     JOIN Airport fap ON r.FromAirportId = fap.Id
-                                     JOIN Airport tap ON r.ToAirportId = tap.Id
-                                     WHERE r.AirlineId = ? and fap.Code = ? and tap.Code = ?''',
-                                  (Airline.SCOOT.value, airport['origin']['station_code'], destination['station_code']))
-                        if c.fetchone() is None:
-                            c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
-                                         SELECT ?, fap.Id, tap.Id, 1 FROM Airport fap, Airport tap
-                                         WHERE fap.Code = ? and tap.Code = ?''',
-                                      (Airline.SCOOT.value, airport['origin']['station_code'], destination['station_code']))
-                        else:
-                            c.execute('''UPDATE Route SET IsActive = 1
-                                         WHERE AirlineId = ?
-                                         AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
-                                         AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
-                                      (Airline.SCOOT.value, airport['origin']['station_code'], destination['station_code']))
-    except Exception as e:
-        conn.rollback()
-        logger.error(failure_stat.format(Airline.SCOOT.value, repr(e)))
-    else:
-        conn.commit()
-        logger.info(success_stat.format(Airline.SCOOT.value))
-
-    # Peach Aviation
+        with timer(upstream_seconds, label):
+            response = http_get(url, params=params, headers=headers, timeout=timeout)
+        if response.status_code in FAILURE_STATUSES:
+            raise UpstreamError(response.status_code, url)
+    except Exception:
+        upstream_errors.inc(label)
+        raise
+    upstream_bytes.observe(len(response.content), label)
+    with timer(parse_seconds, label):
+        return parse(response.text)
+
+def get_vanilla_air_transit(origin, destination, timeout=REQUEST_TIMEOUT):
+    return fetch_page(vanilla_air_routes_request(), lambda text: parse_vanilla_air_transit(text, origin, destination),
+                      timeout, Airline.VANILLA_AIR.name.lower())
+
+def plan_requests(airline, segments, origin, destination, currency, transit=None):
+    # The fewest upstream requests covering the (start, end) date segments, as (request, parse) pairs.
+    # Vanilla Air needs the transit point of the route, looked up beforehand
+    if airline == Airline.TIGERAIR_TAIWAN:
+        return [(tigerair_taiwan_window_request(center, origin, destination, currency), parse_tigerair_taiwan_window)
+                for start, end in segments for center in plan_windows(start, end, TIGERAIR_TAIWAN_HALF_WIDTH)]
+    if airline == Airline.VANILLA_AIR:
+        months = sorted(set(month for start, end in segments for month in plan_months(start, end)))
+        return [(vanilla_air_month_request(month, origin, destination, currency, transit), parse_vanilla_air_month)
+                for month in months]
+    if airline == Airline.JETSTAR:
+        # Jetstar system shows data of a week for one search
+        return [(jetstar_window_request(center, origin, destination, currency), parse_jetstar_window)
+                for start, end in segments for center in plan_windows(start, end, JETSTAR_HALF_WIDTH)]
+
+    # To be constructed... fetch Scoot and Peach Aviation fares
+    return []
+
+def get_paced_timeout(deadline, waited):
+    # Timeout of the next paced request, failing as an unpaced fetch does once the deadline has passed
+    remaining = deadline + waited - time()
+    if remaining <= 0:
+        raise FutureTimeoutError('the deadline passed while pacing the requests')
+    return min(REQUEST_TIMEOUT, remaining)
+
+def fetch_prices(airline, segments, prices, start, origin, destination, currency, deadline, pace=None):
+    # Run the planned requests in parallel and write their prices into the array of days from start,
+    # every page fetched is kept in the fare history as well. Skipped while the breaker of the airline is open.
+    # With pace, as given by prewarm.py, the requests are sent one after another from this thread, each once
+    # pace() has waited for the turn of the airline's site, and the seconds waited are left out of the latency
+    # and of the deadline, which the time spent upstream is held to before every page
+    breaker = breakers[airline]
+    if not breaker.allow():
+        raise CircuitOpen('the circuit breaker of the airline is open')
+    fetch_start = time()
+    waited = 0
+    label = airline.name.lower()
     try:
-        response = requests.get('http://www.flypeach.com/widget/widgetvars.js')
-        response.encoding = 'UTF-8'
-        data = json.loads(re.search(r'routes:(.+?),landingPages:', re.sub(r'[\r\n\t ]', '', response.text))[1].replace('ori', '"ori"').replace('dest', '"dest"'))
-        c.execute('UPDATE Route SET IsActive = 0 WHERE AirlineId = ?',
-                  (Airline.PEACH_AVIATION.value, ))
-        for route in data:
-            c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                      (route['ori'], ))
-            if c.fetchone() is None:
-                c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                          (route['ori'], ))
-            c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                      (route['dest'], ))
-            if c.fetchone() is None:
-                c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                          (route['dest'], ))
-
-            c.execute('''SELECT r.Id FROM Route r
-                         JOIN Airport fap ON r.FromAirportId = fap.Id
-                         JOIN Airport tap ON r.ToAirportId = tap.Id
-                         WHERE r.AirlineId = ? and fap.Code = ? and tap.Code = ?''',
-                      (Airline.PEACH_AVIATION.value, route['ori'], route['dest']))
-            if c.fetchone() is None:
-                c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
-                             SELECT ?, fap.Id, tap.Id, 1 FROM Airport fap, Airport tap
-                             WHERE fap.Code = ? and tap.Code = ?''',
-                          (Airline.PEACH_AVIATION.value, route['ori'], route['dest']))
+        # No single request may outlive the deadline of the whole airline
+        timeout = min(REQUEST_TIMEOUT, max(deadline - time(), 0.1))
+        transit = None
+        if airline == Airline.VANILLA_AIR:
+            if pace is not None:
+                waited += pace()
+                timeout = get_paced_timeout(deadline, waited)
+            transit = get_vanilla_air_transit(origin, destination, timeout)
+        pages = plan_requests(airline, segments, origin, destination, currency, transit)
+        if pace is None:
+            futures = [submit(page_executor, fetch_page, request, parse, timeout, label) for request, parse in pages]
+        for idx, (request, parse) in enumerate(pages):
+            if pace is None:
+                fares = futures[idx].result(timeout=max(deadline - time(), 0))
             else:
-                c.execute('''UPDATE Route SET IsActive = 1
-                             WHERE AirlineId = ?
-                             AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
-                             AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
-                          (Airline.PEACH_AVIATION.value, route['ori'], route['dest']))
-    except Exception as e:
-        conn.rollback()
-        logger.error(failure_stat.format(Airline.PEACH_AVIATION.value, repr(e)))
-    else:
-        conn.commit()
-        logger.info(success_stat.format(Airline.PEACH_AVIATION.value))
-
-    # Jetstar
-    driver = webdriver.Chrome()
-    wait = WebDriverWait(driver, 10)
-    try:
-        c.execute('UPDATE Route SET IsActive = 0 WHERE AirlineId = ?',
-                  (Airline.JETSTAR.value, ))
-        driver.get('http://www.jetstar.com/tw/zh/home')
-        driver.execute_script('document.querySelector("button[data-direction-id = origin]").click();')
-        soup = BeautifulSoup(driver.page_source, 'html.parser')
-        panel_from = soup.find('div', id='origin-panel01')
-        for idx, airport_from in enumerate(panel_from.find_all('button', attrs={'data-value': True})):
-            driver.execute_script('document.querySelector("#origin-panel01 button[data-value = \'{0}\']").click();'.format(airport_from.attrs['data-value']))
-            if idx != 0:
-                wait.until(EC.url_changes(driver.current_url))
-            driver.execute_script('document.querySelector("button[data-direction-id = destination]").click();')
-            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, 'button[data-direction-id = destination][aria-expanded = true]')))
-            soup = BeautifulSoup(driver.page_source, 'html.parser')
-            panel_to = soup.find('div', id='destination-panel01')
-            for airport_to in panel_to.find_all('button', attrs={'data-value': True}):
-                driver.execute_script('document.querySelector("#destination-panel01 button[data-value = \'{0}\']").click();'.format(airport_to.attrs['data-value']))
-                wait.until(EC.url_changes(driver.current_url))
-                codes = re.search(r'origin=([A-Z]{3})&destination=([A-Z]{3})', driver.current_url)
-                c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                          (codes[1], ))
-                if c.fetchone() is None:
-                    c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                              (codes[1], ))
-                c.execute('SELECT Id FROM Airport WHERE Code = ?',
-                          (codes[2], ))
-                if c.fetchone() is None:
-                    c.execute('INSERT INTO Airport (Code) VALUES (?)',
-                              (codes[2], ))
-
-                c.execute('''SELECT r.Id FROM Route r
-                             JOIN Airport fap ON r.FromAirportId = fap.Id
-                             JOIN Airport tap ON r.ToAirportId = tap.Id
-                             WHERE r.AirlineId = ? and fap.Code = ? and tap.Code = ?''',
-                          (Airline.JETSTAR.value, codes[1], codes[2]))
-                if c.fetchone() is None:
-                    c.execute('''INSERT INTO Route (AirlineId, FromAirportId, ToAirportId, IsActive)
-                                 SELECT ?, fap.Id, tap.Id, 1 FROM Airport fap, Airport tap
-                                 WHERE fap.Code = ? and tap.Code = ?''',
-                              (Airline.JETSTAR.value, codes[1], codes[2]))
-                else:
-                    c.execute('''UPDATE Route SET IsActive = 1
-                                 WHERE AirlineId = ?
-                                 AND FromAirportId = (SELECT Id FROM Airport WHERE Code = ?)
-                                 AND ToAirportId = (SELECT Id FROM Airport WHERE Code = ?)''',
-                              (Airline.JETSTAR.value, codes[1], codes[2]))
-    except Exception as e:
-        conn.rollback()
-        logger.error(failure_stat.format(Airline.JETSTAR.value, repr(e)))
-    else:
-        conn.commit()
-        logger.info(success_stat.format(Airline.JETSTAR.value))
-
-    driver.quit()
-
-    # Update English information of airports
-    capital = None
-    c.execute('SELECT Code FROM Airport ORDER BY Code')
-    for row in c.fetchall():
-        try:
-            if row[0][0] != capital:
-                capital = row[0][0]
-                response = requests.get('https://en.wikipedia.org/wiki/List_of_airports_by_IATA_code:_' + capital)
-                soup = BeautifulSoup(response.text, 'html.parser')
-                table = soup.find('table', class_='wikitable sortable')
-            tds = table.find(string=row[0]).find_parent('tr').find_all('td')
-            airport_name = re.split(r'[\[\(\d]', tds[2].text)[0].strip()
-            country_name = re.sub(r'\d', '', tds[3].text.split(',')[-1]).strip()
-            c.execute('SELECT Id FROM Country WHERE Name = ?',
-                      (country_name, ))
-            if c.fetchone() is None:
-                c.execute('INSERT INTO Country (Name) VALUES (?)',
-                          (country_name, ))
-            c.execute('UPDATE Airport SET Name = ?, CountryId = (SELECT Id FROM Country WHERE Name = ?) WHERE Code = ?',
-                      (airport_name, country_name, row[0]))
-        except Exception as e:
-            logger.error('Fail on updating English info of the airport with code {0} - {1}'.format(row[0], repr(e)))
-
-    # Update Chinese information of airports
-    capital = None
-    c.execute('SELECT Code FROM Airport ORDER BY Code')
-    for row in c.fetchall():
-        try:
-            if row[0][0] != capital:
-                capital = row[0][0]
-                response = requests.get('https://zh.wikipedia.org/wiki/%E5%9B%BD%E9%99%85%E8%88%AA%E7%A9%BA%E8%BF%90%E8%BE%93%E5%8D%8F%E4%BC%9A%E6%9C%BA%E5%9C%BA%E4%BB%A3%E7%A0%81_(' + capital + ')')
-                soup = BeautifulSoup(response.text, 'html.parser')
-                table = soup.select('table.wikitable.sortable')[0]
-            tds = table.find(string=row[0]).find_parent('tr').find_all('td')
-            # Pages of these capitals have a different webpage structure
-            start_idx = 1 if capital in ['H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'R', 'S', 'T', 'U'] else 2
-            airport_name = tds[start_idx].text.split('（')[0].strip()
-            country_name = tds[start_idx + 2].text.strip()
-            c.execute('UPDATE Country SET NameZhTW = ? WHERE Id = (SELECT CountryId FROM Airport WHERE Code = ?)',
-                      (HanziConv.toTraditional(country_name), row[0]))
-            if re.search(r'[A-Za-z]', airport_name) is None:
-                c.execute('UPDATE Airport SET NameZhTW = ? WHERE Code = ?',
-                          (HanziConv.toTraditional(airport_name), row[0]))
-        except Exception as e:
-            logger.error('Fail on updating Chinese info of the airport with code {0} - {1}'.format(row[0], repr(e)))
-
-    # Update currency codes of countries
-    c.execute('SELECT Name FROM Country')
-    for row in c.fetchall():
-        try:
-            response = requests.get('https://en.wikipedia.org/wiki/List_of_circulating_currencies')
-            soup = BeautifulSoup(response.text, 'html.parser')
-            tds = soup.find('table', class_='wikitable sortable').find(string=row[0]).find_parent('tr').find_all('td')
-            currency_code = tds[3].text.strip()
-            c.execute('UPDATE Country SET Currency = ? WHERE Name = ?',
-                      (currency_code, row[0]))
-        except Exception as e:
-            logger.error('Fail on updating the currency of the country {0} - {1}'.format(row[0], repr(e)))
-
-    conn.commit()
-    conn.close()
+                waited += pace()
+                fares = fetch_page(request, parse, get_paced_timeout(deadline, waited), label)
+            fare_history.record(airline.value, origin, destination, fares)
+            fill_prices(prices, start, fares)
+    except UPSTREAM_FAILURES:
+        breaker.record_failure()
+        airline_fetch_seconds.observe(time() - fetch_start - waited, label, 'error')
+        raise
+    except Exception:
+        # e.g. a page of a new layout or a route without fares, which one bad route must not open the breaker with
+        breaker.release()
+        airline_fetch_seconds.observe(time() - fetch_start - waited, label, 'error')
+        raise
+    breaker.record_success(time() - fetch_start - waited)
+    airline_fetch_seconds.observe(time() - fetch_start - waited, label, 'ok')
+    return prices
+
+def fetch_month(airline, month, origin, destination, currency, deadline, pace=None):
+    start, num_of_days = get_month_axis(month)
+    return fetch_prices(airline, [(start, start.replace(day=num_of_days))], new_prices(num_of_days), start,
+                        origin, destination, currency, deadline, pace)
+
+AIRLINE_NAMES = {
+    Airline.TIGERAIR_TAIWAN: 'Tigerair Taiwan',
+    Airline.VANILLA_AIR: 'Vanilla Air',
+    Airline.SCOOT: 'Scoot',
+    Airline.PEACH_AVIATION: 'Peach Aviation',
+    Airline.JETSTAR: 'Jetstar'
+}
+
+# Airlines are fetched in parallel, and pages of one airline (e.g. Jetstar weeks) in another pool
+# so that an airline waiting for its pages never starves the pool it is running in
+airline_executor = ThreadPoolExecutor(max_workers=len(Airline) * 4)
+page_executor = ThreadPoolExecutor(max_workers=20)
+
+fare_cache = FareCache(FARE_CACHE_TTLS, FARE_CACHE_MAX_BYTES, FARE_CACHE_DB_PATH)
+fare_history = HistoryWriter()
+# Upstream health of each airline, its timeout adapting to the latency seen up to AIRLINE_TIMEOUTS
+breakers = {airline: CircuitBreaker(AIRLINE_TIMEOUTS[airline]) for airline in Airline}
+job_queue = create_queue(FETCH_QUEUE_BACKEND, FETCH_QUEUE_PATH) if FETCH_QUEUE_BACKEND is not None else None
+
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 0.5, 'open': 1}
+# Metrics of the hot paths exported on /metrics, labelled by the lowercase name of the airline
+upstream_seconds = Histogram('lcc_upstream_request_seconds', 'Seconds of single upstream HTTP requests', ('airline', ))
+upstream_bytes = Histogram('lcc_upstream_response_bytes', 'Bytes of upstream responses', ('airline', ), SIZE_BUCKETS)
+upstream_errors = Counter('lcc_upstream_errors_total', 'Failed or timed out upstream HTTP requests', ('airline', ))
+parse_seconds = Histogram('lcc_parse_seconds', 'Seconds of parsing upstream responses', ('airline', ))
+airline_fetch_seconds = Histogram('lcc_airline_fetch_seconds', 'Seconds of fetching all the pages of an airline',
+                                  ('airline', 'result'))
+fallbacks = Counter('lcc_fallbacks_total', 'Airlines served stale or zeroed fares after failing', ('airline', 'kind'))
+render_seconds = Histogram('lcc_render_seconds', 'Seconds of rendering the chart and the table', ('part', ))
+# Recorded by service.py and aservice.py
+request_seconds = Histogram('lcc_request_seconds', 'Seconds of handling requests', ('endpoint', 'status'))
+db_seconds = Histogram('lcc_db_seconds', 'Seconds of SQLite queries', ('query', ))
+Gauge('lcc_fare_cache', 'Counters and size of the fare cache', lambda: {(key, ): value for key, value in fare_cache.stats().items()},
+      ('stat', ))
+Gauge('lcc_fare_cache_hit_ratio', 'Share of fare cache lookups served from the cache', lambda: get_hit_ratio(fare_cache.stats()))
+Gauge('lcc_fare_cache_prewarmed_hit_ratio', 'Share of fare cache lookups served from fares cached by prewarm.py',
+      lambda: {(): get_cache_stats()['prewarmed_hit_ratio']})
+Gauge('lcc_fare_history', 'Observations written, dropped and queued by the history writer',
+      lambda: {(key, ): value for key, value in fare_history.stats().items()}, ('stat', ))
+Gauge('lcc_breaker_open', 'Whether the circuit breaker of the airline is open (1), half open (0.5) or closed (0)',
+      lambda: {(airline.name.lower(), ): BREAKER_STATE_VALUES[breaker.state] for airline, breaker in breakers.items()},
+      ('airline', ))
+Gauge('lcc_airline_timeout_seconds', 'Current adaptive timeout of the airline',
+      lambda: {(airline.name.lower(), ): breaker.get_timeout() for airline, breaker in breakers.items()}, ('airline', ))
+def get_hit_ratio(stats):
+    lookups = stats['hits'] + stats['misses']
+    return {(): stats['hits'] / lookups if lookups else 0}
+
+def get_cache_stats():
+    # The counters of the fare cache with the share of its lookups served from pre-warmed fares
+    stats = fare_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    stats['prewarmed_hit_ratio'] = stats['prewarmed_hits'] / lookups if lookups else 0
+    return stats
+
+def fetch_queued(key, deadline):
+    # Queue the fetch for worker.py and wait for its prices to land in the FareCache table,
+    # loading them into the memory of the cache as the worker stored them
+    job_id = job_queue.put(key)
+    while time() < deadline:
+        entry = fare_cache.load(key)
+        if entry is not None:
+            return entry[0]
+        state = job_queue.get_state(job_id)
+        if state is not None and state[0] == FAILED:
+            raise RuntimeError('the fetch job failed - {0}'.format(state[1]))
+        sleep(JOB_POLL_INTERVAL)
+    raise TimeoutError('the fetch job was not done in time')
+
+def fetch_cached(airline, month, origin, destination, currency, deadline, prewarm=False, pace=None):
+    # With a queue, the searches leave the fetch to the workers, pre-warming still fetches on its own
+    key = (airline.value, origin, destination, month, currency)
+    if job_queue is not None and not prewarm:
+        return fare_cache.get_or_fetch(key, lambda: fetch_queued(key, deadline), stored=True)
+    return fare_cache.get_or_fetch(
+        key,
+        lambda: fetch_month(airline, month, origin, destination, currency, deadline, pace),
+        prewarm)
+
+def get_fresh_seconds(month, origin, destination, airlines, currency):
+    # Seconds until the first of the cached fares of a search expires, 0 when any of them is not cached
+    seconds = None
+    for airline_id in airlines:
+        if airline_id not in FARE_CACHE_TTLS:
+            continue
+        fetched_at = fare_cache.fetched_at((airline_id, origin, destination, month, currency))
+        if fetched_at is None:
+            return 0
+        remaining = fetched_at + FARE_CACHE_TTLS[airline_id] - time()
+        seconds = remaining if seconds is None else min(seconds, remaining)
+    return max(int(seconds or 0), 0)
+
+def prewarm_fares(airline, month, origin, destination, currency, pace=None):
+    # Fetch the fares into the cache ahead of the users, used by prewarm.py with pace waiting before each request
+    return fetch_cached(airline, month, origin, destination, currency, time() + AIRLINE_TIMEOUTS[airline], True, pace)
+
+def fetch_range(airline, start, end, origin, destination, currency, deadline):
+    # Whole months of the range found in the cache are copied in, the other dates are planned together
+    prices = new_prices((end - start).days + 1)
+    segments = []
+    for month in plan_months(start, end):
+        first = max(dt.date(int(month[:4]), int(month[5:]), 1), start)
+        last = min(first.replace(day=monthrange(first.year, first.month)[1]), end)
+        if first.day == 1 and last.day == monthrange(last.year, last.month)[1]:
+            cached = fare_cache.peek((airline.value, origin, destination, month, currency))
+            if cached is not None:
+                offset = (first - start).days
+                prices[offset:offset + len(cached)] = cached
+                continue
+        if segments and segments[-1][1] + dt.timedelta(days=1) == first:
+            segments[-1] = (segments[-1][0], last)
+        else:
+            segments.append((first, last))
+    if segments:
+        fetch_prices(airline, segments, prices, start, origin, destination, currency, deadline)
+    return prices
+
+def iter_airlines(airlines, fetch, num_of_days, fallback=None):
+    # Run fetch(airline, deadline) for every requested airline at the same time, and yield
+    # (airline, prices, stale) in the order they arrive. A failed or late airline is served
+    # by fallback(airline), its last cached (prices, fetched time) however old, with stale
+    # set to that time, or by zeroed prices when there is nothing cached
+    success_stat = 'Succeed on getting fares of the airline with ID {0}'
+    failure_stat = 'Fail on getting fares of the airline with ID {0} - {1}'
 
-def get_visualized_data(fares):
-    data = pd.DataFrame(fares)
+    def fall_back(airline):
+        cached = fallback(airline) if fallback is not None else None
+        if cached is None:
+            fallbacks.inc(airline.name.lower(), 'zeroed')
+            return airline, new_prices(num_of_days), None
+        fallbacks.inc(airline.name.lower(), 'stale')
+        return airline, cached[0], cached[1]
+
+    start = time()
+    global_deadline = start + FETCH_DEADLINE
+    pending = {}
+    for airline in Airline:
+        if airline.value in airlines:
+            deadline = min(start + breakers[airline].get_timeout(), global_deadline)
+            future = submit(airline_executor, fetch, airline, deadline)
+            pending[future] = (airline, deadline)
+
+    while pending:
+        done, _ = wait(pending, timeout=max(min(d for a, d in pending.values()) - time(), 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            airline, deadline = pending.pop(future)
+            try:
+                data = future.result()
+            except Exception as e:
+                logger.error(failure_stat.format(airline.value, repr(e)))
+                yield fall_back(airline)
+            else:
+                logger.info(success_stat.format(airline.value))
+                yield airline, data, None
+        # Airlines past their deadline are given up
+        for future, (airline, deadline) in list(pending.items()):
+            if deadline <= time():
+                del pending[future]
+                future.cancel()
+                logger.error(failure_stat.format(airline.value, 'timed out after {0:.1f}s'.format(time() - start)))
+                yield fall_back(airline)
+
+def iter_fares(month, origin, destination, airlines, currency):
+    return iter_airlines(
+        airlines,
+        lambda airline, deadline: fetch_cached(airline, month, origin, destination, currency, deadline),
+        get_month_axis(month)[1],
+        lambda airline: fare_cache.peek_stale((airline.value, origin, destination, month, currency)))
+
+def iter_fare_range(start, end, origin, destination, airlines, currency):
+    return iter_airlines(
+        airlines,
+        lambda airline, deadline: fetch_range(airline, start, end, origin, destination, currency, deadline),
+        (end - start).days + 1)
+
+def merge_fares(fares):
+    # The same matrix with the airlines in the order of the Airline enum
+    result = FareMatrix(fares.start, fares.num_of_days)
+    for airline in Airline:
+        if airline in fares.rows:
+            result.add(airline, fares.rows[airline], fares.stale.get(airline))
+    return result
 
-    # altair line chart
-    chart = alt.Chart(data).mark_line().encode(
-        color='Airline:N',
-        x='Date:O',
-        y='Price:Q'
-    )
+def collect_fares(fares, rows):
+    for airline, prices, stale in rows:
+        fares.add(airline, prices, stale)
+    return merge_fares(fares)
 
-    # plotly table
-    trace = go.Table(
-        header={
-            'values': data.columns,
-            'fill': {
-                'color': '#a1c3d1'
-            },
-            'align': ['center']
+def get_fares(month, origin, destination, airlines, currency):
+    return collect_fares(FareMatrix(*get_month_axis(month)), iter_fares(month, origin, destination, airlines, currency))
+
+def get_fare_range(start, end, origin, destination, airlines, currency):
+    # Fares of any span of dates up to RANGE_MAX_DAYS, e.g. 90 days or a few days around a date
+    if end < start or (end - start).days >= RANGE_MAX_DAYS:
+        raise ValueError('invalid date range {0} - {1}'.format(start, end))
+    return collect_fares(FareMatrix(start, (end - start).days + 1),
+                         iter_fare_range(start, end, origin, destination, airlines, currency))
+
+# Skeletons of the Vega-Lite line chart and the Plotly table, serialized once with placeholders for the fares
+FARES_PLACEHOLDER = '"@FARES@"'
+LINE_SPEC_TEMPLATE = json.dumps({
+    'mark': 'line',
+    'encoding': {
+        'color': {
+            'field': 'Airline',
+            'type': 'nominal'
         },
-        cells={
-            'values': [data.Airline, data.Date, data.Price],
-            'fill': {
-                'color': '#EDFAFF'
-            },
-            'align': ['center']
-        })
-    fig = {
-        'data': [trace]
+        'x': {
+            'field': 'Date',
+            'type': 'ordinal'
+        },
+        'y': {
+            'field': 'Price',
+            'type': 'quantitative'
+        }
+    },
+    'data': {
+        'values': '@FARES@'
     }
+}, sort_keys=True).split(FARES_PLACEHOLDER)
+TABLE_TRACE_TEMPLATE = json.dumps([{
+    'type': 'table',
+    'header': {
+        'values': ['Airline', 'Date', 'Price'],
+        'fill': {
+            'color': '#a1c3d1'
+        },
+        'align': ['center']
+    },
+    'cells': {
+        'values': '@FARES@',
+        'fill': {
+            'color': '#EDFAFF'
+        },
+        'align': ['center']
+    }
+}]).replace('"', '\'').split(FARES_PLACEHOLDER.replace('"', '\''))
+# The div is appended to the page, so double quotes are swapped for single ones as offline.plot used to be
+TABLE_DIV_TEMPLATE = ('<div id=\'{0}\' style=\'height: 100%; width: 100%;\' class=\'plotly-graph-div\'></div>'
+                      '<script type=\'text/javascript\'>window.PLOTLYENV=window.PLOTLYENV || {{}};'
+                      'window.PLOTLYENV.BASE_URL=\'https://plot.ly\';'
+                      'Plotly.newPlot(\'{0}\', {1}, {{}}, {{\'showLink\': true, \'linkText\': \'Export to plot.ly\'}})</script>')
+
+def get_line_values(fares):
+    # The JSON of a list of {'Airline', 'Date', 'Price'} records, written straight from the arrays
+    dates = fares.get_dates()
+    records = []
+    for airline, prices in fares.rows.items():
+        prefix = '{"Airline": ' + json.dumps(AIRLINE_NAMES[airline]) + ', "Date": "'
+        records.extend('{0}{1}", "Price": {2}}}'.format(prefix, date, price) for date, price in zip(dates, prices))
+    return '[' + ', '.join(records) + ']'
+
+def get_line_spec(fares):
+    # Vega-Lite line chart
+    with timer(render_seconds, 'line'):
+        return LINE_SPEC_TEMPLATE[0] + get_line_values(fares) + LINE_SPEC_TEMPLATE[1]
+
+def get_table(fares):
+    # plotly table
+    with timer(render_seconds, 'table'):
+        airlines = []
+        dates = []
+        prices = []
+        for airline, row in fares.rows.items():
+            airlines.extend([AIRLINE_NAMES[airline]] * fares.num_of_days)
+            dates.extend(fares.get_dates())
+            prices.extend(row)
+        cells = json.dumps([airlines, dates, prices]).replace('"', '\'')
+        trace = TABLE_TRACE_TEMPLATE[0] + cells + TABLE_TRACE_TEMPLATE[1]
+        return TABLE_DIV_TEMPLATE.format(uuid.uuid4(), trace)
+
+def get_stale(fares):
+    # Airlines served from stale cached fares, with the UNIX time those fares were fetched
+    return [{
+        'airline': airline.value,
+        'fetchedAt': fetched_at
+    } for airline, fetched_at in fares.stale.items()]
 
+def get_visualized_data(fares):
     return {
-        'line': chart.to_json(),
-        'table': offline.plot(fig, include_plotlyjs = False, output_type = 'div').replace('"', '\'')
+        'line': get_line_spec(fares),
+        'table': get_table(fares),
+        'stale': get_stale(fares)
     }
-
-if __name__ == '__main__':
-    get_routes()
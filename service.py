@@ -2,11 +2,23 @@ import logging
 from logging.handlers import RotatingFileHandler
 import sqlite3
 import json
-import functools
+import datetime as dt
+from time import time, perf_counter
 
-from flask import Flask, request, render_template, g, abort
+from flask import Flask, Response, request, render_template, g, abort
 
-from server import get_fares, get_visualized_data
+from server import (RANGE_MAX_DAYS, Airline, breakers, fare_history, get_cache_stats, get_fares, iter_fares, get_fare_range, merge_fares,
+                    get_visualized_data, get_line_spec, get_table, get_stale, get_fresh_seconds, request_seconds, db_seconds)
+from metrics import TRACE_HEADER, render, timer, start_trace, stop_trace, format_server_timing
+from migrations import migrate
+from catalog import get_catalog
+from httpcache import choose_encoding, compress
+from fares import FareMatrix, get_month_axis
+from itinerary import MAX_STOPS, ITINERARY_DEADLINE, search_itineraries
+from explore import EXPLORE_TOP_K, EXPLORE_MAX_TOP_K, explore
+from watch import add_watch, cancel_watch
+from history import HISTORY_DB_PATH, HISTORY_MIGRATIONS, connect_readonly, get_trend, get_cheapest, get_lowest
+from prewarm import Prewarmer
 
 # Set the logger
 rfh = RotatingFileHandler('service.log', maxBytes=10240)
@@ -17,6 +29,11 @@ app.logger.addHandler(rfh)
 
 DB_LCC_PATH = 'lcc.db'
 
+# Bring the schema up to date before serving any request
+migrate(DB_LCC_PATH)
+migrate(HISTORY_DB_PATH, HISTORY_MIGRATIONS)
+get_catalog(DB_LCC_PATH)
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
@@ -24,94 +41,317 @@ def get_db():
         db.execute("PRAGMA foreign_keys = ON")
     return db
 
+def get_history_db():
+    db = getattr(g, '_history_database', None)
+    if db is None:
+        db = g._history_database = connect_readonly(HISTORY_DB_PATH)
+    return db
+
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
         db.close()
+    db = getattr(g, '_history_database', None)
+    if db is not None:
+        db.close()
+
+@app.before_request
+def start_request():
+    g._request_start = perf_counter()
+    start_trace(TRACE_HEADER in request.headers)
+
+@app.after_request
+def finish_request(response):
+    # Responses not compressed in advance are compressed here, except the streamed ones
+    if (response.status_code == 200 and not response.is_streamed and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers
+            and response.mimetype in ('application/json', 'text/html', 'text/plain')):
+        body = response.get_data()
+        encoding = choose_encoding(request.accept_encodings, len(body))
+        if encoding is not None:
+            response.set_data(compress(body, encoding))
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    # Streamed responses are timed up to their first byte
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_seconds.observe(perf_counter() - g._request_start, endpoint, response.status_code)
+    spans = stop_trace()
+    if spans:
+        response.headers['Server-Timing'] = format_server_timing(spans)
+    return response
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-def compare(str_a, str_b):
-    if str_a == 'Other' or str_a > str_b:
-        return 1
-    return -1
+def get_catalog_response(catalog, body):
+    # The catalog responses only change with the catalog version, so the browsers revalidate them on every use
+    # and get a 304 without a body until get_routes bumps it. Their compressed bodies are kept in the catalog
+    etag = 'catalog-{0}'.format(catalog.version)
+    last_modified = int(catalog.updated_at)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        not_modified = since is not None and since.replace(tzinfo=dt.timezone.utc).timestamp() >= last_modified
+    if not_modified:
+        response = Response(status=304)
+    else:
+        encoding = choose_encoding(request.accept_encodings, len(body))
+        response = Response(catalog.get_compressed(body, encoding) if encoding is not None else body, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
 
-@app.route('/airport_codes', methods=['POST'])
+@app.route('/airport_codes', methods=['GET', 'POST'])
 def get_airport_codes():
-    if 'id' not in request.form:
+    if 'id' not in request.values:
         app.logger.error('missing the parameter - id')
         abort(404)
 
-    db = get_db()
-    c = db.cursor()
-    result = []
     # If id is 'ALL', showing all airports, otherwise showing the corresponding destination airports
-    if request.form['id'] == 'ALL':
-        c.execute('''SELECT a.Id, a.Code, a.Name, IFNULL(c.Name, "Other") CountryName FROM Airport a
-                     LEFT JOIN Country c ON a.CountryId = c.Id''')
-    else:
-        c.execute('''SELECT DISTINCT a.Id, a.Code, a.Name, IFNULL(c.Name, "Other") CountryName FROM Route r
-                     JOIN Airport a ON r.ToAirportId = a.Id
-                     JOIN Country c ON a.CountryId = c.Id
-                     WHERE r.FromAirportId = ? AND r.IsActive = 1''',
-                  (request.form['id'], ))
-
-    airport_list = c.fetchall()
-    for country in sorted(set(d[3] for idx, d in enumerate(airport_list)), key=functools.cmp_to_key(compare)):
-        result.append({
-            'text': country,
-            'children': [{
-                'id': d[0],
-                'text': d[2] + ' - ' + d[1] if d[2] is not None else d[1]
-            } for idx, d in enumerate(airport_list) if d[3] == country]
-        })
-
-    return json.dumps(result)
-
-@app.route('/airlines', methods=['POST'])
+    catalog = get_catalog(DB_LCC_PATH)
+    return get_catalog_response(catalog, catalog.get_airport_codes(request.values['id']))
+
+@app.route('/airlines', methods=['GET', 'POST'])
 def get_airlines():
-    if not all(param in list(request.form) for param in ['fromId', 'toId']):
+    if not all(param in list(request.values) for param in ['fromId', 'toId']):
         app.logger.error('missing one or more following parameters - fromId, toId')
         abort(404)
 
-    db = get_db()
-    c = db.cursor()
-    c.execute('''SELECT a.Id, a.Name FROM Airline a
-                 JOIN Route r ON a.Id = r.AirlineId
-                 WHERE r.FromAirportId = ? AND r.ToAirportId = ? AND r.IsActive = 1''',
-              (request.form['fromId'], request.form['toId']))
-    return json.dumps([{
-        'id': d[0],
-        'name': d[1]
-        } for idx, d in enumerate(c.fetchall())]
+    catalog = get_catalog(DB_LCC_PATH)
+    return get_catalog_response(catalog, catalog.get_airlines(request.values['fromId'], request.values['toId']))
+
+def get_route_codes(from_id, to_id):
+    with timer(db_seconds, 'route_codes'):
+        c = get_db().cursor()
+        c.execute('''SELECT fap.Code, tap.Code, c.Currency FROM Airport fap, Airport tap
+                     JOIN Country c ON fap.CountryId = c.Id
+                     WHERE fap.Id = ? AND tap.Id = ?''', (from_id, to_id))
+        codes = c.fetchone()
+    currency = codes[2] if codes[2] is not None else 'TWD'
+    return codes[0], codes[1], currency
+
+def get_search_params():
+    # From the query string of GET requests or the form of POST ones
+    form = request.values
+    if not all(param in list(form) for param in ['fromId', 'toId', 'month', 'airlines']):
+        app.logger.error('missing one or more following parameters - fromId, toId, month, airlines')
+        abort(404)
+
+    origin, destination, currency = get_route_codes(form['fromId'], form['toId'])
+    airlines = [int(id_) for id_ in form['airlines'].split(',')]
+    # Keep the searches for prewarm.py to find the popular ones
+    try:
+        with timer(db_seconds, 'search_history'):
+            db = get_db()
+            db.executemany('''INSERT INTO SearchHistory (FromAirportId, ToAirportId, Month, AirlineId, SearchedAt)
+                              VALUES (?, ?, ?, ?, ?)''',
+                           [(form['fromId'], form['toId'], form['month'], id_, time()) for id_ in airlines])
+            db.commit()
+    except sqlite3.Error as e:
+        app.logger.error('Fail on saving the search history - {0}'.format(repr(e)))
+    return (
+        form['month'],
+        origin,
+        destination,
+        airlines,
+        currency
     )
 
-@app.route('/data', methods=['POST'])
+@app.route('/data', methods=['GET', 'POST'])
 def get_data():
-    if not all(param in list(request.form) for param in ['fromId', 'toId', 'month', 'airlines']):
-        app.logger.error('missing one or more following parameters - fromId, toId, month, airlines')
+    params = get_search_params()
+    fares = get_fares(*params)
+    data = get_visualized_data(fares)
+    data['currency'] = params[4]
+    response = Response(json.dumps(data), mimetype='application/json')
+    # Cacheable until the first of its fares expires, never when any airline failed
+    max_age = get_fresh_seconds(*params) if not fares.stale else 0
+    response.headers['Cache-Control'] = 'public, max-age={0}'.format(max_age) if max_age > 0 else 'no-cache'
+    return response
+
+@app.route('/data/stream', methods=['POST'])
+def stream_data():
+    # Newline-delimited JSON, one line for each airline as soon as its fares arrive, then one line for the table
+    params = get_search_params()
+
+    def generate():
+        fares = FareMatrix(*get_month_axis(params[0]))
+        for airline, prices, stale in iter_fares(*params):
+            fares.add(airline, prices, stale)
+            yield json.dumps({
+                'airline': airline.value,
+                'currency': params[4],
+                'line': get_line_spec(fares),
+                'stale': stale
+            }) + '\n'
+        # The table lists the airlines in the same order as /data does
+        fares = merge_fares(fares)
+        yield json.dumps({
+            'currency': params[4],
+            'line': get_line_spec(fares),
+            'table': get_table(fares),
+            'stale': get_stale(fares)
+        }) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/data/range', methods=['POST'])
+def get_range_data():
+    # Fares of the dates from start to end (YYYY-MM-DD) in one series, across months
+    if not all(param in list(request.form) for param in ['fromId', 'toId', 'start', 'end', 'airlines']):
+        app.logger.error('missing one or more following parameters - fromId, toId, start, end, airlines')
         abort(404)
 
-    db = get_db()
-    c = db.cursor()
-    c.execute('''SELECT fap.Code, tap.Code, c.Currency FROM Airport fap, Airport tap
-                 JOIN Country c ON fap.CountryId = c.Id
-                 WHERE fap.Id = ? AND tap.Id = ?''', (request.form['fromId'], request.form['toId']))
-    codes = c.fetchone()
-    currency = codes[2] if codes[2] is not None else 'TWD'
-    data = get_visualized_data(
-        get_fares(
-            request.form['month'],
-            codes[0],
-            codes[1],
-            [int(id_) for id_ in request.form['airlines'].split(',')],
-            currency
-    ))
+    try:
+        start = dt.datetime.strptime(request.form['start'], '%Y-%m-%d').date()
+        end = dt.datetime.strptime(request.form['end'], '%Y-%m-%d').date()
+        if end < start or (end - start).days >= RANGE_MAX_DAYS:
+            raise ValueError('the range must be within {0} days'.format(RANGE_MAX_DAYS))
+    except ValueError as e:
+        app.logger.error('invalid date range - {0}'.format(repr(e)))
+        abort(400)
+
+    origin, destination, currency = get_route_codes(request.form['fromId'], request.form['toId'])
+    airlines = [int(id_) for id_ in request.form['airlines'].split(',')]
+    data = get_visualized_data(get_fare_range(start, end, origin, destination, airlines, currency))
+    data['currency'] = currency
+    return json.dumps(data)
+
+@app.route('/itineraries', methods=['POST'])
+def get_itineraries():
+    # The cheapest direct or connecting itinerary of each departure date, mixing airlines
+    if not all(param in list(request.form) for param in ['fromId', 'toId', 'month']):
+        app.logger.error('missing one or more following parameters - fromId, toId, month')
+        abort(404)
+
+    from_id = int(request.form['fromId'])
+    to_id = int(request.form['toId'])
+    max_stops = min(int(request.form.get('maxStops', MAX_STOPS)), MAX_STOPS)
+    origin, destination, currency = get_route_codes(from_id, to_id)
+    # Bounded by the upstream budget and the deadline of a search, past which it answers with what it found
+    data = search_itineraries(get_catalog(DB_LCC_PATH), from_id, to_id, request.form['month'], currency, max_stops,
+                              time() + ITINERARY_DEADLINE)
     data['currency'] = currency
     return json.dumps(data)
 
+@app.route('/explore', methods=['POST'])
+def explore_destinations():
+    # The cheapest destinations from an airport in a month, as newline-delimited JSON: one line for each
+    # destination as soon as its fares are known with the top so far, then one line once the top is settled.
+    # exact=1 fetches every destination not in the cache rather than pruning on the fare history
+    if not all(param in list(request.form) for param in ['fromId', 'month']):
+        app.logger.error('missing one or more following parameters - fromId, month')
+        abort(404)
+
+    from_id = int(request.form['fromId'])
+    top_k = max(min(int(request.form.get('topK', EXPLORE_TOP_K)), EXPLORE_MAX_TOP_K), 1)
+    catalog = get_catalog(DB_LCC_PATH)
+    if from_id not in catalog.airports:
+        abort(404)
+    with timer(db_seconds, 'origin_currency'):
+        currency = get_db().execute('''SELECT c.Currency FROM Airport a
+                                        LEFT JOIN Country c ON a.CountryId = c.Id
+                                        WHERE a.Id = ?''', (from_id, )).fetchone()[0] or 'TWD'
+    # The lowest prices ever observed bound the destinations not in the cache, read before the response
+    # is streamed as the connection is closed with the request
+    month = request.form['month']
+    floors = None
+    if request.form.get('exact') not in ('1', 'true'):
+        try:
+            with timer(db_seconds, 'history_lowest'):
+                floors = get_lowest(get_history_db(), catalog.airports[from_id][1], month + '-01', month + '-31')
+        except sqlite3.Error as e:
+            app.logger.error('Fail on reading the lowest observed prices - {0}'.format(repr(e)))
+
+    def generate():
+        for line in explore(catalog, from_id, month, currency, floors, top_k):
+            line['currency'] = currency
+            yield json.dumps(line) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/watches', methods=['POST'])
+def create_watch():
+    # Watch a route and month for a fare at or below the threshold, notified by watch.py
+    if not all(param in list(request.form) for param in ['fromId', 'toId', 'month', 'airlines', 'threshold']):
+        app.logger.error('missing one or more following parameters - fromId, toId, month, airlines, threshold')
+        abort(404)
+
+    airlines = [int(id_) for id_ in request.form['airlines'].split(',')]
+    watch_id = add_watch(get_db(), int(request.form['fromId']), int(request.form['toId']), request.form['month'], airlines,
+                         int(request.form['threshold']))
+    return json.dumps({
+        'id': watch_id
+    })
+
+@app.route('/watches/cancel', methods=['POST'])
+def stop_watch():
+    if 'id' not in request.form:
+        app.logger.error('missing the parameter - id')
+        abort(404)
+
+    if not cancel_watch(get_db(), int(request.form['id'])):
+        abort(404)
+    return json.dumps({
+        'id': int(request.form['id'])
+    })
+
+@app.route('/history/trend', methods=['POST'])
+def get_history_trend():
+    # Prices observed over time for one travel date (YYYY-MM-DD), optionally since a UNIX time
+    if not all(param in list(request.form) for param in ['fromId', 'toId', 'date', 'airlines']):
+        app.logger.error('missing one or more following parameters - fromId, toId, date, airlines')
+        abort(404)
+
+    origin, destination, currency = get_route_codes(request.form['fromId'], request.form['toId'])
+    airlines = [int(id_) for id_ in request.form['airlines'].split(',')]
+    with timer(db_seconds, 'history_trend'):
+        trend = get_trend(get_history_db(), origin, destination, airlines, request.form['date'], int(request.form.get('since', 0)))
+    return json.dumps({
+        'date': request.form['date'],
+        'trend': [{
+            'airline': airline_id,
+            'points': points
+        } for airline_id, points in sorted(trend.items())]
+    })
+
+@app.route('/history/cheapest', methods=['POST'])
+def get_history_cheapest():
+    # The cheapest price ever observed for each travel date from start to end (YYYY-MM-DD)
+    if not all(param in list(request.form) for param in ['fromId', 'toId', 'start', 'end', 'airlines']):
+        app.logger.error('missing one or more following parameters - fromId, toId, start, end, airlines')
+        abort(404)
+
+    origin, destination, currency = get_route_codes(request.form['fromId'], request.form['toId'])
+    airlines = [int(id_) for id_ in request.form['airlines'].split(',')]
+    with timer(db_seconds, 'history_cheapest'):
+        cheapest = get_cheapest(get_history_db(), origin, destination, airlines, request.form['start'], request.form['end'])
+    return json.dumps({
+        'cheapest': cheapest
+    })
+
+@app.route('/status')
+def get_status():
+    # Circuit breakers and latency histograms of the airlines, with the counters of the cache and the history
+    return json.dumps({
+        'airlines': {airline.name: breakers[airline].stats() for airline in Airline},
+        'cache': get_cache_stats(),
+        'history': fare_history.stats()
+    })
+
+@app.route('/metrics')
+def get_metrics():
+    # Prometheus text format
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
+    # Keep the popular searches warm in the cache of this process
+    Prewarmer(DB_LCC_PATH).start()
     app.run()
@@ -0,0 +1,53 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Connection pools kept for each host and connections kept alive in each of them
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+# Retries of a failed GET request, waiting BACKOFF_FACTOR * (2 ** (retry - 1)) seconds in between
+RETRIES = 2
+BACKOFF_FACTOR = 0.3
+RETRY_STATUSES = (500, 502, 503, 504)
+
+sessions = {}
+sessions_lock = threading.Lock()
+# Set by replay.py to keep every response as a fixture
+recorder = None
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+def get_session(url):
+    # One session per host so that its keep-alive connections are reused by every scraper
+    host = urlsplit(url).netloc
+    session = sessions.get(host)
+    if session is None:
+        with sessions_lock:
+            session = sessions.get(host)
+            if session is None:
+                session = sessions[host] = create_session()
+    return session
+
+def http_get(url, **kwargs):
+    response = get_session(url).get(url, **kwargs)
+    if recorder is not None:
+        recorder.save(url, kwargs.get('params'), response)
+    return response
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
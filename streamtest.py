@@ -0,0 +1,106 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from time import time
+
+import requests
+from aiohttp import web
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port, get_route_forms
+
+# Time to the first result of /data/stream against the stubbed airline sites of loadtest.py with Jetstar much slower
+# than the others: the fares of the fast airlines reach the browser before Jetstar answers, while /data waits for it.
+# Both service.py and aservice.py are measured, as the search page streams from either of them
+STREAM_PORT = 8909
+ASYNC_STREAM_PORT = 8912
+AIRLINE_DELAYS = {
+    'tigerair': 0.2,
+    'vanilla': 0.3,
+    'jetstar': 2.0
+}
+# Seconds a line may take beyond the delay of its airline, for the parsing, the render and the thread hand-offs
+LINE_MARGIN = 0.5
+
+def read_stream(port, form):
+    # Seconds to each line of the stream, with the airline of the line, None for the final one
+    start = time()
+    response = requests.post('http://127.0.0.1:{0}/data/stream'.format(port), data=form, stream=True)
+    response.raise_for_status()
+    assert response.headers['Content-Type'].startswith('application/x-ndjson'), response.headers['Content-Type']
+    lines = []
+    for line in response.iter_lines():
+        data = json.loads(line)
+        assert 'line' in data and ('table' in data) == ('airline' not in data), data.keys()
+        lines.append((data.get('airline'), time() - start))
+    return lines
+
+def time_data(port, form):
+    start = time()
+    requests.post('http://127.0.0.1:{0}/data'.format(port), data=form).raise_for_status()
+    return time() - start
+
+def run_async_service(directory, db_path):
+    configure(directory)
+    import aservice
+    aservice.DB_LCC_PATH = db_path
+    web.run_app(aservice.create_app(), host='127.0.0.1', port=ASYNC_STREAM_PORT, print=None)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the time to the first result of /data/stream with a slow airline')
+    parser.add_argument('--month', default='2030-01')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(0.05, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    requests.post('http://{0}:{1}/delays'.format(STUB_HOSTS['tigerair'], STUB_PORT), data=AIRLINE_DELAYS).raise_for_status()
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'lcc.db')
+    shutil.copy('lcc.db', db_path)
+    configure(directory)
+    import server
+    import service
+    from migrations import migrate
+    from werkzeug.serving import make_server
+    migrate(db_path)
+    service.DB_LCC_PATH = db_path
+    http_server = make_server('127.0.0.1', STREAM_PORT, service.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    async_service = multiprocessing.Process(target=run_async_service, args=(directory, db_path), daemon=True)
+    async_service.start()
+    wait_for_port(ASYNC_STREAM_PORT)
+
+    # Distinct months, so that no round shares an upstream fetch with another
+    forms = get_route_forms(db_path, args.month, args.rounds * 4)
+    names = {server.Airline.TIGERAIR_TAIWAN.value: 'tigerair', server.Airline.VANILLA_AIR.value: 'vanilla',
+             server.Airline.JETSTAR.value: 'jetstar'}
+    results = {}
+    for mode, port, offset in [('sync', STREAM_PORT, 0), ('async', ASYNC_STREAM_PORT, args.rounds * 2)]:
+        results[mode] = []
+        for idx in range(args.rounds):
+            lines = read_stream(port, forms[offset + idx * 2])
+            result = {
+                'first_line_ms': round(lines[0][1] * 1000, 1),
+                'lines_ms': [(server.Airline(airline).name if airline is not None else 'table', round(seconds * 1000, 1))
+                             for airline, seconds in lines],
+                'data_ms': round(time_data(port, forms[offset + idx * 2 + 1]) * 1000, 1)
+            }
+            results[mode].append(result)
+            print(mode, result)
+            # One line for each airline in the order they answer, then the table once Jetstar is in
+            assert [airline for airline, seconds in lines] == [1, 2, 5, None], lines
+            for airline, seconds in lines[:-1]:
+                assert seconds < AIRLINE_DELAYS[names[airline]] * 2 + LINE_MARGIN, (airline, seconds)
+            assert lines[0][1] < AIRLINE_DELAYS['jetstar'] and result['data_ms'] / 1000 >= AIRLINE_DELAYS['jetstar']
+    http_server.shutdown()
+    async_service.terminate()
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,236 @@
+import argparse
+import json
+import sqlite3
+import threading
+from collections import defaultdict
+from time import time, strftime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from server import logger, DB_LCC_PATH, fare_cache, get_fares
+from migrations import migrate
+
+# Seconds between two evaluations of the watches
+WATCH_INTERVAL = 600
+# Routes and months fetched at the same time by one evaluation, each of them over all of their airlines
+WATCH_CONCURRENCY = 4
+# Notifications sent in one request of the webhook sink, and seconds it waits for the answer
+WATCH_WEBHOOK_BATCH = 500
+WATCH_WEBHOOK_TIMEOUT = 10
+
+class FileSink:
+    # Notifications appended to a file as JSON lines
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, notifications):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for notification in notifications:
+                f.write(json.dumps(notification) + '\n')
+
+class WebhookSink:
+    # Notifications POSTed to a URL as JSON lists of up to WATCH_WEBHOOK_BATCH
+    def __init__(self, url):
+        self.url = url
+
+    def send(self, notifications):
+        for idx in range(0, len(notifications), WATCH_WEBHOOK_BATCH):
+            requests.post(self.url, json=notifications[idx:idx + WATCH_WEBHOOK_BATCH],
+                          timeout=WATCH_WEBHOOK_TIMEOUT).raise_for_status()
+
+WATCH_SINKS = {
+    'file': FileSink,
+    'webhook': WebhookSink
+}
+
+def create_sink(kind, target):
+    # target is the path of the file sink, or the URL of the webhook one
+    return WATCH_SINKS[kind](target)
+
+def add_watch(conn, from_id, to_id, month, airlines, threshold):
+    c = conn.execute('''INSERT INTO Watch (FromAirportId, ToAirportId, Month, Airlines, Threshold, CreatedAt)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     (from_id, to_id, month, ','.join(str(id_) for id_ in airlines), threshold, time()))
+    conn.commit()
+    return c.lastrowid
+
+def cancel_watch(conn, watch_id):
+    c = conn.execute('UPDATE Watch SET IsActive = 0 WHERE Id = ?', (watch_id, ))
+    conn.commit()
+    return c.rowcount > 0
+
+def get_cheapest(fares):
+    # The cheapest (price, ISO date) of each airline by ID, airlines served stale or zeroed fares are left out
+    dates = fares.get_dates()
+    cheapest = {}
+    for airline, prices in fares.rows.items():
+        if airline in fares.stale:
+            continue
+        best = None
+        for idx, price in enumerate(prices):
+            if price and (best is None or price < best[0]):
+                best = (price, dates[idx])
+        if best is not None:
+            cheapest[airline.value] = best
+    return cheapest
+
+class Watcher:
+    # Evaluates every watch in batches: the watches of a route and month share one get_fares over the
+    # airlines of all of them, so each (airline, route, month) is fetched once per evaluation
+    def __init__(self, db_path, sink):
+        self.db_path = db_path
+        self.sink = sink
+        self.executor = ThreadPoolExecutor(max_workers=WATCH_CONCURRENCY)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.evaluations = 0
+        self.fetches = 0
+        self.notified = 0
+        self.failed = 0
+
+    def get_groups(self, conn):
+        # Active watches of this month on as {(origin, destination, month, currency): [(watch ID, airline IDs,
+        # threshold, notified price), ...]}, and the airline IDs of each group
+        rows = conn.execute('''SELECT w.Id, fap.Code, tap.Code, w.Month, IFNULL(c.Currency, "TWD"), w.Airlines, w.Threshold, w.NotifiedPrice
+                               FROM Watch w
+                               JOIN Airport fap ON w.FromAirportId = fap.Id
+                               JOIN Airport tap ON w.ToAirportId = tap.Id
+                               LEFT JOIN Country c ON fap.CountryId = c.Id
+                               WHERE w.IsActive = 1 AND w.Month >= ?''', (strftime('%Y-%m'), ))
+        groups = defaultdict(list)
+        airlines = defaultdict(set)
+        parsed = {}
+        for watch_id, origin, destination, month, currency, airline_ids, threshold, notified_price in rows:
+            if airline_ids not in parsed:
+                parsed[airline_ids] = tuple(int(id_) for id_ in airline_ids.split(','))
+            key = (origin, destination, month, currency)
+            groups[key].append((watch_id, parsed[airline_ids], threshold, notified_price))
+            airlines[key].update(parsed[airline_ids])
+        return groups, airlines
+
+    def evaluate(self, key, watches, cheapest, now):
+        # Notifications of the watches at or below their threshold and below the price last notified, and the
+        # watches back above it, to be notified again on the next drop
+        origin, destination, month, currency = key
+        notifications = []
+        rearmed = []
+        best_of = {}
+        for watch_id, airline_ids, threshold, notified_price in watches:
+            if airline_ids not in best_of:
+                fares = [cheapest[airline_id] + (airline_id, ) for airline_id in airline_ids if airline_id in cheapest]
+                best_of[airline_ids] = min(fares) if fares else None
+            best = best_of[airline_ids]
+            if best is None:
+                continue
+            if best[0] <= threshold:
+                if notified_price is None or best[0] < notified_price:
+                    notifications.append({
+                        'watch': watch_id,
+                        'origin': origin,
+                        'destination': destination,
+                        'month': month,
+                        'currency': currency,
+                        'threshold': threshold,
+                        'price': best[0],
+                        'date': best[1],
+                        'airline': best[2],
+                        'notifiedAt': now
+                    })
+            elif notified_price is not None:
+                rearmed.append((watch_id, ))
+        return notifications, rearmed
+
+    def run_once(self):
+        start = time()
+        # The fetches are the cache misses of the evaluation: the airlines answered from the cache, and the groups
+        # or airlines never fetched, are left out
+        misses = fare_cache.stats()['misses']
+        conn = sqlite3.connect(self.db_path)
+        try:
+            groups, airlines = self.get_groups(conn)
+            futures = {key: self.executor.submit(get_fares, key[2], key[0], key[1], sorted(airlines[key]), key[3])
+                       for key in groups}
+            notifications = []
+            rearmed = []
+            evaluate_seconds = 0
+            for key, future in futures.items():
+                try:
+                    fares = future.result()
+                except Exception as e:
+                    self.failed += 1
+                    logger.error('Fail on getting fares of {0} for the watches - {1}'.format(key, repr(e)))
+                    continue
+                evaluate_start = time()
+                group_notifications, group_rearmed = self.evaluate(key, groups[key], get_cheapest(fares), int(start))
+                notifications += group_notifications
+                rearmed += group_rearmed
+                evaluate_seconds += time() - evaluate_start
+            fetches = fare_cache.stats()['misses'] - misses
+            self.fetches += fetches
+
+            if notifications:
+                try:
+                    self.sink.send(notifications)
+                except Exception as e:
+                    # Left as they were, so that the next evaluation sends them again
+                    logger.error('Fail on sending {0} price notifications - {1}'.format(len(notifications), repr(e)))
+                    notifications = []
+            conn.executemany('UPDATE Watch SET NotifiedPrice = ?, NotifiedAt = ? WHERE Id = ?',
+                             [(notification['price'], start, notification['watch']) for notification in notifications])
+            conn.executemany('UPDATE Watch SET NotifiedPrice = NULL, NotifiedAt = NULL WHERE Id = ?', rearmed)
+            conn.commit()
+        finally:
+            conn.close()
+        self.evaluations += 1
+        self.notified += len(notifications)
+        result = {
+            'watches': sum(len(watches) for watches in groups.values()),
+            'groups': len(groups),
+            'airlines': sum(len(airline_ids) for airline_ids in airlines.values()),
+            'fetches': fetches,
+            'notified': len(notifications),
+            'rearmed': len(rearmed),
+            'seconds': round(time() - start, 3),
+            'evaluate_seconds': round(evaluate_seconds, 3)
+        }
+        logger.info('Watch evaluation finished - {0}'.format(result))
+        return result
+
+    def run(self, interval=WATCH_INTERVAL):
+        while not self.stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error('Fail on evaluating the watches - {0}'.format(repr(e)))
+            self.stop_event.wait(interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        return {
+            'evaluations': self.evaluations,
+            'fetches': self.fetches,
+            'notified': self.notified,
+            'failed': self.failed
+        }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate the price watches and notify the ones at or below their threshold')
+    parser.add_argument('--sink', choices=sorted(WATCH_SINKS), default='file')
+    parser.add_argument('--target', default='notifications.jsonl', help='file of the file sink, URL of the webhook one')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='seconds between two evaluations')
+    parser.add_argument('--once', action='store_true', help='evaluate once and exit')
+    args = parser.parse_args()
+
+    migrate(DB_LCC_PATH)
+    watcher = Watcher(DB_LCC_PATH, create_sink(args.sink, args.target))
+    if args.once:
+        print(watcher.run_once())
+    else:
+        watcher.run(args.interval)
@@ -0,0 +1,127 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socketserver
+import sqlite3
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from loadtest import STUB_HOSTS, STUB_PORT, run_stub, configure, wait_for_port
+
+# Evaluation time and fetches of watch.py for many watches over a few hundred routes, against the stubbed airline
+# sites of loadtest.py with a lowest fare set for each destination, notifying a local webhook and then a file, then
+# with the fares kept in the cache, where an evaluation fetches nothing
+WEBHOOK_PORT = 8907
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    received = []
+
+    def do_POST(self):
+        self.received.extend(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class WebhookServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def create_watches(db_path, watches, routes, month, seed):
+    # Watches of random airline subsets of routes run by the airlines with a fetcher, thresholds around their fares
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''SELECT r.FromAirportId, r.ToAirportId, GROUP_CONCAT(r.AirlineId) FROM Route r
+                           JOIN Airport a ON r.FromAirportId = a.Id
+                           WHERE r.IsActive = 1 AND r.AirlineId IN (1, 2, 5) AND a.CountryId IS NOT NULL
+                           GROUP BY r.FromAirportId, r.ToAirportId
+                           ORDER BY r.FromAirportId, r.ToAirportId''').fetchall()
+    chosen = rng.sample(rows, min(routes, len(rows)))
+    values = []
+    naive = 0
+    for _ in range(watches):
+        from_id, to_id, airline_ids = rng.choice(chosen)
+        airline_ids = airline_ids.split(',')
+        airlines = sorted(rng.sample(airline_ids, rng.randint(1, len(airline_ids))))
+        naive += len(airlines)
+        values.append((from_id, to_id, month, ','.join(airlines), rng.randint(2, 16) * 500, 0))
+    conn.executemany('''INSERT INTO Watch (FromAirportId, ToAirportId, Month, Airlines, Threshold, CreatedAt)
+                        VALUES (?, ?, ?, ?, ?, ?)''', values)
+    conn.commit()
+    codes = [row[0] for row in conn.execute('SELECT Code FROM Airport WHERE Id IN ({0})'.format(
+        ','.join(str(to_id) for from_id, to_id, airline_ids in chosen)))]
+    conn.close()
+    return codes, naive
+
+def count_upstream(server):
+    return sum(series[-1] for series in server.upstream_seconds.values.values())
+
+def run_evaluation(server, watcher, name):
+    calls = count_upstream(server)
+    result = watcher.run_once()
+    result['evaluation'] = name
+    result['upstream_requests'] = count_upstream(server) - calls
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the evaluation time and fetches of the price watches')
+    parser.add_argument('--watches', type=int, default=100000)
+    parser.add_argument('--routes', type=int, default=300)
+    parser.add_argument('--month', default='2030-01')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the stubbed airlines take to answer')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    stub = multiprocessing.Process(target=run_stub, args=(args.latency, ), daemon=True)
+    stub.start()
+    wait_for_port(STUB_PORT, STUB_HOSTS['tigerair'])
+    directory = tempfile.mkdtemp()
+    db_path = os.path.join(directory, 'lcc.db')
+    shutil.copy('lcc.db', db_path)
+    configure(directory)
+    import server
+    from migrations import migrate
+    from watch import Watcher, create_sink
+    migrate(db_path)
+
+    codes, naive = create_watches(db_path, args.watches, args.routes, args.month, args.seed)
+    rng = random.Random(args.seed)
+    requests.post('http://{0}:{1}/fares'.format(STUB_HOSTS['tigerair'], STUB_PORT),
+                  data={code: rng.randint(2, 12) * 500 for code in codes}).raise_for_status()
+    webhook = WebhookServer(('127.0.0.1', WEBHOOK_PORT), WebhookHandler)
+    threading.Thread(target=webhook.serve_forever, daemon=True).start()
+
+    # Watches already notified are only notified again below the price they were notified at
+    watcher = Watcher(db_path, create_sink('webhook', 'http://127.0.0.1:{0}/'.format(WEBHOOK_PORT)))
+    results = []
+    for name in ('first', 'second'):
+        results.append(run_evaluation(server, watcher, name))
+        results[-1]['naive_fetches'] = naive
+        results[-1]['received'] = len(WebhookHandler.received)
+        print(results[-1])
+    path = os.path.join(directory, 'notifications.jsonl')
+    watcher.sink = create_sink('file', path)
+    results.append(run_evaluation(server, watcher, 'file'))
+    with open(path, encoding='utf-8') as f:
+        results[-1]['written'] = sum(1 for line in f)
+    print(results[-1])
+    # The fares of the last evaluation are kept from now on
+    for airline_id in server.FARE_CACHE_TTLS:
+        server.FARE_CACHE_TTLS[airline_id] = 3600
+    results.append(run_evaluation(server, watcher, 'cached'))
+    print(results[-1])
+    # Only the airlines missing from the cache count as fetches
+    assert all(result['fetches'] <= result['airlines'] for result in results), results
+    assert results[-1]['fetches'] == 0, results[-1]
+    webhook.shutdown()
+    stub.terminate()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
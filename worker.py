@@ -0,0 +1,102 @@
+import argparse
+import os
+import socket
+import threading
+from time import time
+
+from server import logger, Airline, DB_LCC_PATH, FETCH_QUEUE_PATH, breakers, fare_cache, fetch_month
+from jobqueue import JOB_POLL_INTERVAL, JOB_QUEUE_BACKENDS, JOB_RETENTION, create_queue
+from migrations import migrate
+
+# Fetch jobs of each airline run at the same time by one worker process. Workers on other hosts
+# share the queue and the FareCache table through the same database or directory
+WORKER_CONCURRENCY = {
+    Airline.TIGERAIR_TAIWAN: 4,
+    Airline.VANILLA_AIR: 4,
+    Airline.SCOOT: 1,
+    Airline.PEACH_AVIATION: 1,
+    Airline.JETSTAR: 2
+}
+# Seconds between two purges of the finished jobs
+WORKER_PURGE_INTERVAL = 300
+
+class Worker:
+    def __init__(self, queue, concurrency=WORKER_CONCURRENCY):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.name = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.done = 0
+        self.failed = 0
+
+    def run_job(self, airline):
+        # Run one job of the airline, False when there was none
+        job = self.queue.claim([airline.value], self.name)
+        if job is None:
+            return False
+        job_id, key = job
+        airline_id, origin, destination, month, currency = key
+        try:
+            prices = fetch_month(airline, month, origin, destination, currency, time() + breakers[airline].get_timeout())
+            fare_cache.store(key, prices, time())
+        except Exception as e:
+            self.failed += 1
+            self.queue.finish(job_id, repr(e))
+            logger.error('Fail on the fetch job of {0} - {1}'.format(key, repr(e)))
+        else:
+            self.done += 1
+            self.queue.finish(job_id)
+            logger.info('Succeed on the fetch job of {0}'.format(key))
+        return True
+
+    def run(self, airline):
+        while not self.stop_event.is_set():
+            try:
+                busy = self.run_job(airline)
+            except Exception as e:
+                busy = False
+                logger.error('Fail on claiming a fetch job of the airline with ID {0} - {1}'.format(airline.value, repr(e)))
+            if not busy:
+                self.stop_event.wait(JOB_POLL_INTERVAL)
+
+    def start(self):
+        for airline, threads in self.concurrency.items():
+            for idx in range(threads):
+                thread = threading.Thread(target=self.run, args=(airline, ), name='worker-{0}-{1}'.format(airline.name.lower(), idx),
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+    def serve(self):
+        # Run the jobs until stopped, purging the finished ones from time to time
+        self.start()
+        while not self.stop_event.wait(WORKER_PURGE_INTERVAL):
+            try:
+                self.queue.purge(time() - JOB_RETENTION)
+            except Exception as e:
+                logger.error('Fail on purging finished fetch jobs - {0}'.format(repr(e)))
+
+def parse_concurrency(values):
+    # ['jetstar=4', ...] over WORKER_CONCURRENCY
+    concurrency = dict(WORKER_CONCURRENCY)
+    for value in values or []:
+        name, _, threads = value.partition('=')
+        concurrency[Airline[name.upper()]] = int(threads)
+    return concurrency
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the fetch jobs queued by the services')
+    parser.add_argument('--backend', choices=sorted(JOB_QUEUE_BACKENDS), default='sqlite')
+    parser.add_argument('--path', default=FETCH_QUEUE_PATH, help='database of the sqlite backend, directory of the filesystem one')
+    parser.add_argument('--concurrency', action='append', metavar='AIRLINE=THREADS',
+                        help='jobs of the airline run at the same time, e.g. jetstar=4, may be given more than once')
+    args = parser.parse_args()
+
+    migrate(DB_LCC_PATH)
+    Worker(create_queue(args.backend, args.path), parse_concurrency(args.concurrency)).serve()